@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""ASGI entry point for production serving
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+Progress event streams (/events) run on the event loop, so an idle
+connection costs a coroutine rather than a thread. Every other route goes
+through the Flask app on a bounded thread pool (ASGI_BRIDGE_THREADS). Response
+bodies are read from that pool one chunk at a time and sent from the loop, so a
+slow client holds no thread between chunks. Streamed bodies without a
+Content-Length, such as the ZIP of a playlist still downloading, are read on a
+separate pool (ASGI_STREAM_THREADS); while they wait for the next track they
+yield empty chunks, and the loop waits for a progress change before reading
+on. Event streams only read progress when a job they watch has changed, on
+a small pool of their own (ASGI_SNAPSHOT_THREADS). Downloads stay on the
+job queue and pipeline stages in main.
+
+Without STATE_DB, run a single process: jobs and progress live in memory.
+With it, start any number of API processes and run downloads in worker.py.
+"""
+import asyncio
+import io
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from werkzeug.wsgi import FileWrapper
+
+import main
+from main import CONFIG, logger
+
+# Chunk size for file bodies; Werkzeug's default of 8 KiB means a pool round trip per 8 KiB
+FILE_CHUNK_SIZE = 256 * 1024
+
+bridge_pool = ThreadPoolExecutor(max_workers=CONFIG['ASGI_BRIDGE_THREADS'], thread_name_prefix='asgi-bridge')
+stream_pool = ThreadPoolExecutor(max_workers=CONFIG['ASGI_STREAM_THREADS'], thread_name_prefix='asgi-stream')
+snapshot_pool = ThreadPoolExecutor(max_workers=CONFIG['ASGI_SNAPSHOT_THREADS'], thread_name_prefix='asgi-snapshot')
+
+class ProgressWaiter:
+    """Lets coroutines wait for progress changes without a thread each
+
+    Subscribes once to main.progress_notifier; every publish wakes all
+    waiting coroutines on the loop.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.version = main.progress_notifier.version
+        self._changed = asyncio.Event()
+        main.progress_notifier.subscribe(self._published)
+
+    def _published(self, version):
+        # Called from whichever thread wrote the progress
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._wake, version)
+
+    def _wake(self, version):
+        self.version = max(self.version, version)
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self, since, timeout):
+        """Wait until a version newer than `since` is published; returns the latest version"""
+        deadline = self.loop.time() + timeout
+        while self.version <= since:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return self.version
+
+    def close(self):
+        main.progress_notifier.unsubscribe(self._published)
+
+_waiter = None
+
+def progress_waiter():
+    global _waiter
+    loop = asyncio.get_running_loop()
+    if _waiter is None or _waiter.loop is not loop:
+        if _waiter is not None:
+            _waiter.close()
+        _waiter = ProgressWaiter(loop)
+    return _waiter
+
+def wsgi_environ(scope, body):
+    """WSGI environ for an ASGI HTTP scope and its request body"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': lambda file, buffer_size=FILE_CHUNK_SIZE: FileWrapper(file, FILE_CHUNK_SIZE),
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        else:
+            key = 'HTTP_' + name
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def call_flask(environ):
+    """Run a Flask view; returns (status, headers, body iterable)"""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    body = main.app(environ, start_response)
+    return started['status'], started['headers'], body
+
+def encode_headers(headers):
+    return [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in headers]
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def until_disconnect(coro, receive):
+    """Run a response coroutine, cancelling it if the client goes away"""
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    done, pending = await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    for future in pending:
+        future.cancel()
+    if task in done:
+        task.result()
+
+async def send_json(send, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def flask_response(environ, send):
+    """Serve a request through Flask, pulling the body chunk by chunk off the loop"""
+    loop = asyncio.get_running_loop()
+    status, headers, body = await loop.run_in_executor(bridge_pool, call_flask, environ)
+    # Bodies of unknown length may wait on downloads; keep them off the bridge pool
+    streamed = not any(name.lower() == 'content-length' for name, _ in headers)
+    pool = stream_pool if streamed else bridge_pool
+    try:
+        await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+        iterator = await loop.run_in_executor(pool, iter, body)
+        while True:
+            seen_version = main.progress_notifier.version
+            chunk = await loop.run_in_executor(pool, next, iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            elif streamed:
+                # Nothing ready yet; wait for progress on the loop instead of in a thread
+                await progress_waiter().wait(seen_version, CONFIG['SSE_KEEPALIVE'])
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        close = getattr(body, 'close', None)
+        if close:
+            await loop.run_in_executor(pool, close)
+
+async def progress_event_stream(jobs, send):
+    """Async counterpart of main.stream_progress_events"""
+    loop = asyncio.get_running_loop()
+    waiter = progress_waiter()
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ]})
+    sent = {}
+    seen_version, changed = main.progress_notifier.version, None
+    keepalive_at = loop.time() + CONFIG['SSE_KEEPALIVE']
+    while True:
+        # Wakeups for jobs this stream does not watch cost no thread
+        if any(main.needs_snapshot(job, sent, changed) for job in jobs):
+            # Snapshots read the progress backend, which may block; keep them off the loop
+            events, finished = await loop.run_in_executor(
+                snapshot_pool, main.changed_progress_events, jobs, sent, changed)
+            if events:
+                await send({'type': 'http.response.body', 'body': ''.join(events).encode('utf-8'), 'more_body': True})
+                keepalive_at = loop.time() + CONFIG['SSE_KEEPALIVE']
+            if finished:
+                break
+        await waiter.wait(seen_version, keepalive_at - loop.time())
+        if loop.time() >= keepalive_at:
+            await send({'type': 'http.response.body', 'body': main.SSE_KEEPALIVE_EVENT.encode(), 'more_body': True})
+            keepalive_at = loop.time() + CONFIG['SSE_KEEPALIVE']
+        seen_version, changed = main.progress_notifier.changes_since(seen_version)
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            main.start_services()
+            logger.info("Serving over ASGI with %d bridge and %d stream threads",
+                        CONFIG['ASGI_BRIDGE_THREADS'], CONFIG['ASGI_STREAM_THREADS'])
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _waiter is not None:
+                _waiter.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    body = await read_body(receive)
+    if body is None:
+        return
+
+    if scope['path'] == '/events' and scope['method'] == 'GET':
+        args = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        jobs, error = main.event_stream_jobs(args)
+        if error:
+            await send_json(send, 400, {'error': error})
+            return
+        await until_disconnect(progress_event_stream(jobs, send), receive)
+        return
+
+    await until_disconnect(flask_response(wsgi_environ(scope, body), send), receive)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(application, host='0.0.0.0', port=5000)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for the MP3 Downloader internals
+
+Usage: python benchmark.py [name ...]   (runs every benchmark if none given)
+"""
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import yt_dlp
+from yt_dlp.extractor.common import InfoExtractor
+
+import main
+
+def bench_progress_soak(hours=24, jobs_per_minute=30, updates_per_job=20):
+    """Simulate a day of traffic against the progress store and report memory"""
+
+    print(f"\n=== Progress store soak: {hours}h, {jobs_per_minute} jobs/min ===")
+
+    clock = {'now': 0.0}
+    store = main.ProgressStore(main.DownloadRecord, clock=lambda: clock['now'])
+
+    tracemalloc.start()
+    samples = []
+    job_number = 0
+    for minute in range(hours * 60):
+        for _ in range(jobs_per_minute):
+            download_id = f"job-{job_number}"
+            job_number += 1
+            for update in range(updates_per_job):
+                store[download_id] = {
+                    'status': 'downloading',
+                    'percentage': update * 100 / updates_per_job,
+                    'downloaded_bytes': update * 1024,
+                    'total_bytes': updates_per_job * 1024
+                }
+            store[download_id] = {'status': 'completed', 'percentage': 100, 'filename': f'{download_id}.mp3'}
+        clock['now'] += 60
+
+        if minute % 60 == 59:
+            current, _ = tracemalloc.get_traced_memory()
+            samples.append(current)
+            print(f"Hour {len(samples):2d}: {len(store):6d} records, {current / 1024:8.1f} KiB")
+
+    tracemalloc.stop()
+
+    # After the first PROGRESS_TTL the store should stop growing
+    settled = samples[max(1, int(main.CONFIG['PROGRESS_TTL'] // 3600)):]
+    growth = (max(settled) - min(settled)) / max(settled) * 100 if settled else 0
+    print(f"Jobs: {job_number}, evictions: {store.stats()['evictions']}")
+    print(f"Memory spread after warm-up: {growth:.1f}%")
+
+def legacy_hook(download_id, playlist_id, track_index, d):
+    """The pre-throttling hook: a fresh dict per chunk and a full record rewrite"""
+    total = d.get('total_bytes') or d.get('total_bytes_estimate')
+    percent = (d['downloaded_bytes'] / total) * 100 if total else 0
+    main.download_progress[download_id] = {
+        'status': 'downloading',
+        'percentage': min(percent, 100),
+        'speed': d.get('speed', 0) or 0,
+        'eta': d.get('eta', 0) or 0,
+        'downloaded_bytes': d.get('downloaded_bytes', 0),
+        'total_bytes': d.get('total_bytes') or d.get('total_bytes_estimate', 0)
+    }
+    main.set_track_progress(playlist_id, track_index, {
+        'status': 'downloading',
+        'percentage': percent,
+        'title': d.get('info_dict', {}).get('title', f'Track {track_index + 1}')
+    })
+
+def bench_hook_cost(calls=200000):
+    """Cost per yt-dlp progress callback, throttled hook vs. the previous behaviour"""
+
+    print(f"\n=== Progress hook cost: {calls} chunk callbacks ===")
+
+    total = calls * 1024
+    chunks = [
+        {'status': 'downloading', 'downloaded_bytes': i * 1024, 'total_bytes': total,
+         'speed': 1e6, 'eta': 10, 'info_dict': {'title': 'Benchmark Track'}}
+        for i in range(calls)
+    ]
+
+    main.download_progress['bench-legacy'] = {'status': 'starting'}
+    started = time.perf_counter()
+    for d in chunks:
+        legacy_hook('bench-legacy', 'bench-playlist', 0, d)
+    legacy = (time.perf_counter() - started) / calls
+
+    main.download_progress['bench-hook'] = {'status': 'starting'}
+    hook = main.DownloadProgressHook('bench-hook', 'bench-playlist', 1)
+    started = time.perf_counter()
+    for d in chunks:
+        hook(d)
+    throttled = (time.perf_counter() - started) / calls
+
+    print(f"Previous hook:  {legacy * 1e9:8.0f} ns/call")
+    print(f"Throttled hook: {throttled * 1e9:8.0f} ns/call ({legacy / throttled:.1f}x faster)")
+
+def legacy_classify(url):
+    """validate_url, detect_platform and is_playlist_url as they were before URLClassifier"""
+    url_pattern = re.compile(
+        r'^https?://'
+        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+'
+        r'(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'
+        r'localhost|'
+        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'
+        r'(?::\d+)?'
+        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+    well_formed = bool(url_pattern.match(url))
+    domain = urlparse(url.lower()).netloc.replace('www.', '')
+    platform = main.PLATFORM_SUPPORT.get(domain)
+    if platform is None:
+        platform = next((info for suffix, info in main.PLATFORM_SUPPORT.items() if domain.endswith(suffix)),
+                        main.UNKNOWN_PLATFORM)
+    indicators = ['playlist', 'album', 'list=', 'sets/', '/playlist/', '/album/', '/artist/']
+    is_playlist = any(indicator in url.lower() for indicator in indicators)
+    return well_formed, platform, is_playlist
+
+def url_corpus(count, unique):
+    """count URLs drawn with a skew from `unique` distinct ones across the known platforms"""
+    hosts = ['www.youtube.com', 'youtu.be', 'music.youtube.com', 'soundcloud.com', 'artist.bandcamp.com',
+             'vimeo.com', 'open.spotify.com', 'example.com', 'notyoutube.com']
+    paths = ['/watch?v={}', '/{}', '/watch?v={}&list=PL{}', '/someone/sets/{}', '/track/{}', '/album/{}']
+    rng = random.Random(42)
+    distinct = [f"https://{rng.choice(hosts)}{rng.choice(paths).format(i, i)}" for i in range(unique)]
+    # Automation re-submits a small set of URLs far more often than the rest
+    return [distinct[min(int(rng.paretovariate(1.2)) - 1, unique - 1)] if rng.random() < 0.5
+            else rng.choice(distinct) for _ in range(count)]
+
+def bench_url_classification(count=1000000, unique=200000):
+    """URL classification throughput: per-call regex and linear scans vs. URLClassifier"""
+
+    print(f"\n=== URL classification: {count} URLs, {unique} distinct ===")
+    corpus = url_corpus(count, unique)
+
+    started = time.perf_counter()
+    for url in corpus:
+        legacy_classify(url)
+    legacy = time.perf_counter() - started
+
+    uncached = main.URLClassifier(main.PLATFORM_SUPPORT, cache_size=0)
+    started = time.perf_counter()
+    for url in corpus:
+        uncached._classify(url)
+    indexed = time.perf_counter() - started
+
+    classifier = main.URLClassifier(main.PLATFORM_SUPPORT, main.CONFIG['URL_CACHE_SIZE'])
+    started = time.perf_counter()
+    for url in corpus:
+        classifier.classify(url)
+    cached = time.perf_counter() - started
+
+    print(f"Previous functions:   {count / legacy:12,.0f} URLs/s")
+    print(f"URLClassifier:        {count / indexed:12,.0f} URLs/s ({legacy / indexed:.1f}x)")
+    print(f"URLClassifier + LRU:  {count / cached:12,.0f} URLs/s ({legacy / cached:.1f}x), "
+          f"hit rate {classifier.stats()['hits'] / count:.0%}")
+    print(f"Lookalike notyoutube.com: previous {legacy_classify('https://notyoutube.com/x')[1]['name']!r}, "
+          f"now {classifier.classify('https://notyoutube.com/x').platform['name']!r}")
+
+class StubAudioServer(ThreadingHTTPServer):
+    """Local HTTP/1.1 server for the stub extractor: a page and an audio file per track"""
+
+    daemon_threads = True
+
+    def __init__(self, payload_size):
+        self.payload = b'\0' * payload_size
+        self.connections = 0
+        super().__init__(('127.0.0.1', 0), StubAudioHandler)
+
+class StubAudioHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        body = self.server.payload if self.path.startswith('/audio/') else b'<html>stub</html>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mp4' if self.path.startswith('/audio/') else 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def stub_extractor(base_url):
+    """InfoExtractor for stub:<id> URLs served by a StubAudioServer"""
+
+    class StubIE(InfoExtractor):
+        _VALID_URL = r'stub:(?P<id>\w+)'
+        IE_NAME = 'stub'
+
+        def _real_extract(self, url):
+            track_id = self._match_id(url)
+            self._download_webpage(f'{base_url}/page/{track_id}', track_id)
+            return {
+                'id': track_id,
+                'title': f'Stub {track_id}',
+                'uploader': 'Benchmark',
+                'formats': [{'format_id': 'audio', 'url': f'{base_url}/audio/{track_id}', 'ext': 'm4a',
+                             'acodec': 'mp4a.40.2', 'vcodec': 'none'}],
+            }
+
+    return StubIE
+
+def legacy_fetch(url, output_dir, hook, extractor):
+    """fetch_track's yt-dlp use before YoutubeDLPool: a new instance per track"""
+    ydl_opts = main.get_ydl_opts(output_dir, hook, transcode=False)
+    ydl_opts.update(continuedl=True, quiet=True, noprogress=True)
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        ydl.add_info_extractor(extractor())
+        return ydl.extract_info(url, download=True, ie_key='Stub')
+
+def bench_ydl_pool(tracks=200, payload_size=64 * 1024):
+    """Per-track cost of a fresh YoutubeDL vs. a pooled one, against a local stub extractor"""
+
+    print(f"\n=== YoutubeDL per track vs. pooled: {tracks} tracks of {payload_size // 1024} KiB ===")
+
+    server = StubAudioServer(payload_size)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    extractor = stub_extractor(f'http://127.0.0.1:{server.server_address[1]}')
+    hook = main.DownloadProgressHook('bench-ydl')
+    main.download_progress['bench-ydl'] = {'status': 'starting'}
+
+    def pooled_instance(options):
+        ydl = yt_dlp.YoutubeDL(dict(options, quiet=True, noprogress=True))
+        ydl.add_info_extractor(extractor())
+        return ydl
+
+    pool = main.YoutubeDLPool(1, tracks + 1, factory=pooled_instance)
+    results = {}
+    for name in ('per-track', 'pooled'):
+        server.connections = 0
+        started = time.perf_counter()
+        for i in range(tracks):
+            output_dir = tempfile.mkdtemp(prefix='mp3dl_bench_')
+            url = f'stub:{name.replace("-", "")}{i}'
+            if name == 'per-track':
+                legacy_fetch(url, output_dir, hook, extractor)
+            else:
+                with pool.session(output_dir, hook) as ydl:
+                    ydl.extract_info(url, download=True, ie_key='Stub')
+            if not os.listdir(output_dir):
+                raise RuntimeError(f"{name}: nothing downloaded for {url}")
+            shutil.rmtree(output_dir)
+        results[name] = ((time.perf_counter() - started) / tracks, server.connections)
+    server.shutdown()
+
+    legacy, pooled = results['per-track'][0], results['pooled'][0]
+    for name, (seconds, connections) in results.items():
+        print(f"{name + ':':11s} {seconds * 1e3:7.2f} ms/track, {connections / tracks:.2f} connections/track")
+    print(f"Pooled is {legacy / pooled:.1f}x faster per track; pool {pool.stats()}")
+
+BENCHMARKS = {
+    'progress_soak': bench_progress_soak,
+    'hook_cost': bench_hook_cost,
+    'url_classification': bench_url_classification,
+    'ydl_pool': bench_ydl_pool,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        started = time.perf_counter()
+        BENCHMARKS[name]()
+        print(f"({name} took {time.perf_counter() - started:.1f}s)")
@@ -6,15 +6,42 @@ import tempfile
 import threading
 import time
 import uuid
+import heapq
+from datetime import datetime, timezone
 import shutil
-import zipfile
+import subprocess
+import struct
+import zlib
 import logging
 from pathlib import Path
 import re
-from urllib.parse import urlparse
+import hashlib
+import math
+import random
+import json
+import socket
+import sqlite3
+from collections import OrderedDict, deque, namedtuple
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import lru_cache, wraps
+from urllib.parse import quote, urlparse
+
+try:
+    import fcntl
+except ImportError:  # Windows: partial downloads are only locked within the process
+    fcntl = None
+
+try:
+    import config as settings  # Deployment settings; CONFIG reads the keys it supports from it
+except ImportError:
+    settings = None
 
 import yt_dlp
-from flask import Flask, render_template, request, jsonify, send_file
+from yt_dlp.extractor import gen_extractor_classes
+from flask import Flask, Response, render_template, request, jsonify, send_file
+from werkzeug.http import http_date, is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
 from mutagen.mp3 import MP3
 from mutagen.id3 import ID3, TIT2, TPE1, TALB
 
@@ -25,49 +52,1478 @@ app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Global storage for download progress
-download_progress = {}
-playlist_progress = {}
+# Guards read-modify-write updates of playlist progress from concurrent tracks
+progress_lock = threading.RLock()
 
 # Configuration
 CONFIG = {
     'AUDIO_FORMAT': 'mp3',
     'AUDIO_QUALITY': '320',
     'MAX_CONCURRENT_DOWNLOADS': 3,
+    # Tracks a single playlist may have queued or running at once (0 = MAX_CONCURRENT_DOWNLOADS)
+    'PLAYLIST_TRACK_WINDOW': 0,
+    # Entries read per page of a paged playlist listing, and journaled per write
+    'PLAYLIST_PAGE_SIZE': 100,
+    'MAX_ACTIVE_JOBS': 4,  # Jobs (single downloads or playlists) being worked on
+    'MAX_QUEUED_JOBS': 50,  # Jobs waiting for a worker before new ones are rejected
+    'TRANSCODE_WORKERS': os.cpu_count() or 2,  # Concurrent FFmpeg conversions
+    'FFMPEG_PATH': 'ffmpeg',
+    'FFMPEG_TIMEOUT': 600,  # Seconds before a conversion is killed and its track fails
     'TEMP_DIR': tempfile.gettempdir(),
     'DOWNLOAD_DIR': os.path.join(os.getcwd(), 'downloads'),
-    'CLEANUP_DELAY': 300  # 5 minutes
+    'CLEANUP_DELAY': 300,  # 5 minutes
+    'CACHE_MAX_BYTES': 2 * 1024 ** 3,  # Disk budget for cached results
+    # Hand file transfers to a front proxy: None, 'x-sendfile' or 'x-accel-redirect'
+    'SENDFILE_OFFLOAD': None,
+    'X_ACCEL_PREFIX': '/protected-downloads/',  # nginx internal location mapped to DOWNLOAD_DIR
+    'UNCLAIMED_FILE_TTL': 3600,  # Seconds to keep results nobody has fetched
+    'DISK_HIGH_WATERMARK': 10 * 1024 ** 3,  # Expire files early above this many bytes...
+    'DISK_LOW_WATERMARK': 8 * 1024 ** 3,  # ...until usage is back under this
+    'JANITOR_INTERVAL': 30,  # Seconds between disk usage checks
+    'PROGRESS_TTL': 3600,  # Seconds to keep finished jobs' progress
+    'PROGRESS_IDLE_TTL': 86400,  # Seconds before a job with no updates is dropped
+    'PROGRESS_MAX_ENTRIES': 10000,  # Per store (downloads, playlists)
+    'PROGRESS_PRUNE_INTERVAL': 60,
+    # Progress hook writes at most every interval, or sooner on a large enough change
+    'PROGRESS_HOOK_INTERVAL': 0.25,
+    'PROGRESS_HOOK_MIN_DELTA': 1.0,  # Percentage points
+    'SSE_KEEPALIVE': 15,  # Seconds between keep-alive comments on idle event streams
+    'SSE_MAX_JOBS': 500,  # Jobs one event stream may watch
+    'PROGRESS_BATCH_MAX_JOBS': 1000,  # Jobs one /progress/batch request may ask for
+    'ASGI_BRIDGE_THREADS': 32,  # Threads running Flask views and reading response bodies under asgi.py
+    'ASGI_STREAM_THREADS': 32,  # Threads reading streamed bodies (no Content-Length), such as in-progress playlist ZIPs
+    'ASGI_SNAPSHOT_THREADS': 4,  # Threads reading progress for /events streams under asgi.py
+    'STREAM_FILE_WAIT': 1,  # Seconds a streamed playlist ZIP blocks waiting for its next track before yielding an empty chunk
+    # Multi-node deployments: a SQLite file every node can reach, next to a shared DOWNLOAD_DIR
+    'STATE_DB': os.environ.get('STATE_DB', ''),  # '' keeps jobs and progress in process memory
+    'ROLE': os.environ.get('ROLE', 'all'),  # 'api' only enqueues, 'worker' only downloads, 'all' does both
+    'STATE_POLL_INTERVAL': 0.5,  # Seconds between checks for progress written by other nodes
+    'JOB_POLL_INTERVAL': 1.0,  # Seconds between idle workers' checks for new jobs
+    'JOB_LEASE': 60.0,  # Seconds a claimed job stays with a node that stops renewing it
+    # Playlist journal used to resume after a restart; kept in STATE_DB when that is set
+    'JOURNAL_DB': None,  # None keeps it in DOWNLOAD_DIR/.state/journal.db, '' disables it
+    # Unfinished source downloads are kept here so a retry resumes them; node-local, not in DOWNLOAD_DIR
+    'PARTIAL_DIR': os.path.join(tempfile.gettempdir(), 'mp3dl_partial'),
+    'PARTIAL_TTL': 86400,  # Seconds to keep an abandoned partial download (0 disables resuming)
+    # Failed track fetches are retried with exponential backoff and jitter
+    'TRACK_RETRIES': 3,
+    'RETRY_BASE_DELAY': 2.0,  # Seconds before the first retry, doubling per attempt...
+    'RETRY_MAX_DELAY': 60.0,  # ...up to this
+    # Consecutive retryable failures on one platform before its fetches are deferred, and for how long
+    'BREAKER_THRESHOLD': 5,
+    'BREAKER_COOLDOWN': 60.0,
+    'TRACK_MAX_DEFERRAL': 600.0,  # Seconds a track may spend deferred by open breakers before it fails
+    # Aggregate download rate across all fetches in bytes/s (0 = unlimited); per-platform
+    # concurrency and rate limits are the max_concurrent and ratelimit keys of PLATFORM_SUPPORT,
+    # shared by all entries of a family
+    'MAX_BANDWIDTH': 0,
+    # Warm YoutubeDL instances kept for fetches (0 = one per download slot), and fetches
+    # before one is rebuilt (1 builds a new instance for every track)
+    'YDL_POOL_SIZE': 0,
+    'YDL_POOL_MAX_USES': 100,
+    'BATCH_MAX_URLS': 500,  # URLs one /download/batch request may submit
+    'URL_CACHE_SIZE': 4096,  # Recently classified URLs kept by url_classifier
+    # Per-client limit on submissions (/download, /download_playlist, /download/batch), from config.py
+    'RATE_LIMIT_ENABLED': getattr(settings, 'RATE_LIMIT_ENABLED', False),
+    'RATE_LIMIT_PER_MINUTE': getattr(settings, 'RATE_LIMIT_PER_MINUTE', 10),
+    # Header identifying a client instead of its IP; only set it if a gateway in front authenticates it
+    'RATE_LIMIT_KEY_HEADER': None,
+    # Reverse proxies in front of the app; client IPs are then read from their X-Forwarded-For
+    'TRUSTED_PROXY_HOPS': int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
 }
 
+# Identifies this process in the shared job table
+NODE_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+class ProgressRecord:
+    """Progress of one job, stored in fixed slots instead of a fresh dict
+    
+    Records behave like a small mapping for the common fields; keys that are
+    not in FIELDS are kept in `extra`. Unset (None) fields are left out of
+    to_dict().
+    """
+    
+    FIELDS = ()
+    __slots__ = ('version', 'updated_at', 'extra')
+    
+    def __init__(self, data=None):
+        self.reset(data or {})
+        
+    def reset(self, data):
+        """Replace the whole record with data"""
+        for field in self.FIELDS:
+            setattr(self, field, None)
+        self.version = 0
+        self.updated_at = 0.0
+        self.extra = None
+        self.update(data)
+        
+    def update(self, data):
+        for key, value in data.items():
+            self[key] = value
+            
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+            
+    def get(self, key, default=None):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+        else:
+            value = self.extra.get(key) if self.extra else None
+        return default if value is None else value
+    
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+    
+    def __contains__(self, key):
+        return self.get(key) is not None
+    
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in self.FIELDS if getattr(self, field) is not None}
+        if self.extra:
+            data.update(self.extra)
+        return data
+    
+    @classmethod
+    def from_stored(cls, data):
+        """Rebuild a record from the JSON a shared backend stored"""
+        return cls(data)
+
+class DownloadRecord(ProgressRecord):
+    FIELDS = (
+        'status', 'percentage', 'message', 'error', 'speed', 'eta',
+        'downloaded_bytes', 'total_bytes', 'stage', 'title', 'artist',
+        'file_path', 'filename', 'stage_timings', 'playlist_id'
+    )
+    __slots__ = FIELDS
+
+class PlaylistRecord(ProgressRecord):
+    FIELDS = (
+        'status', 'overall_percentage', 'completed_tracks', 'total_tracks',
+        'tracks', 'message', 'error', 'playlist_title', 'zip_filename', 'skipped_tracks'
+    )
+    __slots__ = FIELDS
+    
+    @classmethod
+    def from_stored(cls, data):
+        # JSON turned the track index keys into strings
+        if data.get('tracks'):
+            data['tracks'] = {int(index): track for index, track in data['tracks'].items()}
+        return cls(data)
+
+class ProgressBackend:
+    """Storage interface behind ProgressStore
+    
+    Implementations hold records by key and report keys least recently
+    saved first, which ProgressStore relies on for eviction.
+    """
+    
+    def load(self, key):
+        raise NotImplementedError
+    
+    def save(self, key, record):
+        raise NotImplementedError
+    
+    def delete(self, key):
+        raise NotImplementedError
+    
+    def keys(self):
+        raise NotImplementedError
+    
+    def __len__(self):
+        raise NotImplementedError
+
+class MemoryProgressBackend(ProgressBackend):
+    """In-process backend; saving a record moves it to the back of the LRU order"""
+    
+    def __init__(self):
+        self._records = OrderedDict()
+        
+    def load(self, key):
+        return self._records.get(key)
+    
+    def save(self, key, record):
+        self._records[key] = record
+        self._records.move_to_end(key)
+        
+    def delete(self, key):
+        return self._records.pop(key, None)
+    
+    def keys(self):
+        return list(self._records)
+    
+    def __len__(self):
+        return len(self._records)
+
+class StateDB:
+    """SQLite database holding the state nodes share: progress records and queued jobs
+    
+    Each thread gets its own connection. WAL mode lets readers run alongside
+    the single writer. `version` in the meta table is the progress version
+    counter for every node.
+    """
+    
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        INSERT OR IGNORE INTO meta (name, value) VALUES ('version', 0);
+        CREATE TABLE IF NOT EXISTS progress (
+            store TEXT NOT NULL,
+            key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (store, key)
+        );
+        CREATE INDEX IF NOT EXISTS progress_version ON progress (store, version);
+        CREATE TABLE IF NOT EXISTS jobs (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT UNIQUE NOT NULL,
+            func TEXT NOT NULL,
+            args TEXT NOT NULL,
+            status TEXT NOT NULL,
+            node TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            not_before REAL NOT NULL DEFAULT 0,
+            lease_until REAL,
+            lost_leases INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, seq);
+        CREATE TABLE IF NOT EXISTS journal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL,
+            track_index INTEGER,
+            event TEXT NOT NULL,
+            data TEXT NOT NULL,
+            at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS journal_job ON journal (job_id, seq);
+        CREATE TABLE IF NOT EXISTS rate_limits (client TEXT PRIMARY KEY, tat REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS expiries (
+            kind TEXT NOT NULL,
+            target TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (kind, target)
+        );
+        CREATE INDEX IF NOT EXISTS expiries_deadline ON expiries (expires_at);
+        CREATE TABLE IF NOT EXISTS sync_archive (
+            playlist TEXT NOT NULL,
+            entry TEXT NOT NULL,
+            job TEXT NOT NULL,
+            track TEXT NOT NULL,
+            delivered INTEGER NOT NULL DEFAULT 0,
+            at REAL NOT NULL,
+            PRIMARY KEY (playlist, entry)
+        );
+        CREATE INDEX IF NOT EXISTS sync_archive_track ON sync_archive (track, delivered);
+        CREATE INDEX IF NOT EXISTS sync_archive_job ON sync_archive (job, delivered);
+        CREATE TABLE IF NOT EXISTS result_cache (
+            key TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            metadata TEXT NOT NULL,
+            used_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS result_cache_used ON result_cache (used_at);
+    '''
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self.connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(self.SCHEMA)
+        
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+    
+    @contextmanager
+    def transaction(self):
+        """Write transaction; BEGIN IMMEDIATE serializes writers across processes"""
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        
+    def next_version(self, conn, at_least=0):
+        """Take the next shared version inside a transaction"""
+        current = conn.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()[0]
+        version = max(current + 1, at_least)
+        conn.execute("UPDATE meta SET value = ? WHERE name = 'version'", (version,))
+        return version
+    
+    def version(self):
+        return self.connect().execute("SELECT value FROM meta WHERE name = 'version'").fetchone()[0]
+
+class SqliteProgressBackend(ProgressBackend):
+    """Progress records in a StateDB, so any node can answer for any job
+    
+    Records are stored as JSON, and load() returns a fresh copy. Callers that
+    change a record in place must pass it back to ProgressStore.touch().
+    """
+    
+    def __init__(self, db, name, record_class):
+        self.db = db
+        self.name = name
+        self.record_class = record_class
+        
+    def load(self, key):
+        row = self.db.connect().execute(
+            'SELECT data, version, updated_at FROM progress WHERE store = ? AND key = ?',
+            (self.name, key)
+        ).fetchone()
+        if row is None:
+            return None
+        record = self.record_class.from_stored(json.loads(row[0]))
+        record.version, record.updated_at = row[1], row[2]
+        return record
+    
+    def save(self, key, record):
+        """Store the record under the next shared version; returns that version"""
+        data = json.dumps(record.to_dict())
+        with self.db.transaction() as conn:
+            record.version = self.db.next_version(conn, record.version)
+            conn.execute(
+                'INSERT OR REPLACE INTO progress (store, key, data, version, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (self.name, key, data, record.version, record.updated_at)
+            )
+        return record.version
+    
+    def delete(self, key):
+        record = self.load(key)
+        if record is not None:
+            with self.db.transaction() as conn:
+                conn.execute('DELETE FROM progress WHERE store = ? AND key = ?', (self.name, key))
+        return record
+    
+    def keys(self):
+        rows = self.db.connect().execute(
+            'SELECT key FROM progress WHERE store = ? ORDER BY version', (self.name,)
+        )
+        return [row[0] for row in rows]
+    
+    def changed_since(self, version):
+        """(store, key) of the records saved after version, for ProgressNotifier.observe()"""
+        rows = self.db.connect().execute(
+            'SELECT key FROM progress WHERE store = ? AND version > ?', (self.name, version)
+        )
+        return [(self.name, row[0]) for row in rows]
+    
+    def __len__(self):
+        return self.db.connect().execute(
+            'SELECT COUNT(*) FROM progress WHERE store = ?', (self.name,)
+        ).fetchone()[0]
+
+class ProgressNotifier:
+    """Versions progress changes and wakes up anyone waiting for them
+    
+    Versions increase across every store, so clients can ask for "changes
+    since" a cursor. A version is handed out and applied under one lock, so
+    every change up to the current version is visible to readers.
+    
+    The (store, key) pairs each version wrote are remembered for the last
+    CHANGE_LOG_SIZE versions, so a waiter can re-read only the records it
+    watches that changed rather than all of them (see changes_since()).
+    """
+    
+    CHANGE_LOG_SIZE = 4096
+    
+    def __init__(self):
+        self.version = 0
+        self._cond = threading.Condition()
+        self._listeners = []
+        # (version, frozenset of (store, key), or None when unknown)
+        self._changes = deque()
+        self._forgotten = 0
+        
+    def publish(self, apply=None, keys=None):
+        """Take the next version, pass it to `apply` and wake waiters; returns the version
+        
+        `apply` may return a higher version, as shared backends number
+        changes across every node. `keys` are the (store, key) pairs the
+        change wrote: () if it wrote no record, None if unknown.
+        """
+        with self._cond:
+            version = self.version + 1
+            if apply is not None:
+                version = max(version, apply(version) or 0)
+            # Skipped versions were written by other nodes and are not observed yet
+            self._advance(version, keys if version == self.version + 1 else None)
+            return version
+        
+    def observe(self, version, keys=None):
+        """Catch up with a version published by another node
+        
+        `keys` are the (store, key) pairs written since the last version
+        seen here, or None if unknown.
+        """
+        with self._cond:
+            if version > self.version:
+                self._advance(version, keys)
+                
+    def _advance(self, version, keys):
+        self.version = version
+        self._changes.append((version, None if keys is None else frozenset(keys)))
+        if len(self._changes) > self.CHANGE_LOG_SIZE:
+            self._forgotten = self._changes.popleft()[0]
+        self._cond.notify_all()
+        for listener in self._listeners:
+            listener(version)
+        
+    def subscribe(self, listener):
+        """Call listener(version) on every publish; it must not block"""
+        with self._cond:
+            self._listeners.append(listener)
+            
+    def unsubscribe(self, listener):
+        with self._cond:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+            
+    def wait(self, since, timeout):
+        """Block until something newer than `since` is published; returns the latest version"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version > since, timeout)
+            return self.version
+        
+    def changes_since(self, since):
+        """(latest version, set of (store, key) written after `since`)
+        
+        The set is None when some of those changes are unknown, or too old
+        to be remembered; the caller then has to re-read everything.
+        """
+        with self._cond:
+            if since < self._forgotten:
+                return self.version, None
+            keys = set()
+            for version, changed in reversed(self._changes):
+                if version <= since:
+                    break
+                if changed is None:
+                    return self.version, None
+                keys |= changed
+            return self.version, keys
+
+progress_notifier = ProgressNotifier()
+
+class ProgressStore:
+    """Bounded, expiring map of job id -> progress record
+    
+    Finished jobs (completed/error) expire PROGRESS_TTL seconds after their
+    last update, except playlist tracks, which are dropped with their
+    playlist (see forget_playlist). Anything idle for PROGRESS_IDLE_TTL is
+    dropped, and at most PROGRESS_MAX_ENTRIES records are kept, least
+    recently updated evicted first. Writes go through the store so non-memory backends see them.
+    """
+    
+    TERMINAL_STATUSES = ('completed', 'partial', 'error')
+    
+    def __init__(self, record_class, backend=None, clock=time.time, name=None):
+        self.record_class = record_class
+        self.backend = backend if backend is not None else MemoryProgressBackend()
+        self.clock = clock
+        # Store name in the keys published to progress_notifier; None publishes unknown keys
+        self.name = name
+        self.evictions = 0
+        self._lock = threading.RLock()
+        self._next_prune = 0
+        
+    def _save(self, key, record):
+        record.updated_at = self.clock()
+        
+        def apply(version):
+            record.version = version
+            return self.backend.save(key, record)
+        progress_notifier.publish(apply, ((self.name, key),) if self.name else None)
+        if len(self.backend) > CONFIG['PROGRESS_MAX_ENTRIES'] or record.updated_at >= self._next_prune:
+            self.prune()
+            
+    def __setitem__(self, key, data):
+        with self._lock:
+            record = self.backend.load(key)
+            if record is None:
+                record = self.record_class()
+            record.reset(data)
+            self._save(key, record)
+            
+    def update(self, key, data):
+        """Merge data into a record, creating it if needed; returns the record"""
+        with self._lock:
+            record = self.backend.load(key)
+            if record is None:
+                record = self.record_class()
+            record.update(data)
+            self._save(key, record)
+            return record
+        
+    def touch(self, key, record=None):
+        """Save a record after changing it in place
+        
+        Pass the changed record; shared backends hand out copies, so loading
+        it again would lose the change.
+        """
+        with self._lock:
+            if record is None:
+                record = self.backend.load(key)
+            if record is not None:
+                self._save(key, record)
+                
+    def setdefault(self, key, data):
+        with self._lock:
+            record = self.backend.load(key)
+            if record is None:
+                record = self.record_class(data)
+                self._save(key, record)
+            return record
+        
+    def get(self, key, default=None):
+        record = self.backend.load(key)
+        return default if record is None else record
+    
+    def __getitem__(self, key):
+        record = self.backend.load(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+    
+    def __contains__(self, key):
+        return self.backend.load(key) is not None
+    
+    def pop(self, key, default=None):
+        with self._lock:
+            record = self.backend.delete(key)
+        return default if record is None else record
+    
+    def __len__(self):
+        return len(self.backend)
+    
+    def prune(self):
+        """Drop expired records and enforce PROGRESS_MAX_ENTRIES"""
+        with self._lock:
+            now = self.clock()
+            self._next_prune = now + CONFIG['PROGRESS_PRUNE_INTERVAL']
+            keys = self.backend.keys()
+            excess = len(keys) - CONFIG['PROGRESS_MAX_ENTRIES']
+            for key in keys:
+                record = self.backend.load(key)
+                if record is None:
+                    continue
+                age = now - record.updated_at
+                if (excess > 0
+                        or age > CONFIG['PROGRESS_IDLE_TTL']
+                        or (record.status in self.TERMINAL_STATUSES and age > CONFIG['PROGRESS_TTL']
+                            and not record.get('playlist_id'))):
+                    self.backend.delete(key)
+                    self.evictions += 1
+                    excess -= 1
+                    
+    def stats(self):
+        return {'entries': len(self.backend), 'evictions': self.evictions}
+
+# Shared state for multi-node deployments; None keeps everything in this process
+state_db = StateDB(CONFIG['STATE_DB']) if CONFIG['STATE_DB'] else None
+
+def progress_backend(name, record_class):
+    if state_db:
+        return SqliteProgressBackend(state_db, name, record_class)
+    return MemoryProgressBackend()
+
+class RateLimiter:
+    """Per-client request limit of RATE_LIMIT_PER_MINUTE, using the generic cell rate algorithm
+    
+    Each client is a single timestamp, its theoretical arrival time (TAT): the
+    moment its allowance would be fully used if requests arrived at exactly the
+    allowed rate. A request is let through while the TAT is less than a minute
+    ahead, and pushes it 60/RATE_LIMIT_PER_MINUTE seconds further. So a client
+    may burst its whole minute's allowance and then continue at the allowed
+    rate. Clients whose TAT has passed are back at a full allowance and are
+    pruned, so memory is proportional to recently active clients.
+    """
+    
+    PRUNE_INTERVAL = 60
+    
+    def __init__(self):
+        self.allowed = 0
+        self.limited = 0
+        self._tats = {}
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        
+    @staticmethod
+    def admit(tat, now, count=1):
+        """(new TAT, how many of count requests arriving now are allowed, seconds until the next one would be)"""
+        interval = 60.0 / CONFIG['RATE_LIMIT_PER_MINUTE']
+        tat = max(tat or now, now)
+        granted = min(count, max(0, math.floor((now + 60.0 + 1e-9 - tat) / interval)))
+        tat += granted * interval
+        return tat, granted, 0 if granted == count else tat + interval - now - 60.0
+    
+    def hit(self, client, now=None):
+        """Count a request from client; returns 0 if it is allowed, else the seconds to wait"""
+        return self.take(client, 1, now)[1]
+    
+    def take(self, client, count, now=None):
+        """Count up to count requests from client; returns (number allowed, seconds to wait for the rest)"""
+        now = time.time() if now is None else now
+        granted, retry_after = self._take(client, count, now)
+        with self._lock:
+            self.allowed += granted
+            self.limited += count - granted
+            prune = now - self._last_prune >= self.PRUNE_INTERVAL
+            if prune:
+                self._last_prune = now
+        if prune:
+            self.prune(now)
+        return granted, retry_after
+    
+    def _take(self, client, count, now):
+        with self._lock:
+            tat, granted, retry_after = self.admit(self._tats.get(client), now, count)
+            self._tats[client] = tat
+        return granted, retry_after
+    
+    def prune(self, now):
+        with self._lock:
+            for client in [client for client, tat in self._tats.items() if tat <= now]:
+                del self._tats[client]
+                
+    def clients(self):
+        return len(self._tats)
+    
+    def stats(self):
+        return {
+            'enabled': CONFIG['RATE_LIMIT_ENABLED'],
+            'per_minute': CONFIG['RATE_LIMIT_PER_MINUTE'],
+            'clients': self.clients(),
+            'allowed': self.allowed,
+            'limited': self.limited
+        }
+
+class SharedRateLimiter(RateLimiter):
+    """RateLimiter keeping the TATs in STATE_DB, so every API node enforces one limit per client"""
+    
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+        
+    def _take(self, client, count, now):
+        with self.db.transaction() as conn:
+            row = conn.execute("SELECT tat FROM rate_limits WHERE client = ?", (client,)).fetchone()
+            tat, granted, retry_after = self.admit(row[0] if row else None, now, count)
+            if granted:
+                conn.execute("INSERT OR REPLACE INTO rate_limits (client, tat) VALUES (?, ?)", (client, tat))
+        return granted, retry_after
+    
+    def prune(self, now):
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM rate_limits WHERE tat <= ?", (now,))
+            
+    def clients(self):
+        return self.db.connect().execute("SELECT COUNT(*) FROM rate_limits").fetchone()[0]
+
+rate_limiter = SharedRateLimiter(state_db) if state_db else RateLimiter()
+
+# Global storage for download progress
+download_progress = ProgressStore(DownloadRecord, progress_backend('downloads', DownloadRecord), name='downloads')
+playlist_progress = ProgressStore(PlaylistRecord, progress_backend('playlists', PlaylistRecord), name='playlists')
+
 # Ensure download directory exists
 os.makedirs(CONFIG['DOWNLOAD_DIR'], exist_ok=True)
 
+app.config['USE_X_SENDFILE'] = CONFIG['SENDFILE_OFFLOAD'] == 'x-sendfile'
+
+def trust_proxies(hops):
+    """Take request.remote_addr from X-Forwarded-For as appended by `hops` proxies
+    
+    Behind a proxy every request comes from the proxy's address, so clients
+    would share one rate limit bucket. Entries left of the trusted hops are
+    ignored, since a client can send any X-Forwarded-For it likes.
+    """
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops)
+
+trust_proxies(CONFIG['TRUSTED_PROXY_HOPS'])
+
+# Bytes read per chunk when streaming playlist archives
+ZIP_CHUNK_SIZE = 1024 * 1024
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FLAGS = 0x08 | 0x800  # Sizes in data descriptors, UTF-8 names
+ZIP_CRC_CACHE_SIZE = 10000
+
+# FFmpeg arguments per output format; {quality} is AUDIO_QUALITY in kbps
+AUDIO_CODEC_ARGS = {
+    'mp3': ['-codec:a', 'libmp3lame', '-b:a', '{quality}k'],
+    'm4a': ['-codec:a', 'aac', '-b:a', '{quality}k'],
+    'wav': ['-codec:a', 'pcm_s16le'],
+}
+
+class PipelineStage:
+    """Worker pool for one track pipeline stage with queue depth and timing stats"""
+    
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.total_seconds = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        
+    def submit(self, func, *args):
+        """Queue func(*args) on this stage and return its future"""
+        with self._lock:
+            self.queued += 1
+        return self._executor.submit(self._run, func, args)
+    
+    def _run(self, func, args):
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+        started = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+                self.total_seconds += elapsed
+                
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queued': self.queued,
+                'active': self.active,
+                'completed': self.completed,
+                'avg_seconds': round(self.total_seconds / self.completed, 3) if self.completed else 0
+            }
+
+def platform_family(platform):
+    """Key of the fetch slots and bandwidth bucket a PLATFORM_SUPPORT entry shares"""
+    return platform.get('family') or platform['name']
+
+class PlatformStage(PipelineStage):
+    """Pipeline stage that also caps how many items of each platform run at once
+    
+    `platform_of(*args)` maps an item to its PLATFORM_SUPPORT entry, whose
+    optional max_concurrent is the limit of its platform family. Items wait
+    in one FIFO per family, and a free worker takes the oldest waiting item
+    whose family is under its limit, so a platform at its limit does not
+    hold up other platforms queued behind it. The executor is only handed
+    items that have a slot, so it never queues.
+    """
+    
+    def __init__(self, name, workers, platform_of):
+        super().__init__(name, workers)
+        self.platform_of = platform_of
+        self._waiting = OrderedDict()  # platform family -> deque of (seq, func, args, future)
+        self._running = {}  # platform family -> items running
+        self._limits = {}  # platform family -> max_concurrent (0 = no limit)
+        self._busy = 0
+        self._seq = 0
+        
+    def has_slot(self, platform):
+        """Whether the family of platform is under its limit, counting items waiting for it"""
+        limit = platform.get('max_concurrent') or 0
+        if not limit:
+            return True
+        name = platform_family(platform)
+        with self._lock:
+            return self._running.get(name, 0) + len(self._waiting.get(name, ())) < limit
+        
+    def submit(self, func, *args):
+        platform = self.platform_of(*args)
+        name = platform_family(platform)
+        future = Future()
+        with self._lock:
+            self.queued += 1
+            self._seq += 1
+            self._limits[name] = platform.get('max_concurrent') or 0
+            self._waiting.setdefault(name, deque()).append((self._seq, func, args, future))
+        self._dispatch()
+        return future
+    
+    def _next(self):
+        """Oldest waiting item whose platform has a free slot, as (name, item); None if there is none"""
+        if self._busy >= self.workers:
+            return None
+        best = None
+        for name, waiting in self._waiting.items():
+            limit = self._limits[name]
+            if limit and self._running.get(name, 0) >= limit:
+                continue
+            if best is None or waiting[0][0] < best[1][0][0]:
+                best = (name, waiting)
+        if best is None:
+            return None
+        name, waiting = best
+        item = waiting.popleft()
+        if not waiting:
+            del self._waiting[name]
+        return name, item
+    
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                picked = self._next()
+                if picked is None:
+                    return
+                name, (_, func, args, future) = picked
+                self._busy += 1
+                self._running[name] = self._running.get(name, 0) + 1
+            self._executor.submit(self._run_slot, name, func, args, future)
+            
+    def _run_slot(self, name, func, args, future):
+        error = result = None
+        try:
+            result = self._run(func, args)
+        except BaseException as e:
+            error = e
+        # Free the slot before the future's callbacks run, as they may submit more work
+        with self._lock:
+            self._busy -= 1
+            self._running[name] -= 1
+        self._dispatch()
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+            
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            names = set(self._running) | set(self._waiting)
+            stats['platforms'] = {
+                name: {
+                    'running': self._running.get(name, 0),
+                    'queued': len(self._waiting.get(name, ())),
+                    'limit': self._limits.get(name, 0)
+                } for name in sorted(names)
+            }
+        return stats
+
+class TokenBucket:
+    """Byte rate limit shared by concurrent downloads
+    
+    consume() is called with bytes already received and puts the calling
+    download thread to sleep until the bucket has paid off its debt, so the
+    combined rate of all callers converges on `rate` bytes per second with
+    bursts of up to one second's worth.
+    """
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.throttled_seconds = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        
+    def consume(self, amount):
+        """Take amount tokens, sleeping off any shortfall; returns the seconds slept"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self._updated) * self.rate) - amount
+            self._updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.throttled_seconds += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+# Platform family -> TokenBucket for platforms with a ratelimit, plus None for MAX_BANDWIDTH
+bandwidth_buckets = {}
+bandwidth_lock = threading.Lock()
+
+def platform_buckets(platform):
+    """Token buckets a fetch from platform (a PLATFORM_SUPPORT entry) draws from"""
+    limits = ((None, CONFIG['MAX_BANDWIDTH']), (platform_family(platform), platform.get('ratelimit')))
+    buckets = []
+    with bandwidth_lock:
+        for name, rate in limits:
+            if not rate:
+                continue
+            bucket = bandwidth_buckets.get(name)
+            if bucket is None or bucket.rate != rate:
+                bucket = bandwidth_buckets[name] = TokenBucket(rate)
+            buckets.append(bucket)
+    return tuple(buckets)
+
+# Track pipeline. Every single download and playlist track is fetched on the
+# download stage (network-bound, MAX_CONCURRENT_DOWNLOADS is a global limit,
+# max_concurrent in PLATFORM_SUPPORT a per-platform one) and then handed to the
+# transcode stage, whose workers each drive one FFmpeg process.
+download_stage = PlatformStage('download', CONFIG['MAX_CONCURRENT_DOWNLOADS'],
+                               lambda job: detect_platform(job.url))
+transcode_stage = PipelineStage('transcode', CONFIG['TRANSCODE_WORKERS'])
+
+class QueueFullError(Exception):
+    """Raised when the job queue cannot accept more work"""
+    
+    def __init__(self, retry_after):
+        super().__init__('Server is busy, please try again later')
+        self.retry_after = retry_after
+
+class RequeueJob(Exception):
+    """Raised by a job function to give its worker back and run again later
+    
+    The job is queued again with job_args, keeping its place ahead of jobs
+    submitted after it, but is not started before delay seconds are up.
+    """
+    
+    def __init__(self, delay, job_args):
+        super().__init__(f'Run again in {delay:.0f}s')
+        self.delay = delay
+        self.job_args = tuple(job_args)
+
+class JobQueue:
+    """Bounded FIFO of download jobs served by a fixed set of worker threads
+    
+    Workers take the oldest job that is due and for which `ready(func, args)`
+    holds; a job that is not ready keeps its place while later ones run.
+    """
+    
+    def __init__(self, workers, max_queued, ready=None):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ready = ready or (lambda func, args: True)
+        self.active = 0
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._threads = []
+        # Moving average of job run time, used to estimate Retry-After
+        self._avg_duration = 30.0
+        
+    def _ensure_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(
+                target=self._worker,
+                name=f'job-{len(self._threads)}',
+                daemon=True
+            )
+            self._threads.append(thread)
+            thread.start()
+            
+    def start(self):
+        with self._cond:
+            self._ensure_workers()
+            
+    def submit(self, job_id, func, *args):
+        """Queue a job, raising QueueFullError if the queue is at capacity"""
+        with self._cond:
+            if len(self._pending) >= self.max_queued:
+                raise QueueFullError(self.retry_after())
+            self._pending.append((job_id, func, args, 0))
+            self._ensure_workers()
+            self._cond.notify()
+            
+    def discard(self, job_id):
+        """Drop a waiting job, e.g. one left over from before a restart"""
+        with self._cond:
+            self._pending = deque(job for job in self._pending if job[0] != job_id)
+            
+    def position(self, job_id):
+        """1-based position of a waiting job, or None if it is not queued"""
+        with self._cond:
+            for position, (queued_id, *_) in enumerate(self._pending, 1):
+                if queued_id == job_id:
+                    return position
+        return None
+    
+    def retry_after(self):
+        """Rough number of seconds until a queue slot frees up"""
+        return max(1, int(self._avg_duration * (len(self._pending) + 1) / self.workers))
+    
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'active': self.active,
+                'queued': len(self._pending),
+                'max_queued': self.max_queued
+            }
+        
+    def _take(self):
+        """Remove and return the first pending job that may start now, or None"""
+        now = time.time()
+        for job in self._pending:
+            if job[3] <= now and self.ready(job[1], job[2]):
+                self._pending.remove(job)
+                return job[:3]
+        return None
+    
+    def _idle_timeout(self):
+        """Seconds an idle worker may sleep before a pending job may have become startable"""
+        if not self._pending:
+            return None
+        # Jobs that are due but not ready are polled for
+        due = min(job[3] for job in self._pending) - time.time()
+        return max(0, min(due, CONFIG['JOB_POLL_INTERVAL']))
+    
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._take()
+                while job is None:
+                    self._cond.wait(self._idle_timeout())
+                    job = self._take()
+            job_id, func, args = job
+            # Queue positions of the remaining jobs just changed, but no record
+            progress_notifier.publish(keys=())
+            requeue = self._run(job_id, func, args)
+            if requeue:
+                with self._cond:
+                    self._pending.appendleft((job_id, func) + requeue)
+                    self._cond.notify()
+            
+    def _run(self, job_id, func, args):
+        """Run a job; returns (args, not_before) if it asked to run again later"""
+        with self._cond:
+            self.active += 1
+        started = time.monotonic()
+        try:
+            func(*args)
+        except RequeueJob as e:
+            return e.job_args, time.time() + e.delay
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+        finally:
+            duration = time.monotonic() - started
+            with self._cond:
+                self.active -= 1
+                self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+
+class SharedJobQueue(JobQueue):
+    """JobQueue kept in the StateDB, so API nodes enqueue and worker nodes run
+    
+    Jobs are stored by the name of their entry point in JOB_FUNCTIONS with
+    JSON arguments. Workers are only started on nodes whose ROLE runs
+    downloads; they claim the oldest queued job that is due and delete it
+    when done, or queue it again if it raised RequeueJob.
+    
+    A claim is a lease of JOB_LEASE seconds that a heartbeat thread renews
+    while the job runs. When a node dies its leases run out, and the next
+    claim on any node queues those jobs again; a job that loses its lease
+    MAX_LOST_LEASES times is failed instead, so its progress ends.
+    """
+    
+    # Queued jobs a claim looks at for one that is ready
+    CLAIM_SCAN = 100
+    MAX_LOST_LEASES = 2
+    
+    def __init__(self, db, workers, max_queued, ready=None):
+        super().__init__(workers, max_queued, ready)
+        self.db = db
+        self._claimed = {}  # job id -> started_at of this node's claim, renewed by the heartbeat
+        self._heartbeat = None
+        
+    def _ensure_workers(self):
+        super()._ensure_workers()
+        if self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._renew_leases, name='job-heartbeat', daemon=True)
+            self._heartbeat.start()
+            
+    def _renew_leases(self):
+        while True:
+            time.sleep(CONFIG['JOB_LEASE'] / 3)
+            with self._cond:
+                claimed = list(self._claimed.items())
+            if not claimed:
+                continue
+            try:
+                with self.db.transaction() as conn:
+                    conn.executemany(
+                        "UPDATE jobs SET lease_until = ? WHERE id = ? AND started_at = ?",
+                        [(time.time() + CONFIG['JOB_LEASE'], job_id, started_at) for job_id, started_at in claimed]
+                    )
+            except sqlite3.Error as e:
+                logger.error(f"Could not renew job leases: {e}")
+        
+    def submit(self, job_id, func, *args):
+        if func.__name__ not in JOB_FUNCTIONS:
+            raise ValueError(f"{func.__name__} is not a registered job function")
+        with self.db.transaction() as conn:
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFullError(self._retry_after(queued))
+            conn.execute(
+                "INSERT INTO jobs (id, func, args, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, func.__name__, json.dumps(args), time.time())
+            )
+        with self._cond:
+            self._cond.notify()
+            
+    def discard(self, job_id):
+        """Drop a job, including one a stopped worker had claimed"""
+        with self.db.transaction() as conn:
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            
+    def position(self, job_id):
+        position = self.db.connect().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'queued' "
+            "AND seq <= (SELECT seq FROM jobs WHERE id = ? AND status = 'queued')",
+            (job_id,)
+        ).fetchone()[0]
+        return position or None
+    
+    def _counts(self):
+        rows = self.db.connect().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+        return dict(rows.fetchall())
+    
+    def _retry_after(self, queued):
+        return max(1, int(self._avg_duration * (queued + 1) / self.workers))
+    
+    def retry_after(self):
+        return self._retry_after(self._counts().get('queued', 0))
+    
+    def stats(self):
+        counts = self._counts()
+        with self._cond:
+            return {
+                'workers': len(self._threads),
+                'active': self.active,
+                'queued': counts.get('queued', 0),
+                'running': counts.get('running', 0),
+                'max_queued': self.max_queued
+            }
+        
+    def _claim(self):
+        """Take the oldest queued job that is due and ready; returns (job_id, func, args) or None"""
+        with self.db.transaction() as conn:
+            lost = self._take_back_expired(conn)
+            rows = conn.execute(
+                "SELECT seq, id, func, args FROM jobs WHERE status = 'queued' AND not_before <= ? "
+                "ORDER BY seq LIMIT ?",
+                (time.time(), self.CLAIM_SCAN)
+            )
+            for seq, job_id, name, args in rows:
+                func, args = JOB_FUNCTIONS[name], json.loads(args)
+                if self.ready(func, args):
+                    break
+            else:
+                job_id = None
+            if job_id is not None:
+                started_at = time.time()
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', node = ?, started_at = ?, lease_until = ? WHERE seq = ?",
+                    (NODE_ID, started_at, started_at + CONFIG['JOB_LEASE'], seq)
+                )
+                with self._cond:
+                    self._claimed[job_id] = started_at
+            # Queue positions of the remaining jobs just changed
+            version = self.db.next_version(conn) if job_id is not None or lost is not None else None
+        if version is not None:
+            progress_notifier.observe(version)
+        for lost_id, name in lost or ():
+            fail_lost_job(lost_id, name)
+        return (job_id, func, args) if job_id is not None else None
+    
+    def _take_back_expired(self, conn):
+        """Queue again the running jobs whose lease ran out
+        
+        Returns (job_id, func name) of the jobs that lost too many leases and
+        were dropped, or None if no lease had run out.
+        """
+        rows = conn.execute(
+            "SELECT id, func, node, lost_leases FROM jobs WHERE status = 'running' AND lease_until < ?",
+            (time.time(),)
+        ).fetchall()
+        if not rows:
+            return None
+        failed = []
+        for job_id, name, node, lost_leases in rows:
+            if lost_leases + 1 >= self.MAX_LOST_LEASES:
+                logger.error(f"Job {job_id} lost its worker on {node} again, failing it")
+                conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+                failed.append((job_id, name))
+            else:
+                logger.warning(f"Job {job_id} lost its worker on {node}, queueing it again")
+                conn.execute(
+                    "UPDATE jobs SET status = 'queued', node = NULL, started_at = NULL, lease_until = NULL, "
+                    "lost_leases = lost_leases + 1 WHERE id = ?",
+                    (job_id,)
+                )
+        return failed
+    
+    def _worker(self):
+        while True:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                logger.error(f"Could not claim a job: {e}")
+                job = None
+            if job is None:
+                with self._cond:
+                    self._cond.wait(CONFIG['JOB_POLL_INTERVAL'])
+                continue
+            
+            job_id, func, args = job
+            requeue = None
+            try:
+                requeue = self._run(job_id, func, args)
+            finally:
+                with self._cond:
+                    started_at = self._claimed.pop(job_id)
+                # A claim that lost its lease belongs to another node now, so it is left alone
+                with self.db.transaction() as conn:
+                    if requeue:
+                        conn.execute(
+                            "UPDATE jobs SET status = 'queued', node = NULL, started_at = NULL, lease_until = NULL, "
+                            "args = ?, not_before = ? WHERE id = ? AND started_at = ?",
+                            (json.dumps(requeue[0]), requeue[1], job_id, started_at)
+                        )
+                    else:
+                        conn.execute('DELETE FROM jobs WHERE id = ? AND started_at = ?', (job_id, started_at))
+
+def job_can_start(func, args):
+    """Whether a queued job may take a job worker now
+    
+    A single download of a platform family at its max_concurrent would only
+    hold a worker while it waits for a download slot, so it stays queued and
+    jobs for other platforms go first.
+    """
+    if func is run_single_download:
+        return download_stage.has_slot(detect_platform(args[0]))
+    return True
+
+if state_db:
+    job_queue = SharedJobQueue(state_db, CONFIG['MAX_ACTIVE_JOBS'], CONFIG['MAX_QUEUED_JOBS'], job_can_start)
+else:
+    job_queue = JobQueue(CONFIG['MAX_ACTIVE_JOBS'], CONFIG['MAX_QUEUED_JOBS'], job_can_start)
+
+class PlaylistJournal:
+    """Append-only log of running playlists, replayed to resume them after a restart
+    
+    A playlist appends 'started', then 'entries' pages as its tracks are
+    listed, then one 'track' event per finished track. Its rows are deleted
+    when the job ends, so anything still in the journal at startup was
+    interrupted.
+    """
+    
+    # Flat playlist entry fields needed to download a track again
+    ENTRY_KEYS = ('id', 'url', 'webpage_url', 'ie_key', 'title', 'uploader', 'channel')
+    
+    def __init__(self, db):
+        self.db = db
+        
+    def _append(self, job_id, event, data, track_index=None):
+        with self.db.transaction() as conn:
+            conn.execute(
+                'INSERT INTO journal (job_id, track_index, event, data, at) VALUES (?, ?, ?, ?, ?)',
+                (job_id, track_index, event, json.dumps(data), time.time())
+            )
+            
+    def start(self, playlist_id, url, media_id, options=None):
+        self._append(playlist_id, 'started', {
+            'url': url, 'media_id': media_id, 'options': options or {}, 'host': socket.gethostname()
+        })
+        
+    def record_entries(self, playlist_id, title, entries, offset=0, complete=True):
+        """Log a page of entries starting at index offset; complete marks the last page"""
+        self._append(playlist_id, 'entries', {
+            'title': title,
+            'offset': offset,
+            'complete': complete,
+            'entries': [
+                {key: entry.get(key) for key in self.ENTRY_KEYS if entry.get(key) is not None} if entry else None
+                for entry in entries
+            ]
+        })
+        
+    def record_track(self, playlist_id, track_index, file_path):
+        """Log a finished track; file_path is None if it failed"""
+        self._append(playlist_id, 'track', {'file_path': file_path}, track_index)
+        
+    def finish(self, playlist_id):
+        with self.db.transaction() as conn:
+            conn.execute('DELETE FROM journal WHERE job_id = ?', (playlist_id,))
+            
+    def replay(self, playlist_id):
+        """State of a journaled playlist, or None
+        
+        Returns a dict with url, media_id, options, title, entries (None until known),
+        entries_complete (False if the listing was interrupted) and tracks,
+        mapping track index to {'file_path': ...}.
+        """
+        state = None
+        rows = self.db.connect().execute(
+            'SELECT track_index, event, data FROM journal WHERE job_id = ? ORDER BY seq', (playlist_id,)
+        )
+        for track_index, event, data in rows.fetchall():
+            data = json.loads(data)
+            if event == 'started':
+                # A resumed run logs 'started' again on top of the earlier events
+                state = state or {'title': None, 'entries': None, 'entries_complete': False, 'tracks': {}}
+                state.update(url=data['url'], media_id=data['media_id'], options=data.get('options') or {})
+            elif state is None:
+                continue
+            elif event == 'entries':
+                state['title'] = data['title']
+                # A page at offset 0 starts a new listing
+                offset = data.get('offset', 0)
+                state['entries'] = (state['entries'] or [])[:offset] + data['entries']
+                state['entries_complete'] = data.get('complete', True)
+            elif event == 'track':
+                state['tracks'][track_index] = data
+        return state
+    
+    def interrupted(self):
+        """Ids of journaled playlists this host was running"""
+        rows = self.db.connect().execute(
+            "SELECT job_id, data FROM journal WHERE event = 'started' ORDER BY seq"
+        ).fetchall()
+        host = socket.gethostname()
+        interrupted = []
+        for job_id, data in rows:
+            if json.loads(data).get('host') == host and job_id not in interrupted:
+                interrupted.append(job_id)
+        return interrupted
+
+def open_playlist_journal():
+    """Journal in STATE_DB, else in JOURNAL_DB; None when journaling is disabled"""
+    if state_db:
+        return PlaylistJournal(state_db)
+    path = CONFIG['JOURNAL_DB']
+    if path is None:
+        path = os.path.join(CONFIG['DOWNLOAD_DIR'], '.state', 'journal.db')
+    if path:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return PlaylistJournal(StateDB(path))
+    return None
+
+# Opened by start_services(), so importing this module creates no files
+playlist_journal = None
+
+class PlaylistArchive:
+    """Entries each sync client has already received, for sync mode
+    
+    Like yt-dlp's download_archive, entries are keyed by extractor and id,
+    under a key naming the client's sync id and the playlist. A finished
+    track is only recorded as pending; it counts as synced once the client
+    fetched it through /download_file or a complete playlist ZIP, so a sync
+    whose results were never collected is downloaded again next time.
+    """
+    
+    def __init__(self, db):
+        self.db = db
+        
+    @staticmethod
+    def sync_key(sync_id, url):
+        """Archive key of one client's copy of a playlist"""
+        return f"{sync_id} {canonical_media_id(url)}"
+        
+    @staticmethod
+    def entry_key(entry):
+        """'<extractor> <id>' for a flat playlist entry, else its normalized URL"""
+        if entry.get('ie_key') and entry.get('id'):
+            return f"{entry['ie_key'].lower()} {entry['id']}"
+        return normalize_url(entry.get('url') or entry.get('webpage_url') or entry.get('id', ''))
+        
+    def has(self, sync_key, entry):
+        """Whether the client already received the entry"""
+        row = self.db.connect().execute(
+            'SELECT 1 FROM sync_archive WHERE playlist = ? AND entry = ? AND delivered = 1',
+            (sync_key, self.entry_key(entry))
+        ).fetchone()
+        return row is not None
+    
+    def add(self, sync_key, entry, job, track):
+        """Record a finished track as pending delivery by track download id and playlist job"""
+        with self.db.transaction() as conn:
+            conn.execute(
+                'INSERT INTO sync_archive (playlist, entry, job, track, at) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (playlist, entry) DO UPDATE SET job = excluded.job, track = excluded.track, '
+                'at = excluded.at WHERE delivered = 0',
+                (sync_key, self.entry_key(entry), job, track, time.time())
+            )
+            
+    def deliver(self, track=None, job=None):
+        """Mark the pending entries of a served track, or of a whole playlist job, as received"""
+        column, value = ('track', track) if track is not None else ('job', job)
+        conn = self.db.connect()
+        # Most served files belong to no sync run; only take the write lock when there is work
+        if conn.execute(f'SELECT 1 FROM sync_archive WHERE {column} = ? AND delivered = 0', (value,)).fetchone() is None:
+            return
+        with self.db.transaction() as conn:
+            conn.execute(f'UPDATE sync_archive SET delivered = 1 WHERE {column} = ? AND delivered = 0', (value,))
+            
+    def count(self, sync_key):
+        return self.db.connect().execute(
+            'SELECT COUNT(*) FROM sync_archive WHERE playlist = ? AND delivered = 1', (sync_key,)
+        ).fetchone()[0]
+
+# Kept next to the journal; sync mode is unavailable without one
+playlist_archive = None
+
+def open_journal():
+    """Open the playlist journal and the sync archive stored with it"""
+    global playlist_journal, playlist_archive
+    if playlist_journal is None:
+        playlist_journal = open_playlist_journal()
+        playlist_archive = PlaylistArchive(playlist_journal.db) if playlist_journal else None
+
 # Platform support configuration
 PLATFORM_SUPPORT = {
     'youtube.com': {
         'supported': True,
         'name': 'YouTube',
-        'notes': 'Fully supported'
+        'notes': 'Fully supported',
+        'playlist_pattern': r'[?&]list=|/playlist',  # Matched against path and query (absent = generic markers)
+        'family': 'youtube',  # Entries of one family share fetch slots and ratelimit (absent = name)
+        'max_concurrent': None,  # Fetches from this family at once (None = only MAX_CONCURRENT_DOWNLOADS)
+        'ratelimit': None  # Bytes/s across all of this family's fetches (None = unlimited)
     },
     'youtu.be': {
         'supported': True,
         'name': 'YouTube',
-        'notes': 'Fully supported'
+        'notes': 'Fully supported',
+        'playlist_pattern': r'[?&]list=|/playlist',
+        'family': 'youtube',
+        'max_concurrent': None,
+        'ratelimit': None
     },
     'music.youtube.com': {
         'supported': True,
         'name': 'YouTube Music',
-        'notes': 'May require sign-in for some content'
+        'notes': 'May require sign-in for some content',
+        'playlist_pattern': r'[?&]list=|/playlist',
+        'family': 'youtube',
+        'max_concurrent': None,
+        'ratelimit': None
     },
     'soundcloud.com': {
         'supported': True,
         'name': 'SoundCloud',
-        'notes': 'Fully supported for public tracks'
+        'notes': 'Fully supported for public tracks',
+        'playlist_pattern': r'/sets/',
+        'max_concurrent': None,
+        'ratelimit': None
     },
     'bandcamp.com': {
         'supported': True,
         'name': 'Bandcamp',
-        'notes': 'Supported for free tracks'
+        'notes': 'Supported for free tracks',
+        'playlist_pattern': r'/album/',
+        'max_concurrent': None,
+        'ratelimit': None
     },
     'vimeo.com': {
         'supported': True,
@@ -111,53 +1567,112 @@ PLATFORM_SUPPORT = {
     }
 }
 
+UNKNOWN_PLATFORM = {
+    'supported': True,
+    'name': 'Unknown Platform',
+    'notes': 'Platform not recognized, attempting download'
+}
+
+INVALID_PLATFORM = {
+    'supported': False,
+    'name': 'Invalid URL',
+    'notes': 'URL format is invalid'
+}
+
+# Basic URL validation; also captures the host and the rest of the URL so
+# classification needs no separate parse
+URL_PATTERN = re.compile(
+    r'^https?://'  # http:// or https://
+    r'(?P<host>(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+'  # domain...
+    r'(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # host...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
+    r'(?::\d+)?'  # optional port
+    r'(?P<rest>/?|[/?]\S+)$', re.IGNORECASE)
+
+# Playlist markers for platforms without a playlist_pattern of their own
+DEFAULT_PLAYLIST_PATTERN = r'playlist|album|list=|sets/|/artist/'
+
+URLClassification = namedtuple('URLClassification', 'well_formed platform is_playlist')
+
+class URLClassifier:
+    """Validates URLs and finds their PLATFORM_SUPPORT entry, with tables built once
+    
+    Domains live in a trie keyed by host labels from the right ('com' ->
+    'youtube' -> 'music'). A host maps to the entry of its longest registered
+    suffix that ends on a label boundary, so music.youtube.com finds YouTube
+    Music, m.youtube.com finds YouTube and notyoutube.com finds nothing.
+    Each platform's playlist_pattern is compiled up front, and results for
+    recently seen URLs are kept in an LRU.
+    """
+    
+    def __init__(self, platforms, cache_size):
+        self._domains = {}  # label -> [entry or None, child labels]
+        default = re.compile(DEFAULT_PLAYLIST_PATTERN, re.IGNORECASE)
+        self._playlist_patterns = {}  # platform name -> compiled pattern
+        for domain, info in platforms.items():
+            children = self._domains
+            node = None
+            for label in reversed(domain.split('.')):
+                node = children.setdefault(label, [None, {}])
+                children = node[1]
+            node[0] = info
+            pattern = info.get('playlist_pattern')
+            self._playlist_patterns[info['name']] = re.compile(pattern, re.IGNORECASE) if pattern else default
+        self._default_playlist_pattern = default
+        self.classify = lru_cache(maxsize=cache_size)(self._classify)
+        
+    def platform_for_host(self, host):
+        """Entry of the longest registered suffix of host, or None"""
+        found = None
+        children = self._domains
+        for label in reversed(host.split('.')):
+            node = children.get(label)
+            if node is None:
+                break
+            if node[0] is not None:
+                found = node[0]
+            children = node[1]
+        return found
+    
+    def _classify(self, url):
+        """URLClassification for url; classify() is the cached version"""
+        match = URL_PATTERN.match(url)
+        if match:
+            host, rest = match.group('host', 'rest')
+        else:
+            # Malformed URLs still get a platform, for error messages
+            try:
+                parsed = urlparse(url)
+                host, rest = parsed.hostname or '', f"{parsed.path}?{parsed.query}"
+            except ValueError:
+                return URLClassification(False, INVALID_PLATFORM, False)
+        platform = self.platform_for_host(host.lower().rstrip('.')) or UNKNOWN_PLATFORM
+        pattern = self._playlist_patterns.get(platform['name'], self._default_playlist_pattern)
+        return URLClassification(match is not None, platform, pattern.search(rest) is not None)
+    
+    def stats(self):
+        info = self.classify.cache_info()
+        return {'hits': info.hits, 'misses': info.misses, 'entries': info.currsize}
+
+url_classifier = URLClassifier(PLATFORM_SUPPORT, CONFIG['URL_CACHE_SIZE'])
+
 def detect_platform(url):
     """Detect the platform from URL and return support information"""
-    try:
-        parsed = urlparse(url.lower())
-        domain = parsed.netloc.replace('www.', '')
-        
-        # Check exact domain match
-        if domain in PLATFORM_SUPPORT:
-            return PLATFORM_SUPPORT[domain]
-        
-        # Check subdomain matches
-        for platform_domain, info in PLATFORM_SUPPORT.items():
-            if domain.endswith(platform_domain):
-                return info
-        
-        # Unknown platform - assume it might work
-        return {
-            'supported': True,
-            'name': 'Unknown Platform',
-            'notes': 'Platform not recognized, attempting download'
-        }
-    except Exception:
-        return {
-            'supported': False,
-            'name': 'Invalid URL',
-            'notes': 'URL format is invalid'
-        }
+    if not isinstance(url, str):
+        return INVALID_PLATFORM
+    return url_classifier.classify(url).platform
 
 def validate_url(url):
     """Validate URL and check platform support"""
     if not url or not isinstance(url, str):
         return False, "Invalid URL format"
     
-    # Basic URL validation
-    url_pattern = re.compile(
-        r'^https?://'  # http:// or https://
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+'  # domain...
-        r'(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # host...
-        r'localhost|'  # localhost...
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
-        r'(?::\d+)?'  # optional port
-        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-    
-    if not url_pattern.match(url):
+    classification = url_classifier.classify(url)
+    if not classification.well_formed:
         return False, "Invalid URL format"
     
-    platform_info = detect_platform(url)
+    platform_info = classification.platform
     
     if not platform_info['supported']:
         error_msg = f"{platform_info['name']} is not supported. {platform_info['notes']}"
@@ -167,70 +1682,118 @@ def validate_url(url):
     
     return True, platform_info['notes']
 
+def set_track_progress(playlist_id, track_index, track_data):
+    """Record the state of one playlist track"""
+    with progress_lock:
+        record = playlist_progress.setdefault(playlist_id, {'tracks': {}})
+        if record.tracks is None:
+            record.tracks = {}
+        record.tracks[track_index] = track_data
+        playlist_progress.touch(playlist_id, record)
+
 class DownloadProgressHook:
-    def __init__(self, download_id, playlist_id=None, track_index=None):
+    """yt-dlp progress hook that updates the job's progress record in place
+    
+    yt-dlp calls this for every received chunk. Updates are coalesced: the
+    record is only written when PROGRESS_HOOK_INTERVAL seconds have passed or
+    the percentage moved by PROGRESS_HOOK_MIN_DELTA, and no dicts are built
+    per call.
+    """
+    
+    __slots__ = ('download_id', 'playlist_id', 'track_index', 'track', 'last_emit', 'last_percent',
+                 'buckets', 'last_bytes')
+    
+    def __init__(self, download_id, playlist_id=None, track_index=None, buckets=()):
         self.download_id = download_id
         self.playlist_id = playlist_id
         self.track_index = track_index
-        
+        self.last_emit = 0.0
+        self.last_percent = -100.0
+        # Token buckets to charge received bytes to; sleeping here throttles the download
+        self.buckets = buckets
+        self.last_bytes = None
+        # Per-track entry in the playlist record, created once and updated in place
+        self.track = None
+        if playlist_id and track_index is not None:
+            self.track = {'status': 'downloading', 'percentage': 0, 'title': None}
+            
     def __call__(self, d):
         try:
-            if d['status'] == 'downloading':
-                if 'total_bytes' in d and d['total_bytes']:
-                    percent = (d['downloaded_bytes'] / d['total_bytes']) * 100
-                elif 'total_bytes_estimate' in d and d['total_bytes_estimate']:
-                    percent = (d['downloaded_bytes'] / d['total_bytes_estimate']) * 100
-                else:
-                    percent = 0
+            status = d['status']
+            if status == 'downloading':
+                downloaded = d.get('downloaded_bytes') or 0
+                if self.buckets:
+                    self._throttle(downloaded)
+                total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+                percent = min(downloaded / total * 100, 100) if total else 0
                 
-                speed = d.get('speed', 0) or 0
-                eta = d.get('eta', 0) or 0
+                now = time.monotonic()
+                if (now - self.last_emit < CONFIG['PROGRESS_HOOK_INTERVAL']
+                        and abs(percent - self.last_percent) < CONFIG['PROGRESS_HOOK_MIN_DELTA']):
+                    return
+                self.last_emit = now
+                self.last_percent = percent
                 
-                progress_data = {
-                    'status': 'downloading',
-                    'percentage': min(percent, 100),
-                    'speed': speed,
-                    'eta': eta,
-                    'downloaded_bytes': d.get('downloaded_bytes', 0),
-                    'total_bytes': d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-                }
-                
-                download_progress[self.download_id] = progress_data
+                record = self._record()
+                record.status = 'downloading'
+                record.percentage = percent
+                record.speed = d.get('speed') or 0
+                record.eta = d.get('eta') or 0
+                record.downloaded_bytes = downloaded
+                record.total_bytes = total
+                download_progress.touch(self.download_id, record)
                 
                 # Update playlist progress if this is part of a playlist
-                if self.playlist_id and self.track_index is not None:
-                    if self.playlist_id not in playlist_progress:
-                        playlist_progress[self.playlist_id] = {'tracks': {}}
+                if self.track is not None:
+                    self._update_track(d, 'downloading', percent)
                     
-                    playlist_progress[self.playlist_id]['tracks'][self.track_index] = {
-                        'status': 'downloading',
-                        'percentage': percent,
-                        'title': d.get('info_dict', {}).get('title', f'Track {self.track_index + 1}')
-                    }
-                    
-            elif d['status'] == 'finished':
+            elif status == 'finished':
                 download_progress[self.download_id] = {
                     'status': 'processing',
                     'percentage': 100,
-                    'message': 'Converting to MP3...'
+                    'message': 'Download finished, waiting for conversion...'
                 }
                 
-                if self.playlist_id and self.track_index is not None:
-                    if self.playlist_id not in playlist_progress:
-                        playlist_progress[self.playlist_id] = {'tracks': {}}
-                    
-                    playlist_progress[self.playlist_id]['tracks'][self.track_index] = {
-                        'status': 'completed',
-                        'percentage': 100,
-                        'title': d.get('info_dict', {}).get('title', f'Track {self.track_index + 1}')
-                    }
+                if self.track is not None:
+                    self._update_track(d, 'processing', 100)
                     
         except Exception as e:
             logger.error(f"Progress hook error: {e}")
+            
+    def _throttle(self, downloaded):
+        # The first report of a resumed download counts bytes from earlier attempts
+        received = downloaded - self.last_bytes if self.last_bytes is not None else 0
+        self.last_bytes = downloaded
+        if received > 0:
+            for bucket in self.buckets:
+                bucket.consume(received)
+                
+    def _record(self):
+        record = download_progress.get(self.download_id)
+        if record is None:
+            record = download_progress.setdefault(self.download_id, {})
+        return record
+    
+    def _update_track(self, d, status, percent):
+        track = self.track
+        first_update = track['title'] is None
+        if first_update:
+            track['title'] = (d.get('info_dict') or {}).get('title') or f'Track {self.track_index + 1}'
+        track['status'] = status
+        track['percentage'] = percent
+        if first_update or state_db:
+            # Shared backends hold a copy of the track entry, so write it through
+            set_track_progress(self.playlist_id, self.track_index, track)
+        else:
+            playlist_progress.touch(self.playlist_id)
 
-def get_ydl_opts(output_path, progress_hook):
-    """Get enhanced yt-dlp options for better platform support"""
-    return {
+def get_ydl_opts(output_path, progress_hook, transcode=True):
+    """Get enhanced yt-dlp options for better platform support
+    
+    With transcode=False the FFmpeg postprocessor is left out and yt-dlp only
+    downloads the source audio.
+    """
+    opts = {
         'format': 'bestaudio[ext=m4a]/bestaudio[ext=mp3]/bestaudio/best[height<=720]',
         'outtmpl': os.path.join(output_path, '%(title)s.%(ext)s'),
         'postprocessors': [{
@@ -269,14 +1832,116 @@ def get_ydl_opts(output_path, progress_hook):
         # Age limit bypass
         'age_limit': None
     }
+    if not transcode:
+        del opts['postprocessors']
+    return opts
+
+class ProgressHookSlot:
+    """Progress hook of a pooled YoutubeDL, forwarding to the hook of the fetch using it"""
+    
+    __slots__ = ('hook',)
+    
+    def __init__(self):
+        self.hook = None
+        
+    def __call__(self, d):
+        hook = self.hook
+        if hook is not None:
+            hook(d)
+
+class YoutubeDLPool:
+    """Warm YoutubeDL instances reused by this process's fetches
+    
+    Building a YoutubeDL loads the extractors and a new request director, so
+    one per track pays that startup every time and drops keep-alive
+    connections and cookies between tracks. Pooled instances serve one fetch
+    at a time: the output directory, rate limit and progress hook are set on
+    checkout and cleared on return. An instance is closed after `max_uses`
+    fetches, and at most `size` are kept idle.
+    """
+    
+    def __init__(self, size, max_uses, factory=None):
+        self.size = size
+        self.max_uses = max_uses
+        # Builds an instance from options; yt_dlp.YoutubeDL when None
+        self.factory = factory
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.retired = 0
+        
+    def _create(self):
+        slot = ProgressHookSlot()
+        options = get_ydl_opts('', slot, transcode=False)
+        options['continuedl'] = True
+        # A fetch is one track: let its error propagate so classify_track_error sees the real cause
+        options['ignoreerrors'] = False
+        stack = ExitStack()
+        ydl = stack.enter_context((self.factory or yt_dlp.YoutubeDL)(options))
+        with self._lock:
+            self.created += 1
+        return {'ydl': ydl, 'stack': stack, 'slot': slot, 'uses': 0}
+    
+    def _retire(self, instance):
+        with self._lock:
+            self.retired += 1
+        try:
+            instance['stack'].close()
+        except Exception as e:
+            logger.error(f"Failed to close YoutubeDL instance: {e}")
+            
+    def warm(self):
+        """Build the idle instances ahead of the first fetch"""
+        while True:
+            with self._lock:
+                if len(self._idle) >= self.size:
+                    return
+            instance = self._create()
+            with self._lock:
+                self._idle.append(instance)
+                
+    @contextmanager
+    def session(self, output_dir, progress_hook, ratelimit=None):
+        """Check out an instance that downloads into output_dir"""
+        with self._lock:
+            instance = self._idle.popleft() if self._idle else None
+            if instance is not None:
+                self.reused += 1
+        if instance is None:
+            instance = self._create()
+        
+        ydl = instance['ydl']
+        ydl.params['paths'] = {'home': output_dir}
+        ydl.params['ratelimit'] = ratelimit
+        instance['slot'].hook = progress_hook
+        instance['uses'] += 1
+        try:
+            yield ydl
+        finally:
+            instance['slot'].hook = None
+            ydl.params['paths'] = {}
+            with self._lock:
+                keep = instance['uses'] < self.max_uses and len(self._idle) < self.size
+                if keep:
+                    self._idle.append(instance)
+            if not keep:
+                self._retire(instance)
+                
+    def stats(self):
+        with self._lock:
+            return {
+                'idle': len(self._idle),
+                'created': self.created,
+                'reused': self.reused,
+                'retired': self.retired
+            }
+
+ydl_pool = YoutubeDLPool(CONFIG['YDL_POOL_SIZE'] or download_stage.workers, CONFIG['YDL_POOL_MAX_USES'])
 
 def is_playlist_url(url):
     """Check if URL is a playlist"""
-    playlist_indicators = [
-        'playlist', 'album', 'list=', 'sets/',
-        '/playlist/', '/album/', '/artist/'
-    ]
-    return any(indicator in url.lower() for indicator in playlist_indicators)
+    return url_classifier.classify(url).is_playlist
 
 def add_metadata(file_path, title=None, artist=None, album=None):
     """Add metadata to MP3 file"""
@@ -298,118 +1963,1695 @@ def add_metadata(file_path, title=None, artist=None, album=None):
     except Exception as e:
         logger.error(f"Failed to add metadata to {file_path}: {e}")
 
+class ResultCache:
+    """Size-bounded LRU cache of finished audio files, kept under DOWNLOAD_DIR
+    
+    Entries are keyed by source media and output format. Hits are served by
+    hard-linking the cached file into place, so they cost no extra disk space.
+    """
+    
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (path, size, metadata)
+        self._size = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        
+    @staticmethod
+    def make_key(extractor, media_id):
+        raw = f"{extractor}:{media_id}:{CONFIG['AUDIO_FORMAT']}:{CONFIG['AUDIO_QUALITY']}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def _scan(self):
+        """(last used, key, path, size, metadata) of the entries on disk, least recently used first"""
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    metadata = json.load(f)
+                path = os.path.join(self.directory, f"{key}.{metadata['ext']}")
+                stat = os.stat(path)
+            except (OSError, ValueError, KeyError):
+                continue
+            found.append((stat.st_atime, key, path, stat.st_size, metadata))
+        return sorted(found)
+    
+    def _load(self):
+        """Rebuild the index from disk"""
+        for _, key, path, size, metadata in self._scan():
+            self._entries[key] = (path, size, metadata)
+            self._size += size
+            
+    def _use(self, key):
+        """(path, size, metadata) of an entry, marking it most recently used; None if missing"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+        
+    def _add(self, key, path, size, metadata):
+        """Index an entry; returns the (key, path) of the entries evicted to stay in budget"""
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._size -= old[1]
+            self._entries[key] = (path, size, metadata)
+            self._size += size
+            evicted = []
+            while self._size > self.max_bytes and self._entries:
+                old_key, (old_path, old_size, _) = self._entries.popitem(last=False)
+                self._size -= old_size
+                evicted.append((old_key, old_path))
+            return evicted
+        
+    def _totals(self):
+        """(entries, bytes) in the index"""
+        with self._lock:
+            return len(self._entries), self._size
+            
+    def lookup(self, key, dest_path):
+        """Place the cached file for `key` at dest_path; returns its metadata or None"""
+        entry = self._use(key)
+        with self._lock:
+            if entry is None or not os.path.exists(entry[0]):
+                self.misses += 1
+                return None
+            self.hits += 1
+        
+        path, _, metadata = entry
+        link_or_copy(path, dest_path)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return metadata
+    
+    def store(self, key, src_path, metadata):
+        """Add a finished file to the cache and evict old entries over budget"""
+        ext = os.path.splitext(src_path)[1].lstrip('.')
+        path = os.path.join(self.directory, f"{key}.{ext}")
+        metadata = dict(metadata, ext=ext)
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            link_or_copy(src_path, path)
+            with open(os.path.join(self.directory, f"{key}.json"), 'w') as f:
+                json.dump(metadata, f)
+            size = os.path.getsize(path)
+        except OSError as e:
+            logger.error(f"Failed to cache {src_path}: {e}")
+            return
+        
+        evicted = self._add(key, path, size, metadata)
+        with self._lock:
+            self.evictions += len(evicted)
+        for old_key, old_path in evicted:
+            for stale in (old_path, os.path.join(self.directory, f"{old_key}.json")):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+                
+    def stats(self):
+        entries, size = self._totals()
+        with self._lock:
+            return {
+                'entries': entries,
+                'bytes': size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+class SharedResultCache(ResultCache):
+    """ResultCache indexed in STATE_DB, for nodes sharing DOWNLOAD_DIR
+    
+    Every node sees the entries the others stored, and they share one LRU
+    order and one CACHE_MAX_BYTES budget.
+    """
+    
+    def __init__(self, directory, max_bytes, db):
+        self.db = db
+        super().__init__(directory, max_bytes)
+        
+    def _load(self):
+        """Index entries found on disk that the shared index does not know yet"""
+        with self.db.transaction() as conn:
+            for used_at, key, path, size, metadata in self._scan():
+                conn.execute(
+                    'INSERT OR IGNORE INTO result_cache (key, path, size, metadata, used_at) VALUES (?, ?, ?, ?, ?)',
+                    (key, path, size, json.dumps(metadata), used_at)
+                )
+                
+    def _use(self, key):
+        with self.db.transaction() as conn:
+            row = conn.execute('SELECT path, size, metadata FROM result_cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE result_cache SET used_at = ? WHERE key = ?', (time.time(), key))
+        return row[0], row[1], json.loads(row[2])
+    
+    def _add(self, key, path, size, metadata):
+        with self.db.transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO result_cache (key, path, size, metadata, used_at) VALUES (?, ?, ?, ?, ?)',
+                (key, path, size, json.dumps(metadata), time.time())
+            )
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM result_cache').fetchone()[0]
+            evicted = []
+            if total > self.max_bytes:
+                for old_key, old_path, old_size in conn.execute(
+                        'SELECT key, path, size FROM result_cache ORDER BY used_at').fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    total -= old_size
+                    evicted.append((old_key, old_path))
+                conn.executemany('DELETE FROM result_cache WHERE key = ?', [(old_key,) for old_key, _ in evicted])
+            return evicted
+        
+    def _totals(self):
+        return tuple(self.db.connect().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM result_cache'
+        ).fetchone())
+
+def link_or_copy(src_path, dest_path):
+    """Hard-link src_path to dest_path, copying when linking is not possible"""
+    try:
+        os.link(src_path, dest_path)
+    except OSError:
+        shutil.copy2(src_path, dest_path)
+
+@lru_cache(maxsize=4096)
+def media_key(url):
+    """(extractor, media id) for a URL without network access, or None if unknown"""
+    for extractor in get_extractor_classes():
+        if extractor.ie_key() == 'Generic' or not extractor.suitable(url):
+            continue
+        media_id = extractor.get_temp_id(url)
+        return extractor.ie_key(), media_id or normalize_url(url)
+    return None
+
+def normalize_url(url):
+    """Host, path and sorted query of a URL, ignoring scheme, www. and fragments"""
+    parsed = urlparse(url)
+    query = '&'.join(sorted(filter(None, parsed.query.split('&'))))
+    host = parsed.netloc.lower()
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    normalized = f"{host}{parsed.path.rstrip('/')}"
+    return f"{normalized}?{query}" if query else normalized
+
+def canonical_media_id(url):
+    """Identifier shared by every URL that points at the same media"""
+    key = media_key(url)
+    if key:
+        return f"{key[0]}:{key[1]}"
+    return f"{detect_platform(url)['name']}:{normalize_url(url)}"
+
+@lru_cache(maxsize=1)
+def get_extractor_classes():
+    return list(gen_extractor_classes())
+
+def warm_extractors():
+    """Import every extractor and compile its URL pattern ahead of the first media_key()
+    
+    Both happen lazily in yt-dlp, and a URL no extractor claims walks all of
+    them, which costs the first request several hundred milliseconds.
+    """
+    started = time.time()
+    extractors = get_extractor_classes()
+    for extractor in extractors:
+        extractor.suitable('')
+    logger.info(f"Prepared {len(extractors)} extractors in {time.time() - started:.2f}s")
+
+def track_cache_key(job):
+    """Result cache key for a track, or None if it cannot be cached"""
+    if job.ie_key and job.media_id:
+        return ResultCache.make_key(job.ie_key, job.media_id)
+    key = media_key(job.url)
+    return ResultCache.make_key(*key) if key else None
+
+if state_db:
+    result_cache = SharedResultCache(os.path.join(CONFIG['DOWNLOAD_DIR'], '.cache'), CONFIG['CACHE_MAX_BYTES'], state_db)
+else:
+    result_cache = ResultCache(os.path.join(CONFIG['DOWNLOAD_DIR'], '.cache'), CONFIG['CACHE_MAX_BYTES'])
+
+class PartialDownloads:
+    """Per-media directories that keep yt-dlp's .part files between attempts
+    
+    A failed download leaves its directory behind, and the next attempt at the
+    same media downloads into it again so yt-dlp continues from the .part file
+    instead of starting over. A directory is held by one attempt at a time: a
+    lock file guards it across processes (where flock is available) and a set
+    of held paths within this one. The janitor removes directories nobody
+    has come back to within PARTIAL_TTL.
+    """
+    
+    LOCK_NAME = '.lock'
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.resumed = 0
+        self._held = {}  # path -> open lock file
+        self._lock = threading.Lock()
+        
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+    
+    def acquire(self, key):
+        """Hold the directory for key; returns its path, or None if another attempt holds it"""
+        path = self.path(key)
+        with self._lock:
+            if path in self._held:
+                return None
+            self._held[path] = None
+        try:
+            os.makedirs(path, exist_ok=True)
+            lock_file = self._lock_file(path)
+        except OSError as e:
+            logger.error(f"Failed to open partial download directory: {e}")
+            lock_file = None
+        with self._lock:
+            if lock_file is None:
+                del self._held[path]
+                return None
+            self._held[path] = lock_file
+        
+        os.utime(path, None)
+        if any(name.endswith('.part') for name in os.listdir(path)):
+            with self._lock:
+                self.resumed += 1
+            logger.info(f"Resuming partial download of {key}")
+        return path
+    
+    def _lock_file(self, path):
+        """Open and lock path's lock file; None if another process holds it"""
+        lock_file = open(os.path.join(path, self.LOCK_NAME), 'a')
+        if fcntl:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return None
+        return lock_file
+    
+    def release(self, path, keep):
+        """Give up a held directory, keeping its contents for a later attempt or deleting them"""
+        with self._lock:
+            lock_file = self._held.pop(path, None)
+        try:
+            if keep:
+                os.utime(path, None)
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+        finally:
+            if lock_file:
+                lock_file.close()
+                
+    def remove(self, path):
+        """Janitor handler: delete an abandoned directory unless an attempt holds it"""
+        with self._lock:
+            if path in self._held or not os.path.isdir(path):
+                return
+            self._held[path] = None
+        try:
+            lock_file = self._lock_file(path)
+            if lock_file:
+                shutil.rmtree(path, ignore_errors=True)
+                lock_file.close()
+                logger.info(f"Cleaned up partial download: {path}")
+        finally:
+            with self._lock:
+                self._held.pop(path, None)
+                
+    def existing(self):
+        """(path, mtime) of every directory on disk"""
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return []
+        return [(entry.path, entry.stat().st_mtime) for entry in entries if entry.is_dir()]
+    
+    def stats(self):
+        found = self.existing()
+        with self._lock:
+            return {'entries': len(found), 'held': len(self._held), 'resumed': self.resumed}
+
+partial_downloads = PartialDownloads(CONFIG['PARTIAL_DIR'])
+
+def partial_key(job):
+    """Identifies the media a job downloads, so retries find the same partial directory"""
+    if job.ie_key and job.media_id:
+        return f"{job.ie_key}:{job.media_id}"
+    key = media_key(job.url)
+    return f"{key[0]}:{key[1]}" if key else normalize_url(job.url)
+
+class TrackJob:
+    """State of one track as it moves through the pipeline stages"""
+    
+    def __init__(self, url, download_id, playlist_id=None, track_index=None, entry=None):
+        self.url = url
+        self.download_id = download_id
+        self.playlist_id = playlist_id
+        self.track_index = track_index
+        self.temp_dir = None
+        self.partial_dir = None
+        self.source_path = None
+        # Flat playlist entries already carry the extractor and basic metadata
+        entry = entry or {}
+        self.ie_key = entry.get('ie_key')
+        self.media_id = entry.get('id')
+        self.cache_key = None
+        self.title = entry.get('title')
+        self.artist = entry.get('uploader') or entry.get('channel')
+        self.stage_timings = {}
+        self.attempts = 0  # Retries of the fetch so far
+        self.deferred = 0.0  # Seconds spent waiting on an open breaker
+
+def transcode_audio(source_path, output_dir):
+    """Convert a downloaded audio file to AUDIO_FORMAT with FFmpeg"""
+    audio_format = CONFIG['AUDIO_FORMAT']
+    base_name = os.path.splitext(os.path.basename(source_path))[0]
+    output_path = os.path.join(output_dir, f"{base_name}.{audio_format}")
+    if output_path == source_path:
+        output_path = os.path.join(output_dir, f"{base_name}.converted.{audio_format}")
+    
+    codec_args = AUDIO_CODEC_ARGS.get(audio_format, AUDIO_CODEC_ARGS['mp3'])
+    if source_path.lower().endswith(f'.{audio_format}'):
+        # Already in the target format, only strip video streams
+        codec_args = ['-codec:a', 'copy']
+    
+    command = [
+        CONFIG['FFMPEG_PATH'], '-y', '-loglevel', 'error',
+        '-i', source_path, '-vn',
+        *[arg.format(quality=CONFIG['AUDIO_QUALITY']) for arg in codec_args],
+        output_path
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, timeout=CONFIG['FFMPEG_TIMEOUT'])
+    except subprocess.TimeoutExpired:
+        # subprocess.run has killed FFmpeg; drop what it wrote so far
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise Exception(f"Audio conversion timed out after {CONFIG['FFMPEG_TIMEOUT']} seconds")
+    if result.returncode != 0:
+        raise Exception(f"Audio conversion failed: {result.stderr.strip()[-300:]}")
+    
+    return output_path
+
+# Extractor round trips, to check that each track is resolved exactly once
+extraction_stats = {'tracks': 0, 'resolves': 0}
+extraction_lock = threading.Lock()
+
+def count_resolve():
+    with extraction_lock:
+        extraction_stats['resolves'] += 1
+
+def complete_track(job, final_path):
+    """Record a finished track in the progress store"""
+    download_progress[job.download_id] = {
+        'status': 'completed',
+        'percentage': 100,
+        'file_path': final_path,
+        'filename': os.path.basename(final_path),
+        'title': job.title,
+        'artist': job.artist,
+        'stage_timings': {name: round(seconds, 3) for name, seconds in job.stage_timings.items()},
+        'playlist_id': job.playlist_id,
+        'message': 'Download completed!'
+    }
+    # Playlist tracks expire with their playlist (see expire_playlist), which may outlive the TTL
+    if not job.playlist_id:
+        expire_download(job.download_id, final_path, CONFIG['UNCLAIMED_FILE_TTL'])
+    
+    if job.playlist_id and job.track_index is not None:
+        set_track_progress(job.playlist_id, job.track_index, {
+            'status': 'completed',
+            'percentage': 100,
+            'title': job.title
+        })
+
+def fetch_cached_track(job):
+    """Complete a track from the result cache; returns the final path or None"""
+    if CONFIG['CACHE_MAX_BYTES'] <= 0:
+        return None
+    job.cache_key = track_cache_key(job)
+    if not job.cache_key:
+        return None
+    
+    staging_path = os.path.join(CONFIG['DOWNLOAD_DIR'], f"{job.download_id}.caching")
+    metadata = result_cache.lookup(job.cache_key, staging_path)
+    if metadata is None:
+        return None
+    
+    job.title = metadata.get('title')
+    job.artist = metadata.get('artist')
+    final_path = os.path.join(CONFIG['DOWNLOAD_DIR'], f"{job.download_id}_{metadata['filename']}")
+    os.replace(staging_path, final_path)
+    job.stage_timings['cache'] = 0
+    complete_track(job, final_path)
+    logger.info(f"Served from cache: {job.title}")
+    return final_path
+
+def fetch_track(job):
+    """Pipeline stage 1: resolve and download the source audio (network-bound)
+    
+    Returns the final path if the track was served from the result cache,
+    otherwise None and the transcode stage takes over.
+    """
+    cached_path = fetch_cached_track(job)
+    if cached_path:
+        return cached_path
+    
+    breaker = platform_breaker(job.url)
+    retry_after = breaker.retry_after()
+    if retry_after:
+        raise HostDeferred(breaker.name, retry_after)
+    
+    job.temp_dir = tempfile.mkdtemp(prefix='mp3dl_')
+    # The source goes to the media's partial directory when resuming is on and
+    # no other attempt holds it; the transcoded file always goes to temp_dir
+    if CONFIG['PARTIAL_TTL'] > 0:
+        job.partial_dir = partial_downloads.acquire(partial_key(job))
+    source_dir = job.partial_dir or job.temp_dir
+    
+    # Initialize progress
+    download_progress[job.download_id] = {
+        'status': 'starting',
+        'percentage': 0,
+        'message': 'Initializing download...'
+    }
+    
+    # Create progress hook
+    platform = detect_platform(job.url)
+    progress_hook = DownloadProgressHook(job.download_id, job.playlist_id, job.track_index,
+                                         platform_buckets(platform))
+    
+    # Pooled instances download the raw audio only, since conversion happens in
+    # the transcode stage. yt-dlp paces a single download with ratelimit; the
+    # buckets cap all of the platform's downloads together
+    started = time.monotonic()
+    
+    with ydl_pool.session(source_dir, progress_hook, platform.get('ratelimit')) as ydl:
+        download_progress.update(job.download_id, {
+            'status': 'extracting',
+            'message': f'Downloading: {job.title}' if job.title else 'Extracting track information...'
+        })
+        
+        # Resolve and download in one pass so the page and formats are only
+        # fetched once; a known ie_key also skips matching against every extractor
+        count_resolve()
+        info = ydl.extract_info(job.url, download=True, ie_key=job.ie_key)
+        if not info:
+            raise Exception("Failed to extract video information")
+            
+        job.title = info.get('title') or job.title or 'Unknown Title'
+        job.artist = info.get('uploader', info.get('artist')) or job.artist or 'Unknown Artist'
+    breaker.record_success()
+    
+    # Find the downloaded file
+    downloaded_files = [
+        f for f in os.listdir(source_dir)
+        if not f.endswith(('.part', '.ytdl')) and f != PartialDownloads.LOCK_NAME
+    ]
+    
+    if not downloaded_files:
+        raise Exception("No audio file found after download")
+    
+    job.source_path = os.path.join(source_dir, downloaded_files[0])
+    job.stage_timings['download'] = time.monotonic() - started
+    
+    download_progress[job.download_id] = {
+        'status': 'processing',
+        'percentage': 100,
+        'stage': 'transcode',
+        'message': 'Waiting for converter...'
+    }
+    return None
+
+def finish_track(job):
+    """Pipeline stage 2: transcode, tag and move into DOWNLOAD_DIR (CPU-bound)"""
+    download_progress[job.download_id] = {
+        'status': 'processing',
+        'percentage': 100,
+        'stage': 'transcode',
+        'message': f"Converting to {CONFIG['AUDIO_FORMAT'].upper()}..."
+    }
+    
+    started = time.monotonic()
+    temp_file_path = transcode_audio(job.source_path, job.temp_dir)
+    job.stage_timings['transcode'] = time.monotonic() - started
+    
+    # Add metadata
+    started = time.monotonic()
+    add_metadata(temp_file_path, job.title, job.artist)
+    
+    # Move to permanent location
+    filename = os.path.basename(temp_file_path)
+    final_path = os.path.join(CONFIG['DOWNLOAD_DIR'], f"{job.download_id}_{filename}")
+    shutil.move(temp_file_path, final_path)
+    job.stage_timings['tag'] = time.monotonic() - started
+    
+    if job.cache_key:
+        result_cache.store(job.cache_key, final_path, {
+            'title': job.title,
+            'artist': job.artist,
+            'filename': filename
+        })
+    
+    complete_track(job, final_path)
+    
+    logger.info(f"Successfully downloaded: {job.title}")
+    return final_path
+
+# Failures that retrying will not fix: (text in the error, message shown to the user)
+PERMANENT_TRACK_ERRORS = (
+    ("Please sign in", "This video requires authentication. Please try a different URL or a public video."),
+    ("Video unavailable", "This video is not available. It may be private, deleted, or region-restricted."),
+    ("Unsupported URL", "This platform is not supported. Please use YouTube, SoundCloud, or other supported platforms."),
+)
+
+def classify_track_error(error):
+    """(user-facing message, whether a retry may succeed) for a track failure"""
+    if isinstance(error, HostDeferred):
+        return f"{error.platform} is not responding, try again later", True
+    error_msg = str(error)
+    for marker, message in PERMANENT_TRACK_ERRORS:
+        if marker in error_msg:
+            return message, False
+    return error_msg, True
+
+def record_track_error(job, error):
+    """Translate a track failure into a user-facing error and record it"""
+    error_msg = classify_track_error(error)[0]
+    
+    logger.error(f"Download failed for {job.url}: {error_msg}")
+    
+    download_progress[job.download_id] = {
+        'status': 'error',
+        'percentage': 0,
+        'error': error_msg,
+        'playlist_id': job.playlist_id,
+        'message': f'Download failed: {error_msg}'
+    }
+    if not job.playlist_id:
+        expire_download(job.download_id, None, CONFIG['UNCLAIMED_FILE_TTL'])
+    
+    if job.playlist_id and job.track_index is not None:
+        set_track_progress(job.playlist_id, job.track_index, {
+            'status': 'error',
+            'percentage': 0,
+            'title': f'Track {job.track_index + 1}',
+            'error': error_msg
+        })
+
+class HostDeferred(Exception):
+    """Raised by the download stage instead of fetching from a platform whose breaker is open"""
+    
+    def __init__(self, platform, retry_after):
+        super().__init__(f"{platform} is failing, deferring for {retry_after:.0f}s")
+        self.platform = platform
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Stops fetching from one platform while it keeps failing
+    
+    After BREAKER_THRESHOLD consecutive retryable failures the breaker opens
+    and fetches are deferred for BREAKER_COOLDOWN seconds. Then a single fetch
+    is let through as a probe: success closes the breaker, another failure
+    opens it again.
+    """
+    
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.trips = 0
+        self.deferred = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        
+    def retry_after(self, now=None):
+        """Seconds a fetch should wait, or 0 if it may go ahead"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            remaining = self._opened_at + CONFIG['BREAKER_COOLDOWN'] - now
+            if remaining <= 0 and not self._probing:
+                self._probing = True
+                return 0
+            self.deferred += 1
+            # Spread deferred fetches out so they do not all return at once
+            return max(remaining, 0) + random.uniform(0, CONFIG['RETRY_BASE_DELAY'])
+    
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"{self.name} is fetching again, closing its circuit breaker")
+            self.failures = 0
+            self._opened_at = None
+            self._probing = False
+            
+    def record_failure(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.failures += 1
+            if self._probing or (self._opened_at is None and self.failures >= CONFIG['BREAKER_THRESHOLD']):
+                self.trips += 1
+                logger.warning(f"{self.name} failed {self.failures} times in a row, deferring its fetches "
+                               f"for {CONFIG['BREAKER_COOLDOWN']:.0f}s")
+                self._opened_at = now
+            self._probing = False
+            
+    def release_probe(self):
+        """End a probe whose failure says nothing about the platform, so the next fetch probes again"""
+        with self._lock:
+            self._probing = False
+            
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            return 'half-open' if self._probing else 'open'
+    
+    def stats(self):
+        return {'state': self.state(), 'failures': self.failures, 'trips': self.trips, 'deferred': self.deferred}
+
+# Platform name (as reported by detect_platform) -> its circuit breaker
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+def platform_breaker(url):
+    name = detect_platform(url)['name']
+    with circuit_breakers_lock:
+        breaker = circuit_breakers.get(name)
+        if breaker is None:
+            breaker = circuit_breakers[name] = CircuitBreaker(name)
+        return breaker
+
+def retry_backoff(attempt):
+    """Seconds before retry number `attempt`: exponential, capped, with equal jitter"""
+    delay = min(CONFIG['RETRY_MAX_DELAY'], CONFIG['RETRY_BASE_DELAY'] * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def track_retry_delay(job, error):
+    """Seconds to wait before fetching job again after a failed fetch, or None to give up"""
+    if isinstance(error, HostDeferred):
+        if job.deferred + error.retry_after > CONFIG['TRACK_MAX_DEFERRAL']:
+            return None
+        job.deferred += error.retry_after
+        return error.retry_after
+    breaker = platform_breaker(job.url)
+    if not classify_track_error(error)[1]:
+        # The platform answered, about this track only; a probe ending here must not hold the breaker half-open
+        breaker.release_probe()
+        return None
+    breaker.record_failure()
+    job.attempts += 1
+    if job.attempts > CONFIG['TRACK_RETRIES']:
+        return None
+    return retry_backoff(job.attempts)
+
+# Download id -> callable that resubmits the track, run by the janitor when its delay is up
+pending_retries = {}
+retry_stats = {'scheduled': 0, 'deferred': 0}
+retry_lock = threading.Lock()
+
+def show_retry(job, error, delay):
+    """Show the track as queued again until its next fetch in delay seconds"""
+    if isinstance(error, HostDeferred):
+        message = f"{error.platform} is not responding, waiting {delay:.0f}s..."
+        counter = 'deferred'
+    else:
+        message = f"Retrying in {delay:.0f}s (attempt {job.attempts + 1} of {CONFIG['TRACK_RETRIES'] + 1})..."
+        counter = 'scheduled'
+        logger.info(f"Fetch failed for {job.url}, retrying in {delay:.1f}s: {error}")
+    
+    download_progress[job.download_id] = {'status': 'queued', 'percentage': 0, 'message': message}
+    if job.playlist_id and job.track_index is not None:
+        set_track_progress(job.playlist_id, job.track_index, {
+            'status': 'queued',
+            'percentage': 0,
+            'title': job.title or f'Track {job.track_index + 1}'
+        })
+    with retry_lock:
+        retry_stats[counter] += 1
+
+def schedule_retry(job, error, delay, resubmit):
+    """Show the track as queued again and resubmit it after delay seconds"""
+    show_retry(job, error, delay)
+    with retry_lock:
+        pending_retries[job.download_id] = resubmit
+    janitor.schedule('retry', job.download_id, delay)
+
+def retry_summary():
+    with retry_lock:
+        return dict(retry_stats, pending=len(pending_retries))
+
+def run_retry(download_id):
+    with retry_lock:
+        resubmit = pending_retries.pop(download_id, None)
+    if resubmit:
+        resubmit()
+
+def cleanup_temp_dir(temp_dir):
+    if temp_dir and os.path.exists(temp_dir):
+        try:
+            shutil.rmtree(temp_dir)
+        except Exception as e:
+            logger.error(f"Failed to cleanup temp directory: {e}")
+
+def release_partial(job, keep):
+    """Let go of a job's partial directory, keeping it for a retry if the track failed"""
+    if not job.partial_dir:
+        return
+    path, job.partial_dir = job.partial_dir, None
+    partial_downloads.release(path, keep)
+    if keep:
+        janitor.schedule('partial', path, CONFIG['PARTIAL_TTL'])
+
+def submit_track(url, download_id, playlist_id=None, track_index=None, entry=None, retry_state=None):
+    """Queue a track on the download/transcode pipeline and return its future
+    
+    The future resolves to the final file path, or None if the track failed.
+    `entry` is the flat playlist entry for the track, if there is one.
+    With `retry_state` (a dict, empty on the first run) a fetch that should
+    be retried is not waited for here: the future fails with RequeueJob,
+    whose job_args is the retry_state to pass to the next run.
+    """
+    download_progress.setdefault(download_id, {
+        'status': 'queued',
+        'percentage': 0,
+        'message': 'Waiting for a free download slot...'
+    })
+    
+    job = TrackJob(url, download_id, playlist_id, track_index, entry)
+    if retry_state:
+        job.attempts = retry_state.get('attempts', 0)
+        job.deferred = retry_state.get('deferred', 0.0)
+    result = Future()
+    with extraction_lock:
+        extraction_stats['tracks'] += 1
+    
+    def start_fetch():
+        download_stage.submit(fetch_track, job).add_done_callback(after_fetch)
+    
+    def stage_failed(future, retry=False):
+        error = future.exception()
+        if error is None:
+            return False
+        cleanup_temp_dir(job.temp_dir)
+        # Keep the partial (or fully fetched) source so the next attempt resumes
+        release_partial(job, keep=True)
+        delay = track_retry_delay(job, error) if retry else None
+        if delay is not None and retry_state is not None:
+            show_retry(job, error, delay)
+            result.set_exception(RequeueJob(delay, [{'attempts': job.attempts, 'deferred': job.deferred}]))
+            return True
+        if delay is not None:
+            schedule_retry(job, error, delay, start_fetch)
+            return True
+        record_track_error(job, error)
+        result.set_result(None)
+        return True
+    
+    def after_fetch(future):
+        # Only fetches are retried; a conversion that failed once fails again
+        if stage_failed(future, retry=True):
+            return
+        if future.result():
+            # Served from the result cache, nothing left to convert
+            result.set_result(future.result())
+        else:
+            transcode_stage.submit(finish_track, job).add_done_callback(after_transcode)
+    
+    def after_transcode(future):
+        if not stage_failed(future):
+            cleanup_temp_dir(job.temp_dir)
+            release_partial(job, keep=False)
+            result.set_result(future.result())
+    
+    start_fetch()
+    return result
+
 def download_single_track(url, download_id, playlist_id=None, track_index=None):
-    """Download a single track"""
-    temp_dir = None
+    """Download a single track and wait for it to finish"""
+    return submit_track(url, download_id, playlist_id, track_index).result()
+
+# Canonical media id -> id of the queued or running job fetching it
+inflight_jobs = {}
+inflight_lock = threading.Lock()
+
+def job_finished(job_id):
+    record = download_progress.get(job_id) or playlist_progress.get(job_id)
+    return record is None or record.get('status') in ProgressStore.TERMINAL_STATUSES
+
+def claim_inflight(media_id, job_id):
+    """Register job_id as the fetcher of media_id
+    
+    Returns the id of a job already fetching the same media, or None if
+    job_id now owns it. Claims of finished jobs are replaced, since with
+    ROLE=api the job runs, and is released, on another node.
+    """
+    with inflight_lock:
+        existing = inflight_jobs.get(media_id)
+        if existing and not job_finished(existing):
+            return existing
+        inflight_jobs[media_id] = job_id
+        return None
+
+def release_inflight(media_id, job_id):
+    with inflight_lock:
+        if inflight_jobs.get(media_id) == job_id:
+            del inflight_jobs[media_id]
+
+def run_single_download(url, download_id, media_id=None, retry_state=None):
+    """Job entry point for a single track download
+    
+    A fetch that has to wait before its next attempt gives the job worker
+    back: the job is queued again, to start once the wait is over.
+    """
+    requeued = False
     try:
-        # Create temporary directory
-        temp_dir = tempfile.mkdtemp(prefix='mp3dl_')
+        return submit_track(url, download_id, retry_state=retry_state or {}).result()
+    except RequeueJob as e:
+        requeued = True
+        raise RequeueJob(e.delay, (url, download_id, media_id) + e.job_args)
+    finally:
+        # A requeued job still fetches media_id, so identical requests keep attaching to it
+        if media_id and not requeued:
+            release_inflight(media_id, download_id)
+
+def run_playlist_download(url, playlist_id, media_id=None, entries=None, options=None):
+    """Job entry point for a playlist download
+    
+    The playlist is journaled while it runs; if the process dies first,
+    resume_interrupted_playlists() queues it again on the next start.
+    """
+    if playlist_journal:
+        playlist_journal.start(playlist_id, url, media_id, options)
+    try:
+        download_playlist(url, playlist_id, entries, options)
+    finally:
+        # A partial playlist stays journaled, so the next start resumes its listing
+        if playlist_journal and (playlist_progress.get(playlist_id) or {}).get('status') != 'partial':
+            playlist_journal.finish(playlist_id)
+        if media_id:
+            release_inflight(media_id, playlist_id)
+
+def resume_interrupted_playlists():
+    """Queue again the playlists this host was running when it stopped"""
+    if not playlist_journal:
+        return
+    for playlist_id in playlist_journal.interrupted():
+        state = playlist_journal.replay(playlist_id)
+        # Keep finished tracks until the resumed job has picked them up
+        reused = 0
+        for track in state['tracks'].values():
+            file_path = track.get('file_path')
+            if file_path and os.path.exists(file_path):
+                janitor.schedule_at('file', file_path, time.time() + CONFIG['UNCLAIMED_FILE_TTL'])
+                reused += 1
         
-        # Initialize progress
-        download_progress[download_id] = {
-            'status': 'starting',
+        job_queue.discard(playlist_id)
+        playlist_progress[playlist_id] = {
+            'status': 'queued',
+            'overall_percentage': 0,
+            'completed_tracks': 0,
+            'total_tracks': 0,
+            'tracks': {},
+            'message': 'Resuming after restart...'
+        }
+        if state['media_id']:
+            claim_inflight(state['media_id'], playlist_id)
+        try:
+            args = (state['url'], playlist_id, state['media_id'])
+            if state['options']:
+                args += (None, state['options'])
+            job_queue.submit(playlist_id, run_playlist_download, *args)
+        except QueueFullError:
+            # Still journaled, so the next start tries again
+            playlist_progress.pop(playlist_id, None)
+            logger.warning(f"Queue full, not resuming playlist {playlist_id}")
+            continue
+        logger.info(f"Resuming playlist {playlist_id} with {reused} tracks already downloaded")
+
+# Job entry points SharedJobQueue may run, by name
+def run_batch_download(urls, batch_id):
+    """Job entry point for a batch submission: its URLs are downloaded as one playlist
+    
+    All entries are journaled as one complete page before any track starts,
+    unlike the pages of an extractor listing, so a resumed batch never needs
+    its pseudo URL.
+    """
+    run_playlist_download(f"batch:{batch_id}", batch_id, entries=[{'url': url} for url in urls])
+
+JOB_FUNCTIONS = {
+    'run_single_download': run_single_download,
+    'run_playlist_download': run_playlist_download,
+    'run_batch_download': run_batch_download,
+}
+
+def fail_lost_job(job_id, name):
+    """Record a job whose workers kept dying as failed, so its progress ends"""
+    error_msg = 'The worker running this download stopped, please try again'
+    if name == 'run_single_download':
+        download_progress[job_id] = {
+            'status': 'error',
             'percentage': 0,
-            'message': 'Initializing download...'
+            'error': error_msg,
+            'message': f'Download failed: {error_msg}'
         }
+        expire_download(job_id, None, CONFIG['UNCLAIMED_FILE_TTL'])
+    else:
+        playlist_progress.update(job_id, {
+            'status': 'error',
+            'overall_percentage': 0,
+            'error': error_msg,
+            'message': f'Playlist download failed: {error_msg}'
+        })
+        if playlist_journal:
+            playlist_journal.finish(job_id)
+        expire_playlist(job_id, CONFIG['CLEANUP_DELAY'])
+
+def get_playlist_window():
+    """Number of tracks one playlist may keep in the pipeline at once"""
+    return CONFIG['PLAYLIST_TRACK_WINDOW'] or (download_stage.workers + transcode_stage.workers)
+
+class PlaylistFiles:
+    """Finished track files of a playlist in playlist order, for streaming
+    
+    Tracks are resolved by index as they finish (None for failed tracks), so a
+    reader can stream them in order while later tracks are still downloading.
+    """
+    
+    def __init__(self):
+        self.total = 0
+        self.finished = False
+        self._paths = {}
+        self._cond = threading.Condition()
         
-        # Create progress hook
-        progress_hook = DownloadProgressHook(download_id, playlist_id, track_index)
-        
-        # Get yt-dlp options
-        ydl_opts = get_ydl_opts(temp_dir, progress_hook)
-        
-        # Download with yt-dlp
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            download_progress[download_id]['status'] = 'extracting'
-            download_progress[download_id]['message'] = 'Extracting track information...'
-            
-            # Extract info
-            info = ydl.extract_info(url, download=False)
-            if not info:
-                raise Exception("Failed to extract video information")
-                
-            title = info.get('title', 'Unknown Title')
-            artist = info.get('uploader', info.get('artist', 'Unknown Artist'))
+    def set_total(self, total):
+        with self._cond:
+            self.total = total
+            self._cond.notify_all()
             
-            download_progress[download_id]['message'] = f'Downloading: {title}'
+    def add(self, index, file_path):
+        with self._cond:
+            self._paths[index] = file_path
+            self._cond.notify_all()
             
-            # Download
-            ydl.download([url])
+    def finish(self):
+        with self._cond:
+            self.finished = True
+            self._cond.notify_all()
             
-        # Find the downloaded file
-        downloaded_files = [f for f in os.listdir(temp_dir) if f.endswith('.mp3')]
+    def ready(self):
+        """Paths of the tracks finished so far, without waiting"""
+        with self._cond:
+            return [self._paths[i] for i in sorted(self._paths) if self._paths[i]]
+    
+    def __iter__(self):
+        """Yield paths in order, or None when no track resolved within STREAM_FILE_WAIT"""
+        index = 0
+        while True:
+            with self._cond:
+                resolved = self._cond.wait_for(
+                    lambda: index in self._paths or (self.finished and index >= self.total),
+                    CONFIG['STREAM_FILE_WAIT']
+                )
+                if resolved and index not in self._paths:
+                    return
+                file_path = self._paths.get(index)
+            if not resolved:
+                yield None
+                continue
+            index += 1
+            if file_path:
+                yield file_path
+
+class StoredPlaylistFiles:
+    """PlaylistFiles rebuilt from progress records, for nodes that did not run the playlist
+    
+    Track files are found through the per-track download records, so any node
+    sharing STATE_DB and DOWNLOAD_DIR can stream or serve the archive.
+    """
+    
+    def __init__(self, playlist_id):
+        self.playlist_id = playlist_id
         
-        if not downloaded_files:
-            raise Exception("No MP3 file found after download")
-            
-        downloaded_file = downloaded_files[0]
-        temp_file_path = os.path.join(temp_dir, downloaded_file)
+    def _playlist(self):
+        """(total tracks, finished) for the playlist"""
+        record = playlist_progress.get(self.playlist_id)
+        if record is None:
+            return 0, True
+        return record.get('total_tracks', 0), record.get('status') in ProgressStore.TERMINAL_STATUSES
+    
+    def _track(self, index):
+        """(resolved, file_path) for one track; failed tracks resolve to None"""
+        record = download_progress.get(f"{self.playlist_id}_track_{index}")
+        if record is None or record.get('status') not in ProgressStore.TERMINAL_STATUSES:
+            return False, None
+        file_path = record.get('file_path')
+        if record.get('status') == 'completed' and file_path and os.path.exists(file_path):
+            return True, file_path
+        return True, None
+    
+    def ready(self):
+        total, _ = self._playlist()
+        return [file_path for file_path in (self._track(i)[1] for i in range(total)) if file_path]
+    
+    def __iter__(self):
+        """Yield paths in order, or None when no track resolved within STREAM_FILE_WAIT"""
+        index = 0
+        while True:
+            seen_version = progress_notifier.version
+            total, finished = self._playlist()
+            while index < total:
+                resolved, file_path = self._track(index)
+                if not resolved and not finished:
+                    break
+                index += 1
+                if file_path:
+                    yield file_path
+            if finished:
+                return
+            progress_notifier.wait(seen_version, CONFIG['STREAM_FILE_WAIT'])
+            yield None
+
+class ZipEntry:
+    """One STORED member of a streamed playlist archive"""
+    
+    def __init__(self, file_path):
+        stat = os.stat(file_path)
+        self.path = file_path
+        self.name = os.path.basename(file_path).encode('utf-8')
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.crc = None
+        self.offset = 0
         
-        # Add metadata
-        add_metadata(temp_file_path, title, artist)
+        year, month, day, hour, minute, second = time.localtime(stat.st_mtime)[:6]
+        if year < 1980:
+            year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+        self.dos_time = (hour << 11) | (minute << 5) | (second // 2)
+        self.dos_date = ((year - 1980) << 9) | (month << 5) | day
         
-        # Move to permanent location
-        final_filename = f"{download_id}_{downloaded_file}"
-        final_path = os.path.join(CONFIG['DOWNLOAD_DIR'], final_filename)
-        shutil.move(temp_file_path, final_path)
+    @property
+    def zip64_size(self):
+        return self.size >= ZIP64_LIMIT
+    
+    def local_header(self):
+        # Sizes and CRC follow the data in a descriptor, so the header can be
+        # written before the file has been read
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if self.zip64_size else b''
+        return struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 45 if self.zip64_size else 20, ZIP_FLAGS, 0,
+            self.dos_time, self.dos_date, 0, 0, 0, len(self.name), len(extra)
+        ) + self.name + extra
+    
+    def data_descriptor(self):
+        if self.zip64_size:
+            return struct.pack('<IIQQ', 0x08074b50, self.crc, self.size, self.size)
+        return struct.pack('<IIII', 0x08074b50, self.crc, self.size, self.size)
+    
+    def central_header(self):
+        extra_values = []
+        size = self.size
+        offset = self.offset
+        if self.zip64_size:
+            extra_values += [self.size, self.size]
+            size = ZIP64_LIMIT
+        if self.offset >= ZIP64_LIMIT:
+            extra_values.append(self.offset)
+            offset = ZIP64_LIMIT
+        extra = b''
+        if extra_values:
+            extra = struct.pack(f'<HH{len(extra_values)}Q', 1, 8 * len(extra_values), *extra_values)
+        version = 45 if extra else 20
+        return struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, 0x0300 | version, version, ZIP_FLAGS, 0,
+            self.dos_time, self.dos_date, self.crc, size, size,
+            len(self.name), len(extra), 0, 0, 0, 0o100644 << 16, offset
+        ) + self.name + extra
+
+def zip_central_directory(entries, offset):
+    """Central directory and end records for entries, starting at offset"""
+    directory = b''.join(entry.central_header() for entry in entries)
+    count = len(entries)
+    size = len(directory)
+    end = b''
+    if count >= 0xFFFF or offset >= ZIP64_LIMIT or size >= ZIP64_LIMIT:
+        zip64_end_offset = offset + size
+        end += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, size, offset)
+        end += struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1)
+    end += struct.pack(
+        '<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+        min(size, ZIP64_LIMIT), min(offset, ZIP64_LIMIT), 0
+    )
+    return directory + end
+
+# CRC-32 of archived files by (path, size, mtime), so resumed transfers of a
+# finished archive don't have to re-read every track to rebuild its layout
+zip_crc_cache = OrderedDict()
+zip_crc_lock = threading.Lock()
+
+def cached_crc(entry):
+    with zip_crc_lock:
+        crc = zip_crc_cache.get((entry.path, entry.size, entry.mtime_ns))
+        if crc is not None:
+            zip_crc_cache.move_to_end((entry.path, entry.size, entry.mtime_ns))
+        return crc
+
+def remember_crc(entry):
+    with zip_crc_lock:
+        zip_crc_cache[(entry.path, entry.size, entry.mtime_ns)] = entry.crc
+        while len(zip_crc_cache) > ZIP_CRC_CACHE_SIZE:
+            zip_crc_cache.popitem(last=False)
+
+def file_crc(entry):
+    crc = cached_crc(entry)
+    if crc is None:
+        crc = 0
+        with open(entry.path, 'rb') as f:
+            while True:
+                chunk = f.read(ZIP_CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+        entry.crc = crc
+        remember_crc(entry)
+    return crc
+
+def stream_zip(file_paths):
+    """Generate a STORED ZIP archive of file_paths chunk by chunk
+    
+    Entries are STORED since MP3 data does not compress, and nothing is
+    written to disk. The bytes are identical to zip_layout() for the same
+    files, so a finished archive can later be served with Range requests.
+    A None in file_paths means the next file is not ready yet; it becomes an
+    empty chunk so the server can give the thread back while it waits.
+    """
+    entries = []
+    offset = 0
+    for file_path in file_paths:
+        if file_path is None:
+            yield b''
+            continue
+        entry = ZipEntry(file_path)
+        entry.offset = offset
+        header = entry.local_header()
+        yield header
+        offset += len(header)
         
-        # Update progress
-        download_progress[download_id] = {
-            'status': 'completed',
-            'percentage': 100,
-            'file_path': final_path,
-            'filename': final_filename,
-            'title': title,
-            'artist': artist,
-            'message': 'Download completed!'
-        }
+        crc = 0
+        with open(file_path, 'rb') as f:
+            remaining = entry.size
+            while remaining:
+                chunk = f.read(min(ZIP_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f"{file_path} shrank while it was being archived")
+                crc = zlib.crc32(chunk, crc)
+                remaining -= len(chunk)
+                yield chunk
+        entry.crc = crc
+        remember_crc(entry)
         
-        logger.info(f"Successfully downloaded: {title}")
-        return final_path
+        descriptor = entry.data_descriptor()
+        yield descriptor
+        offset += entry.size + len(descriptor)
+        entries.append(entry)
+    
+    yield zip_central_directory(entries, offset)
+
+def zip_layout(file_paths):
+    """Byte layout of the archive stream_zip() produces for finished files
+    
+    Returns a list of segments, each either bytes or (path, size), plus the
+    ZipEntry list.
+    """
+    segments = []
+    entries = []
+    offset = 0
+    for file_path in file_paths:
+        entry = ZipEntry(file_path)
+        entry.offset = offset
+        entry.crc = file_crc(entry)
+        header = entry.local_header()
+        descriptor = entry.data_descriptor()
+        segments += [header, (entry.path, entry.size), descriptor]
+        offset += len(header) + entry.size + len(descriptor)
+        entries.append(entry)
+    segments.append(zip_central_directory(entries, offset))
+    return segments, entries
+
+def iter_segments(segments, start, stop):
+    """Yield the bytes in [start, stop) of a segmented archive"""
+    position = 0
+    for segment in segments:
+        length = len(segment) if isinstance(segment, bytes) else segment[1]
+        segment_start, position = position, position + length
+        if position <= start:
+            continue
+        if segment_start >= stop:
+            break
+        begin = max(start - segment_start, 0)
+        end = min(stop - segment_start, length)
+        if isinstance(segment, bytes):
+            yield segment[begin:end]
+            continue
+        with open(segment[0], 'rb') as f:
+            f.seek(begin)
+            remaining = end - begin
+            while remaining:
+                chunk = f.read(min(ZIP_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f"{segment[0]} shrank while it was being served")
+                remaining -= len(chunk)
+                yield chunk
+
+# Track files of running and finished playlists, by playlist id
+playlist_files = {}
+
+class Janitor:
+    """Single background thread that expires downloaded files and job records
+    
+    Expiries live in a heap ordered by deadline, with one live deadline per
+    (kind, target) key: scheduling a key again replaces its deadline instead
+    of queueing a second deletion. Each kind has a handler that does the
+    actual cleanup.
+    
+    With a StateDB, deadlines of the SHARED_KINDS are kept in its expiries
+    table instead, so a deadline moved by one node (say an API node serving
+    the file) holds for every node. Each node's janitor polls for due rows
+    and claims one by deleting it, so only one node runs each expiry.
+    """
+    
+    # Files in the shared DOWNLOAD_DIR and records in the shared progress stores
+    SHARED_KINDS = ('file', 'download', 'playlist')
+    
+    def __init__(self, handlers, db=None):
+        self.handlers = handlers
+        self.db = db
+        self.expired = 0
+        self._heap = []
+        self._deadlines = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._last_watermark_check = 0
         
-    except Exception as e:
-        error_msg = str(e)
-        if "Please sign in" in error_msg:
-            error_msg = "This video requires authentication. Please try a different URL or a public video."
-        elif "Video unavailable" in error_msg:
-            error_msg = "This video is not available. It may be private, deleted, or region-restricted."
-        elif "Unsupported URL" in error_msg:
-            error_msg = "This platform is not supported. Please use YouTube, SoundCloud, or other supported platforms."
-        elif "Failed to extract video information" in error_msg:
-            error_msg = "Unable to extract video information. The URL may be invalid or the platform may not be supported."
+    def start(self):
+        """Rebuild the expiry index from DOWNLOAD_DIR and start the janitor thread"""
+        with self._cond:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, name='janitor', daemon=True)
+        self.rebuild()
+        self._thread.start()
         
-        logger.error(f"Download failed for {url}: {error_msg}")
+    def schedule(self, kind, target, delay):
+        """Expire target `delay` seconds from now, replacing any earlier schedule"""
+        self.schedule_at(kind, target, time.time() + delay)
+        if not self._thread:
+            self.start()
+            
+    def schedule_at(self, kind, target, expires_at, replace=True):
+        """Expire target at expires_at; with replace=False an existing deadline is kept"""
+        if self._shared(kind):
+            with self.db.transaction() as conn:
+                conn.execute(
+                    'INSERT INTO expiries (kind, target, expires_at) VALUES (?, ?, ?) '
+                    'ON CONFLICT (kind, target) DO ' + ('UPDATE SET expires_at = excluded.expires_at' if replace else 'NOTHING'),
+                    (kind, target, expires_at)
+                )
+            with self._cond:
+                self._cond.notify()
+            return
+        with self._cond:
+            key = (kind, target)
+            if not replace and key in self._deadlines:
+                return
+            self._deadlines[key] = expires_at
+            heapq.heappush(self._heap, (expires_at, key))
+            self._cond.notify()
+            
+    def _shared(self, kind):
+        return self.db is not None and kind in self.SHARED_KINDS
+            
+    def rebuild(self):
+        """Schedule every finished file in DOWNLOAD_DIR and partial download left on disk, e.g. after a restart"""
+        try:
+            entries = list(os.scandir(CONFIG['DOWNLOAD_DIR']))
+        except OSError as e:
+            logger.error(f"Failed to scan download directory: {e}")
+            return
+        for entry in entries:
+            if entry.is_file() and not entry.name.endswith('.caching'):
+                self.schedule_at('file', entry.path, entry.stat().st_mtime + CONFIG['CLEANUP_DELAY'], replace=False)
+        for path, mtime in partial_downloads.existing():
+            self.schedule_at('partial', path, mtime + CONFIG['PARTIAL_TTL'], replace=False)
+            
+    def _claim(self, keys):
+        """Delete shared deadlines this node is about to run; returns the keys it won"""
+        claimed = []
+        with self.db.transaction() as conn:
+            for kind, target, expires_at in keys:
+                # Another node may have run or moved the deadline since it was read
+                if conn.execute(
+                    'DELETE FROM expiries WHERE kind = ? AND target = ? AND expires_at = ?', (kind, target, expires_at)
+                ).rowcount:
+                    claimed.append((kind, target))
+        return claimed
+                
+    def run_due(self, now=None):
+        """Expire everything whose deadline has passed; returns seconds until the next one"""
+        now = time.time() if now is None else now
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                expires_at, key = heapq.heappop(self._heap)
+                # Skip heap entries superseded by a later schedule() of the same key
+                if self._deadlines.get(key) == expires_at:
+                    del self._deadlines[key]
+                    due.append(key)
+            next_deadline = self._heap[0][0] - now if self._heap else None
         
-        download_progress[download_id] = {
-            'status': 'error',
-            'percentage': 0,
-            'error': error_msg,
-            'message': f'Download failed: {error_msg}'
-        }
+        if self.db is not None:
+            conn = self.db.connect()
+            due += self._claim(conn.execute(
+                'SELECT kind, target, expires_at FROM expiries WHERE expires_at <= ?', (now,)
+            ).fetchall())
+            next_shared = conn.execute('SELECT MIN(expires_at) FROM expiries').fetchone()[0]
+            if next_shared is not None:
+                next_deadline = min(next_shared - now, next_deadline if next_deadline is not None else math.inf)
         
-        if playlist_id and track_index is not None:
-            if playlist_id not in playlist_progress:
-                playlist_progress[playlist_id] = {'tracks': {}}
-            playlist_progress[playlist_id]['tracks'][track_index] = {
-                'status': 'error',
-                'percentage': 0,
-                'title': f'Track {track_index + 1}',
-                'error': error_msg
-            }
+        for key in due:
+            self._expire(key)
+        return next_deadline
+    
+    def enforce_watermarks(self):
+        """Expire scheduled files early, soonest first, while DOWNLOAD_DIR is over the high watermark
         
-        return None
+        Only files with a single link count as reclaimable; a file the result
+        cache links to keeps its disk space until the cache evicts it.
+        """
+        usage = disk_usage(CONFIG['DOWNLOAD_DIR'])
+        if usage <= CONFIG['DISK_HIGH_WATERMARK']:
+            return
         
-    finally:
-        # Cleanup temp directory
-        if temp_dir and os.path.exists(temp_dir):
+        if self._shared('file'):
+            files = self.db.connect().execute(
+                "SELECT expires_at, target FROM expiries WHERE kind = 'file' ORDER BY expires_at"
+            ).fetchall()
+        else:
+            with self._cond:
+                files = sorted(
+                    (expires_at, target) for (kind, target), expires_at in self._deadlines.items() if kind == 'file'
+                )
+        for expires_at, file_path in files:
+            if usage <= CONFIG['DISK_LOW_WATERMARK']:
+                break
             try:
-                shutil.rmtree(temp_dir)
-            except Exception as e:
-                logger.error(f"Failed to cleanup temp directory: {e}")
+                stat = os.stat(file_path)
+            except OSError:
+                stat = None
+            if stat is not None and stat.st_nlink > 1:
+                # Also linked from the result cache: removing it would free nothing
+                continue
+            if self._shared('file'):
+                if not self._claim([('file', file_path, expires_at)]):
+                    continue
+            else:
+                with self._cond:
+                    self._deadlines.pop(('file', file_path), None)
+            self._expire(('file', file_path))
+            usage -= stat.st_size if stat is not None else 0
+        logger.info(f"Disk usage above high watermark, expired files down to {usage} bytes")
+            
+    def _expire(self, key):
+        kind, target = key
+        try:
+            self.handlers[kind](target)
+            self.expired += 1
+        except Exception as e:
+            logger.error(f"Failed to expire {kind} {target}: {e}")
+            
+    def _run(self):
+        while True:
+            timeout = None
+            try:
+                timeout = self.run_due()
+                if time.time() - self._last_watermark_check >= CONFIG['JANITOR_INTERVAL']:
+                    self._last_watermark_check = time.time()
+                    self.enforce_watermarks()
+            except sqlite3.Error as e:
+                logger.error(f"Could not read shared expiries: {e}")
+            with self._cond:
+                # Shared deadlines may be set by other nodes, so poll at least every JANITOR_INTERVAL
+                wait = CONFIG['JANITOR_INTERVAL'] if timeout is None else min(timeout, CONFIG['JANITOR_INTERVAL'])
+                self._cond.wait(max(wait, 0))
+                
+    def stats(self):
+        with self._cond:
+            scheduled = len(self._deadlines)
+        if self.db is not None:
+            scheduled += self.db.connect().execute('SELECT COUNT(*) FROM expiries').fetchone()[0]
+        return {'scheduled': scheduled, 'expired': self.expired}
+
+def disk_usage(directory):
+    """Total size of the files directly inside directory"""
+    total = 0
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file():
+                total += entry.stat().st_size
+        except OSError:
+            pass
+    return total
+
+def remove_file(file_path):
+    if os.path.exists(file_path):
+        os.remove(file_path)
+        logger.info(f"Cleaned up file: {file_path}")
+
+def forget_download(download_id):
+    download_progress.pop(download_id, None)
+
+def forget_playlist(playlist_id):
+    """Drop a playlist's progress, its track records and its streamable file list"""
+    with progress_lock:
+        progress = playlist_progress.pop(playlist_id, None) or {}
+    for track_index in progress.get('tracks', {}):
+        download_progress.pop(f"{playlist_id}_track_{track_index}", None)
+    forget_playlist_files(playlist_id)
+
+def forget_playlist_files(playlist_id):
+    playlist_files.pop(playlist_id, None)
+
+janitor = Janitor({
+    'file': remove_file,
+    'download': forget_download,
+    'playlist': forget_playlist,
+    'playlist_files': forget_playlist_files,
+    'partial': partial_downloads.remove,
+    'retry': run_retry
+}, state_db)
+
+def expire_download(download_id, file_path, delay):
+    """Schedule a single download's file and progress record for cleanup"""
+    if file_path:
+        janitor.schedule('file', file_path, delay)
+    janitor.schedule('download', download_id, delay)
+
+def expire_playlist(playlist_id, delay):
+    """Schedule a playlist's track files and records for cleanup"""
+    files = playlist_files.get(playlist_id)
+    if files is not None:
+        for file_path in files.ready():
+            janitor.schedule('file', file_path, delay)
+    janitor.schedule('playlist', playlist_id, delay)
+    if state_db and files is not None:
+        # The shared expiry may run on another node, which cannot drop this node's file list;
+        # other nodes serve the archive from the progress records meanwhile
+        janitor.schedule('playlist_files', playlist_id, delay)
+
+def reuse_playlist_track(playlist_id, track_index, file_path, entry):
+    """Mark a track finished by an interrupted run of the playlist as completed"""
+    title = (entry or {}).get('title') or f'Track {track_index + 1}'
+    download_progress[f"{playlist_id}_track_{track_index}"] = {
+        'status': 'completed',
+        'percentage': 100,
+        'title': title,
+        'file_path': file_path,
+        'filename': os.path.basename(file_path),
+        'playlist_id': playlist_id,
+        'message': 'Downloaded before restart'
+    }
+    set_track_progress(playlist_id, track_index, {
+        'status': 'completed',
+        'percentage': 100,
+        'title': title
+    })
+
+class PlaylistSelection:
+    """Tracks of a playlist to download, in yt-dlp's playlist_items syntax
+    
+    "1-3,7,10:" selects by 1-based position: single items, inclusive ranges
+    with an optional :step, and negative positions counting from the end.
+    Selected tracks keep playlist order whatever the order of the items.
+    """
+    
+    def __init__(self, items):
+        self.items = items
+        # ValueError for a malformed specification
+        self._specs = [
+            slice(spec, spec) if isinstance(spec, int) else spec
+            for spec in yt_dlp.utils.PlaylistEntries.parse_playlist_items(items)
+        ]
+        for text, spec in zip(items.split(','), self._specs):
+            if spec.start == 0 or spec.stop == 0:
+                raise ValueError(f"'{text}': positions start at 1")
+        # yt-dlp silently downloads nothing for these; reject them up front instead.
+        # An empty item next to others is ignored, as yt-dlp ignores it.
+        if all(self._selects_nothing(spec) for spec in self._specs):
+            raise ValueError(f"'{items}' selects no tracks")
+    
+    @staticmethod
+    def _selects_nothing(spec):
+        """Whether a range is empty whatever the playlist length"""
+        if spec.start is None or spec.stop is None or (spec.start < 0) != (spec.stop < 0):
+            # Open-ended, or depends on the playlist length
+            return False
+        return spec.start > spec.stop if (spec.step or 1) > 0 else spec.start < spec.stop
+        
+    @classmethod
+    def from_request(cls, data):
+        """Selection from the items, or start and end, of a request; None selects everything"""
+        items, start, end = data.get('items'), data.get('start'), data.get('end')
+        if items is not None:
+            if start is not None or end is not None:
+                raise ValueError('use either items or start/end')
+            return cls(str(items))
+        if start is None and end is None:
+            return None
+        for value in (start, end):
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 1):
+                raise ValueError('start and end must be positive integers')
+        return cls(f"{start or 1}:{'' if end is None else end}")
+    
+    @property
+    def needs_count(self):
+        """Whether positions count from the end, so the playlist length must be known"""
+        return any(
+            (spec.start or 0) < 0 or (spec.stop or 0) < 0 or (spec.start is None and (spec.step or 1) < 0)
+            for spec in self._specs
+        )
+    
+    def _ranges(self, count):
+        """(first, last, anchor, step) per item as 0-based inclusive bounds, as yt-dlp walks them"""
+        for spec in self._specs:
+            step = spec.step or 1
+            if spec.start is None:
+                start = 0 if step > 0 else count - 1
+            else:
+                start = spec.start - 1 if spec.start >= 0 else count + spec.start
+            if spec.stop is None:
+                stop = math.inf if step > 0 else 0
+            else:
+                stop = spec.stop - 1 if spec.stop >= 0 else count + spec.stop
+            yield (start, stop, start, step) if step > 0 else (stop, start, start, -step)
+    
+    def select(self, entries, count=None):
+        """Yield the selected entries, without listing past the last position that can match"""
+        ranges = list(self._ranges(count))
+        end = max(last for _, last, _, _ in ranges)
+        for index, entry in enumerate(entries):
+            if index > end:
+                return
+            if any(first <= index <= last and (index - anchor) % step == 0 for first, last, anchor, step in ranges):
+                yield entry
+    
+    def count(self, total):
+        """Number of tracks selected from a playlist of total tracks"""
+        return sum(1 for _ in self.select(range(total), total))
+
+def iter_playlist_entries(entries):
+    """Iterate raw playlist entries without materializing them
+    
+    Paged listings are read a page at a time; generators are consumed as the
+    extractor yields them.
+    """
+    if isinstance(entries, yt_dlp.utils.PagedList):
+        start = 0
+        while True:
+            page = entries.getslice(start, start + CONFIG['PLAYLIST_PAGE_SIZE'])
+            yield from page
+            if len(page) < CONFIG['PLAYLIST_PAGE_SIZE']:
+                return
+            start += len(page)
+    else:
+        yield from entries or ()
+
+def expand_playlist(url):
+    """List a playlist lazily
+    
+    First yields (title, expected track count or None), then the flat entries
+    as the extractor produces them, so tracks can start while later pages are
+    still being fetched. Extraction is not processed: yt-dlp would collect all
+    entries before returning.
+    """
+    ydl_opts = {
+        'extract_flat': True,
+        'lazy_playlist': True,
+        'quiet': True,
+        'no_warnings': True
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False, process=False)
+        # Follow redirects such as a watch URL pointing at its playlist
+        for _ in range(3):
+            if not info or info.get('_type') not in ('url', 'url_transparent'):
+                break
+            info = ydl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
+        if not info or 'entries' not in info:
+            raise Exception("No tracks found in playlist")
+        
+        yield info.get('title') or 'Unknown Playlist', info.get('playlist_count')
+        yield from iter_playlist_entries(info['entries'])
 
-def download_playlist(url, playlist_id):
-    """Download a playlist"""
+def download_playlist(url, playlist_id, entries=None, options=None):
+    """Download a playlist
+    
+    Entries are listed lazily: tracks start as soon as the first entries are
+    known and total_tracks grows as later pages arrive. Only the playlist
+    window of tracks is held in the pipeline, so memory does not grow with the
+    playlist. Finished tracks are published through playlist_files so
+    /download_playlist/<playlist_id> can stream the ZIP while later tracks are
+    still downloading. `entries` skips extraction, for batches of URLs.
+    
+    `options` may hold 'items', a PlaylistSelection specification, and
+    'sync', a client's sync id, to download only the entries that client has
+    not received yet (see PlaylistArchive). Tracks are numbered by their
+    position among the downloaded ones.
+    """
+    options = options or {}
     temp_dir = None
+    listing = None
+    skipped = 0
+    files = playlist_files[playlist_id] = PlaylistFiles()
+    # Journal state of this run; None when the job is not journaled
+    resume = playlist_journal.replay(playlist_id) if playlist_journal else None
     try:
         # Initialize playlist progress
         playlist_progress[playlist_id] = {
@@ -418,121 +3660,464 @@ def download_playlist(url, playlist_id):
             'completed_tracks': 0,
             'total_tracks': 0,
             'tracks': {},
+            'zip_filename': f"playlist_{playlist_id}.zip",
             'message': 'Extracting playlist information...'
         }
         
         # Create temporary directory
         temp_dir = tempfile.mkdtemp(prefix='mp3dl_playlist_')
         
-        # Extract playlist info
-        ydl_opts = {
-            'extract_flat': True,
-            'quiet': True,
-            'no_warnings': True
-        }
+        sync = options.get('sync')
+        if sync and playlist_archive is None:
+            raise Exception("Sync mode needs JOURNAL_DB or STATE_DB")
+        archive_key = PlaylistArchive.sync_key(sync, url) if sync else None
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            playlist_info = ydl.extract_info(url, download=False)
-            
-        if 'entries' not in playlist_info:
-            raise Exception("No tracks found in playlist")
-            
-        entries = list(playlist_info['entries'])
-        total_tracks = len(entries)
+        def unsynced(entries):
+            """Entries the sync client has not received; unavailable entries are dropped"""
+            nonlocal skipped
+            for entry in entries:
+                if entry is None:
+                    continue
+                if playlist_archive.has(archive_key, entry):
+                    skipped += 1
+                    continue
+                yield entry
+        
+        if resume is not None and resume['entries_complete']:
+            # Resuming after a restart: the entries were journaled by the first run
+            entries = resume['entries']
+            playlist_title = resume['title']
+            expected = len(entries)
+        elif entries is not None:
+            playlist_title = f"Batch of {len(entries)} tracks"
+            expected = len(entries)
+            # Known up front, and a resumed batch cannot list its pseudo URL again
+            if resume is not None:
+                playlist_journal.record_entries(playlist_id, playlist_title, entries)
+        else:
+            # Also taken when a restart interrupted the listing: it is listed again from the start
+            listing = expand_playlist(url)
+            playlist_title, expected = next(listing)
+            entries = listing
+            if options.get('items'):
+                selection = PlaylistSelection(options['items'])
+                if selection.needs_count and expected is None:
+                    # Positions counted from the end need the length, so list everything first
+                    entries = list(entries)
+                    expected = len(entries)
+                entries = selection.select(entries, expected)
+                expected = selection.count(expected) if expected is not None else None
+            if sync:
+                entries = unsynced(entries)
+                expected = None
+        
+        # Entries of an extractor listing are journaled page by page
+        journal_entries = resume is not None and listing is not None
+        total_tracks = expected or 0
         
-        playlist_progress[playlist_id].update({
+        playlist_progress.update(playlist_id, {
+            'status': 'downloading',
             'total_tracks': total_tracks,
-            'playlist_title': playlist_info.get('title', 'Unknown Playlist'),
-            'message': f'Found {total_tracks} tracks. Starting downloads...'
+            'playlist_title': playlist_title,
+            'message': f'Found {total_tracks} tracks. Starting downloads...' if expected
+                       else 'Listing tracks. Starting downloads...'
         })
         
-        downloaded_files = []
+        # Tracks a previous run finished before it was interrupted
+        reused = {
+            i: track['file_path'] for i, track in (resume['tracks'] if resume else {}).items()
+            if track.get('file_path') and os.path.exists(track['file_path'])
+        }
+        if reused:
+            playlist_progress.update(playlist_id, {
+                'message': f"Resumed with {len(reused)} tracks already downloaded"
+            })
         
-        # Download each track
-        for i, entry in enumerate(entries):
-            if entry is None:
-                continue
-                
-            track_url = entry.get('url') or entry.get('webpage_url')
-            if not track_url:
-                track_url = f"https://www.youtube.com/watch?v={entry['id']}"
-                
-            track_download_id = f"{playlist_id}_track_{i}"
-            
-            playlist_progress[playlist_id]['message'] = f'Downloading track {i+1}/{total_tracks}'
-            
-            # Download track
-            file_path = download_single_track(track_url, track_download_id, playlist_id, i)
+        entry_iter = iter(entries)
+        listed = 0
+        listing_done = False
+        listing_error = None
+        page = []
+        completed = 0
+        pending = {}
+        window = get_playlist_window()
+        
+        def flush_page(complete):
+            nonlocal page
+            if journal_entries:
+                playlist_journal.record_entries(playlist_id, playlist_title, page, listed - len(page), complete)
+            page = []
             
-            if file_path and os.path.exists(file_path):
-                downloaded_files.append(file_path)
-                playlist_progress[playlist_id]['completed_tracks'] += 1
+        def next_entry():
+            """(index, entry) of the next listed track, or None once the listing is exhausted"""
+            nonlocal listed, listing_done, listing_error, total_tracks
+            if listing_done:
+                return None
+            try:
+                entry = next(entry_iter)
+            except StopIteration:
+                pass
+            except Exception as e:
+                if not listed:
+                    raise
+                # Keep the tracks listed so far rather than failing the playlist
+                logger.error(f"Listing playlist {playlist_id} stopped after {listed} tracks: {e}")
+                listing_error = str(e)
+            else:
+                listed += 1
+                page.append(entry)
+                if len(page) >= CONFIG['PLAYLIST_PAGE_SIZE']:
+                    flush_page(complete=False)
+                return listed - 1, entry
             
-            # Update overall progress
-            overall_percentage = (playlist_progress[playlist_id]['completed_tracks'] / total_tracks) * 100
-            playlist_progress[playlist_id]['overall_percentage'] = overall_percentage
+            listing_done = True
+            # An interrupted listing stays incomplete in the journal, so a resume lists it again
+            flush_page(complete=listing_error is None)
+            total_tracks = listed
+            files.set_total(listed)
+            return None
         
-        if not downloaded_files:
-            raise Exception("No tracks were successfully downloaded")
-            
-        # Create ZIP file
-        playlist_progress[playlist_id]['message'] = 'Creating ZIP file...'
-        zip_filename = f"playlist_{playlist_id}.zip"
-        zip_path = os.path.join(CONFIG['DOWNLOAD_DIR'], zip_filename)
+        def submit_next():
+            # Keep at most `window` tracks of this playlist in the shared pool,
+            # so other jobs can interleave instead of queueing behind all of it.
+            # Entries are only listed this far ahead of the downloads.
+            nonlocal completed
+            while True:
+                item = next_entry()
+                if item is None:
+                    return False
+                i, entry = item
+                if entry is None:
+                    files.add(i, None)
+                    continue
+                if i in reused:
+                    reuse_playlist_track(playlist_id, i, reused[i], entry)
+                    files.add(i, reused[i])
+                    completed += 1
+                    if sync:
+                        playlist_archive.add(archive_key, entry, playlist_id, f"{playlist_id}_track_{i}")
+                    continue
+                
+                track_url = entry.get('url') or entry.get('webpage_url')
+                if not track_url:
+                    track_url = f"https://www.youtube.com/watch?v={entry['id']}"
+                
+                track_download_id = f"{playlist_id}_track_{i}"
+                future = submit_track(track_url, track_download_id, playlist_id, i, entry)
+                pending[future] = i, entry
+                return True
         
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for file_path in downloaded_files:
-                if os.path.exists(file_path):
-                    arcname = os.path.basename(file_path)
-                    zipf.write(file_path, arcname)
+        while len(pending) < window and submit_next():
+            pass
         
-        # Update final progress
-        playlist_progress[playlist_id].update({
-            'status': 'completed',
-            'overall_percentage': 100,
-            'zip_path': zip_path,
-            'zip_filename': zip_filename,
-            'message': f'Playlist download completed! {len(downloaded_files)} tracks downloaded.'
-        })
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, entry = pending.pop(future)
+                file_path = future.result()
+                
+                with progress_lock:
+                    if file_path and os.path.exists(file_path):
+                        completed += 1
+                        if sync:
+                            playlist_archive.add(archive_key, entry, playlist_id, f"{playlist_id}_track_{i}")
+                    else:
+                        file_path = None
+                    files.add(i, file_path)
+                    if resume is not None:
+                        playlist_journal.record_track(playlist_id, i, file_path)
+                    
+                    # Update overall progress; the total grows while entries are still being listed
+                    total_tracks = max(total_tracks, listed)
+                    playlist_progress.update(playlist_id, {
+                        'completed_tracks': completed,
+                        'total_tracks': total_tracks,
+                        'overall_percentage': (completed / total_tracks) * 100,
+                        'message': f"Downloaded {completed}/{total_tracks} tracks"
+                    })
+                
+                submit_next()
         
-        logger.info(f"Playlist download completed: {len(downloaded_files)} tracks")
+        if sync and not listed:
+            message = f'Playlist is up to date, all {skipped} tracks were downloaded before.'
+        elif not completed:
+            raise Exception(listing_error or "No tracks were successfully downloaded")
+        elif listing_error:
+            message = f'Playlist partially downloaded: {completed} tracks downloaded before the listing failed.'
+        else:
+            message = f'Playlist download completed! {completed} tracks downloaded.'
         
-        # Schedule cleanup of individual files
-        def cleanup_files():
-            time.sleep(CONFIG['CLEANUP_DELAY'])
-            for file_path in downloaded_files:
-                try:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                except Exception as e:
-                    logger.error(f"Failed to cleanup file {file_path}: {e}")
+        # Update final progress
+        final = {
+            'status': 'partial' if listing_error else 'completed',
+            'overall_percentage': 100,
+            'completed_tracks': completed,
+            'total_tracks': total_tracks,
+            'message': message
+        }
+        if listing_error:
+            final['error'] = f"Listing stopped after {listed} tracks: {listing_error}"
+        if sync:
+            final['skipped_tracks'] = skipped
+        playlist_progress.update(playlist_id, final)
         
-        threading.Thread(target=cleanup_files, daemon=True).start()
+        logger.info(f"Playlist download completed: {completed} tracks")
         
     except Exception as e:
         error_msg = str(e)
         logger.error(f"Playlist download failed: {error_msg}")
         
-        playlist_progress[playlist_id] = {
+        # Keep the track list, so forget_playlist still finds the track records
+        playlist_progress.update(playlist_id, {
             'status': 'error',
             'overall_percentage': 0,
             'error': error_msg,
             'message': f'Playlist download failed: {error_msg}'
-        }
+        })
         
     finally:
+        if listing is not None:
+            listing.close()
+        files.finish()
+        expire_playlist(playlist_id, CONFIG['CLEANUP_DELAY'])
         if temp_dir and os.path.exists(temp_dir):
             try:
                 shutil.rmtree(temp_dir)
             except Exception as e:
                 logger.error(f"Failed to cleanup temp directory: {e}")
 
+def queue_full_response(error):
+    """503 response telling the client when to retry"""
+    response = jsonify({'error': str(error), 'retry_after': error.retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def client_key():
+    """Identifies the client a request is rate limited as"""
+    header = CONFIG['RATE_LIMIT_KEY_HEADER']
+    if header and request.headers.get(header):
+        return f"key:{request.headers[header]}"
+    return f"ip:{request.remote_addr}"
+
+def too_many_requests(retry_after):
+    """429 response telling the client when to retry"""
+    response = jsonify({'error': 'Too many requests, please slow down', 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def rate_limited(view):
+    """Reject a client's requests beyond RATE_LIMIT_PER_MINUTE with 429 and Retry-After"""
+    @wraps(view)
+    def limited_view(*args, **kwargs):
+        if CONFIG['RATE_LIMIT_ENABLED']:
+            retry_after = math.ceil(rate_limiter.hit(client_key()))
+            if retry_after:
+                return too_many_requests(retry_after)
+        return view(*args, **kwargs)
+    return limited_view
+
+def with_queue_position(job_id, progress):
+    """Add the live queue position to a queued job's progress"""
+    if progress.get('status') == 'queued':
+        position = job_queue.position(job_id)
+        if position is not None:
+            progress = dict(progress, queue_position=position,
+                            message=f'Waiting in queue (position {position})...')
+    return progress
+
+def job_snapshot(kind, job_id):
+    """Current progress of a download or playlist as sent to clients"""
+    if kind == 'playlist':
+        record = playlist_progress.get(job_id)
+        progress = record.to_dict() if record else {
+            'status': 'not_found',
+            'overall_percentage': 0,
+            'message': 'Playlist not found'
+        }
+    else:
+        record = download_progress.get(job_id)
+        progress = record.to_dict() if record else {
+            'status': 'not_found',
+            'percentage': 0,
+            'message': 'Download not found'
+        }
+    return (record.version if record else 0), with_queue_position(job_id, progress)
+
+def progress_changes(jobs, since=0):
+    """Progress of every (kind, job_id) that changed after cursor `since`
+    
+    Returns (cursor, changes). The cursor is read before the records, so a
+    change racing with the snapshot is reported again on the next call rather
+    than lost. Queued jobs are always included because their queue position
+    moves without a new record version; unknown jobs are always included so
+    clients notice expired ids.
+    """
+    cursor = progress_notifier.version
+    changes = {'downloads': {}, 'playlists': {}}
+    for kind, job_id in jobs:
+        version, progress = job_snapshot(kind, job_id)
+        if version > since or progress.get('status') in ('queued', 'not_found'):
+            changes[kind + 's'][job_id] = progress
+    return cursor, changes
+
+SSE_KEEPALIVE_EVENT = ": keep-alive\n\n"
+
+def event_stream_jobs(args):
+    """(kind, job_id) pairs requested in /events query args; returns (jobs, error)"""
+    jobs = [
+        (kind, job_id)
+        for kind, param in (('download', 'downloads'), ('playlist', 'playlists'))
+        for job_id in args.get(param, '').split(',')
+        if job_id
+    ]
+    if not jobs:
+        return None, 'Pass downloads and/or playlists as comma-separated ids'
+    if len(jobs) > CONFIG['SSE_MAX_JOBS']:
+        return None, f"At most {CONFIG['SSE_MAX_JOBS']} jobs per stream"
+    return jobs, None
+
+def needs_snapshot(job, sent, changed):
+    """Whether changed_progress_events() has to read a watched (kind, job_id) again"""
+    last = sent.get(job)
+    return last is None or changed is None or (job[0] + 's', job[1]) in changed or last[1] == 'queued'
+
+def changed_progress_events(jobs, sent, changed=None):
+    """SSE events for jobs that changed since the signatures in `sent`
+    
+    `changed` is the set of (store, job_id) written since the last call, as
+    from progress_notifier.changes_since(), so only those jobs are read
+    again; None reads every job. Queued jobs are always read, since their
+    queue position moves with other jobs. Updates `sent` and returns
+    (events, finished); once every job is finished or unknown the events end
+    with 'done'.
+    """
+    events = []
+    finished = 0
+    for kind, job_id in jobs:
+        last = sent.get((kind, job_id))
+        if needs_snapshot((kind, job_id), sent, changed):
+            version, progress = job_snapshot(kind, job_id)
+            signature = (version, progress.get('queue_position'))
+            status = progress.get('status')
+            if last is None or last[0] != signature:
+                payload = json.dumps({'type': kind, 'id': job_id, 'progress': progress})
+                events.append(f"event: progress\ndata: {payload}\n\n")
+            sent[(kind, job_id)] = signature, status
+        else:
+            status = last[1]
+        if status in ProgressStore.TERMINAL_STATUSES + ('not_found',):
+            finished += 1
+    
+    if finished == len(jobs):
+        events.append("event: done\ndata: {}\n\n")
+        return events, True
+    return events, False
+
+def stream_progress_events(jobs):
+    """Server-Sent Events stream of progress changes for (kind, job_id) pairs
+    
+    Each job's progress is sent once up front and then again only when it
+    changes. The stream ends when every job is finished or unknown; between
+    changes it just sends a keep-alive comment every SSE_KEEPALIVE seconds.
+    """
+    sent = {}
+    seen_version, changed = progress_notifier.version, None
+    while True:
+        events, finished = changed_progress_events(jobs, sent, changed)
+        yield from events
+        if finished:
+            return
+        
+        while progress_notifier.wait(seen_version, CONFIG['SSE_KEEPALIVE']) == seen_version:
+            yield SSE_KEEPALIVE_EVENT
+        seen_version, changed = progress_notifier.changes_since(seen_version)
+
+def content_disposition(filename):
+    return f"attachment; filename*=UTF-8''{quote(filename)}"
+
+def serve_artifact(file_path, filename):
+    """Send a finished file with Range, ETag and Last-Modified support
+    
+    With SENDFILE_OFFLOAD set, the transfer is handed to the front proxy
+    (X-Sendfile or nginx X-Accel-Redirect) instead of going through Python.
+    Otherwise send_file hands the open file to the server's wsgi.file_wrapper,
+    which uses os.sendfile where the server supports it.
+    """
+    if CONFIG['SENDFILE_OFFLOAD'] == 'x-accel-redirect':
+        relative_path = os.path.relpath(file_path, CONFIG['DOWNLOAD_DIR'])
+        response = Response()
+        response.headers['X-Accel-Redirect'] = CONFIG['X_ACCEL_PREFIX'].rstrip('/') + '/' + quote(relative_path)
+        response.headers['Content-Disposition'] = content_disposition(filename)
+        return response
+    
+    return send_file(file_path, as_attachment=True, download_name=filename, conditional=True, etag=True)
+
+def after_sent(chunks, callback):
+    """Yield chunks, then call callback; it is skipped if the client disconnects first"""
+    yield from chunks
+    callback()
+
+def serve_zip_archive(file_paths, zip_filename, on_complete=None):
+    """Send a finished playlist archive with Range, ETag and Last-Modified support
+    
+    on_complete is called once a response reaching the end of the archive
+    has been sent in full.
+    """
+    segments, entries = zip_layout(file_paths)
+    total = sum(len(s) if isinstance(s, bytes) else s[1] for s in segments)
+    etag = hashlib.sha256(
+        '|'.join(f"{e.name!r}:{e.size}:{e.mtime_ns}" for e in entries).encode('utf-8')
+    ).hexdigest()[:32]
+    last_modified = datetime.fromtimestamp(
+        max((e.mtime_ns for e in entries), default=0) // 10 ** 9, timezone.utc
+    )
+    
+    headers = {
+        'Content-Disposition': f'attachment; filename="{zip_filename}"',
+        'Accept-Ranges': 'bytes',
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(last_modified)
+    }
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return Response(status=304, headers=headers)
+    
+    # If-Range: only honour the range if the client's partial copy is still current
+    if_range = request.if_range
+    if if_range.etag:
+        range_allowed = if_range.etag == etag
+    elif if_range.date:
+        range_allowed = if_range.date >= last_modified
+    else:
+        range_allowed = True
+    
+    start, stop, status = 0, total, 200
+    range_header = request.range
+    if range_header and range_allowed:
+        if len(range_header.ranges) == 1:
+            bounds = range_header.range_for_length(total)
+            if bounds is None:
+                headers['Content-Range'] = f'bytes */{total}'
+                return Response(status=416, headers=headers)
+            start, stop = bounds
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{total}'
+    
+    headers['Content-Length'] = str(stop - start)
+    body = iter_segments(segments, start, stop)
+    if on_complete and stop == total:
+        body = after_sent(body, on_complete)
+    return Response(body, status=status,
+                    mimetype='application/zip', headers=headers)
+
 # Flask Routes
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route('/download', methods=['POST'])
+@rate_limited
 def download():
     try:
         data = request.get_json()
@@ -559,26 +4144,47 @@ def download():
         # Generate download ID
         download_id = str(uuid.uuid4())
         
-        # Start download in background thread
-        thread = threading.Thread(
-            target=download_single_track,
-            args=(url, download_id),
-            daemon=True
-        )
-        thread.start()
+        # Attach to a running download of the same media instead of fetching it again
+        media_id = canonical_media_id(url)
+        existing_id = claim_inflight(media_id, download_id)
+        if existing_id:
+            return jsonify({
+                'download_id': existing_id,
+                'message': f'Joined download already in progress from {platform_info["name"]}',
+                'platform': platform_info['name'],
+                'platform_notes': platform_info['notes'],
+                'coalesced': True
+            })
+        
+        # Queue the download job
+        download_progress[download_id] = {
+            'status': 'queued',
+            'percentage': 0,
+            'message': 'Waiting in queue...'
+        }
+        try:
+            job_queue.submit(download_id, run_single_download, url, download_id, media_id)
+        except QueueFullError:
+            download_progress.pop(download_id, None)
+            release_inflight(media_id, download_id)
+            raise
         
         return jsonify({
             'download_id': download_id,
             'message': f'Download started from {platform_info["name"]}',
             'platform': platform_info['name'],
-            'platform_notes': platform_info['notes']
+            'platform_notes': platform_info['notes'],
+            'coalesced': False
         })
         
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         logger.error(f"Download endpoint error: {e}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/download_playlist', methods=['POST'])
+@rate_limited
 def download_playlist_route():
     try:
         data = request.get_json()
@@ -601,45 +4207,243 @@ def download_playlist_route():
                 'error': 'This does not appear to be a playlist URL. Please use the "Download Single" button instead.',
                 'is_playlist': False
             }), 400
+        
+        # Optional track range, and sync mode downloading only tracks not fetched before
+        try:
+            selection = PlaylistSelection.from_request(data)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid playlist range: {e}'}), 400
+        options = {}
+        if selection is not None:
+            options['items'] = selection.items
+        sync_id = data.get('sync')
+        if sync_id is not None:
+            if not isinstance(sync_id, str) or not sync_id.strip() or len(sync_id) > 128:
+                return jsonify({'error': 'sync must be a sync id of 1 to 128 characters'}), 400
+            if playlist_archive is None:
+                return jsonify({'error': 'Sync mode needs JOURNAL_DB or STATE_DB'}), 400
+            options['sync'] = sync_id.strip()
             
         # Generate playlist ID
         playlist_id = str(uuid.uuid4())
         
-        # Start playlist download in background thread
-        thread = threading.Thread(
-            target=download_playlist,
-            args=(url, playlist_id),
-            daemon=True
-        )
-        thread.start()
+        # Attach to a running download of the same playlist, range and mode
+        media_id = canonical_media_id(url)
+        if options:
+            media_id = f"{media_id}|{json.dumps(options, sort_keys=True)}"
+        existing_id = claim_inflight(media_id, playlist_id)
+        if existing_id:
+            return jsonify({
+                'playlist_id': existing_id,
+                'message': 'Joined playlist download already in progress',
+                'platform': 'detected',
+                'coalesced': True
+            })
+        
+        # Queue the playlist job
+        playlist_progress[playlist_id] = {
+            'status': 'queued',
+            'overall_percentage': 0,
+            'completed_tracks': 0,
+            'total_tracks': 0,
+            'tracks': {},
+            'message': 'Waiting in queue...'
+        }
+        try:
+            args = (url, playlist_id, media_id) + ((None, options) if options else ())
+            job_queue.submit(playlist_id, run_playlist_download, *args)
+        except QueueFullError:
+            playlist_progress.pop(playlist_id, None)
+            release_inflight(media_id, playlist_id)
+            raise
         
         return jsonify({
             'playlist_id': playlist_id,
             'message': 'Playlist download started',
-            'platform': 'detected'
+            'platform': 'detected',
+            'coalesced': False,
+            'items': options.get('items'),
+            'sync': options.get('sync'),
+            'manifest_url': f'/download_playlist/{playlist_id}/manifest'
         })
         
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         logger.error(f"Playlist download endpoint error: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/download/batch', methods=['POST'])
+def download_batch():
+    """Queue many single-track URLs as one job
+    
+    Each URL is checked on its own: valid ones are accepted, the rest are
+    returned with the reason, and the request only fails if none is valid.
+    The batch runs like a playlist, so it has one progress record and one
+    ZIP, and each track can also be fetched on its own. Every accepted URL
+    counts as one submission against the rate limit; URLs beyond the
+    client's remaining allowance are rejected.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        urls = data.get('urls')
+        if not isinstance(urls, list) or not urls:
+            return jsonify({'error': 'urls must be a non-empty list'}), 400
+        if len(urls) > CONFIG['BATCH_MAX_URLS']:
+            return jsonify({'error': f"At most {CONFIG['BATCH_MAX_URLS']} URLs per batch"}), 400
+        
+        batch_id = str(uuid.uuid4())
+        accepted, rejected, seen = [], [], {}
+        for index, url in enumerate(urls):
+            url = url.strip() if isinstance(url, str) else url
+            is_valid, message = validate_url(url)
+            if is_valid and is_playlist_url(url):
+                is_valid, message = False, 'Playlist URLs must be submitted to /download_playlist'
+            if is_valid:
+                normalized = normalize_url(url)
+                if normalized in seen:
+                    is_valid, message = False, f"Duplicate of URL {seen[normalized]}"
+            if not is_valid:
+                rejected.append({'index': index, 'url': url, 'error': message})
+                continue
+            seen[normalized] = index
+            accepted.append({
+                'index': index,
+                'url': url,
+                'download_id': f"{batch_id}_track_{len(accepted)}"
+            })
+        
+        if CONFIG['RATE_LIMIT_ENABLED']:
+            # A batch of only invalid URLs still costs a request, like an invalid /download
+            granted, retry_after = rate_limiter.take(client_key(), max(len(accepted), 1))
+            retry_after = math.ceil(retry_after)
+            if not granted:
+                return too_many_requests(retry_after)
+            if granted < len(accepted):
+                rejected.extend(
+                    {'index': item['index'], 'url': item['url'],
+                     'error': f"Rate limit reached, retry in {retry_after} seconds"}
+                    for item in accepted[granted:]
+                )
+                rejected.sort(key=lambda item: item['index'])
+                accepted = accepted[:granted]
+        
+        if not accepted:
+            return jsonify({'error': 'No valid URLs in batch', 'rejected': rejected}), 400
+        
+        playlist_progress[batch_id] = {
+            'status': 'queued',
+            'overall_percentage': 0,
+            'completed_tracks': 0,
+            'total_tracks': len(accepted),
+            'tracks': {},
+            'message': 'Waiting in queue...'
+        }
+        try:
+            job_queue.submit(batch_id, run_batch_download, [item['url'] for item in accepted], batch_id)
+        except QueueFullError:
+            playlist_progress.pop(batch_id, None)
+            raise
+        
+        logger.info(f"Queued batch {batch_id}: {len(accepted)} accepted, {len(rejected)} rejected")
+        return jsonify({
+            'batch_id': batch_id,
+            'accepted': accepted,
+            'rejected': rejected,
+            'progress_url': f"/playlist_progress/{batch_id}",
+            'archive_url': f"/download_playlist/{batch_id}",
+            'message': f"Queued {len(accepted)} of {len(urls)} URLs"
+        })
+        
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except Exception as e:
+        logger.error(f"Batch download endpoint error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/pipeline_stats')
+def get_pipeline_stats():
+    """Queue depth and timing for the job queue and each pipeline stage"""
+    return jsonify({
+        'jobs': job_queue.stats(),
+        'stages': {stage.name: stage.stats() for stage in (download_stage, transcode_stage)},
+        'extraction': dict(extraction_stats),
+        'cache': result_cache.stats(),
+        'partials': partial_downloads.stats(),
+        'retries': retry_summary(),
+        'breakers': {name: breaker.stats() for name, breaker in list(circuit_breakers.items())},
+        'rate_limit': rate_limiter.stats(),
+        'url_cache': url_classifier.stats(),
+        'ydl_pool': ydl_pool.stats(),
+        'bandwidth': {
+            name or 'total': {'rate': bucket.rate, 'throttled_seconds': round(bucket.throttled_seconds, 3)}
+            for name, bucket in list(bandwidth_buckets.items())
+        },
+        'janitor': janitor.stats(),
+        'progress': {
+            'downloads': download_progress.stats(),
+            'playlists': playlist_progress.stats()
+        }
+    })
+
 @app.route('/progress/<download_id>')
 def get_progress(download_id):
-    progress = download_progress.get(download_id, {
-        'status': 'not_found',
-        'percentage': 0,
-        'message': 'Download not found'
-    })
-    return jsonify(progress)
+    return jsonify(job_snapshot('download', download_id)[1])
 
 @app.route('/playlist_progress/<playlist_id>')
 def get_playlist_progress(playlist_id):
-    progress = playlist_progress.get(playlist_id, {
-        'status': 'not_found',
-        'overall_percentage': 0,
-        'message': 'Playlist not found'
-    })
-    return jsonify(progress)
+    return jsonify(job_snapshot('playlist', playlist_id)[1])
+
+@app.route('/progress/batch', methods=['POST'])
+def get_progress_batch():
+    """Progress for many downloads and playlists in one request
+    
+    Pass the `cursor` from the previous response as `since` (or send the
+    previous ETag in If-None-Match) to get only the jobs that changed; 304
+    when nothing did.
+    """
+    data = request.get_json(silent=True) or {}
+    downloads = data.get('downloads') or []
+    playlists = data.get('playlists') or []
+    if not isinstance(downloads, list) or not isinstance(playlists, list):
+        return jsonify({'error': 'downloads and playlists must be lists of ids'}), 400
+    
+    jobs = [('download', str(job_id)) for job_id in downloads] + [('playlist', str(job_id)) for job_id in playlists]
+    if not jobs:
+        return jsonify({'error': 'downloads and/or playlists are required'}), 400
+    if len(jobs) > CONFIG['PROGRESS_BATCH_MAX_JOBS']:
+        return jsonify({'error': f"At most {CONFIG['PROGRESS_BATCH_MAX_JOBS']} jobs per request"}), 400
+    
+    since = data.get('since')
+    if since is None and request.if_none_match:
+        etags = request.if_none_match.as_set()
+        since = max((int(tag) for tag in etags if tag.isdigit()), default=None)
+    try:
+        since = int(since or 0)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'since must be an integer cursor'}), 400
+    
+    cursor, changes = progress_changes(jobs, since)
+    if since and not changes['downloads'] and not changes['playlists']:
+        response = Response(status=304)
+    else:
+        response = jsonify({'cursor': cursor, **changes})
+    response.set_etag(str(cursor))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/events')
+def progress_events():
+    """Push progress for many jobs over one Server-Sent Events stream"""
+    jobs, error = event_stream_jobs(request.args)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    return Response(
+        stream_progress_events(jobs),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/download_file/<download_id>')
 def download_file(download_id):
@@ -655,19 +4459,14 @@ def download_file(download_id):
         if not file_path or not os.path.exists(file_path):
             return jsonify({'error': 'File not found'}), 404
             
-        # Schedule file cleanup
-        def cleanup_file():
-            time.sleep(CONFIG['CLEANUP_DELAY'])
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    logger.info(f"Cleaned up file: {file_path}")
-            except Exception as e:
-                logger.error(f"Failed to cleanup file: {e}")
-                
-        threading.Thread(target=cleanup_file, daemon=True).start()
+        # Schedule file cleanup; fetching again just moves the deadline.
+        # A playlist's tracks are still needed for its ZIP and expire with it.
+        if not progress.get('playlist_id'):
+            expire_download(download_id, file_path, CONFIG['CLEANUP_DELAY'])
+        if playlist_archive is not None:
+            playlist_archive.deliver(track=download_id)
         
-        return send_file(file_path, as_attachment=True, download_name=filename)
+        return serve_artifact(file_path, filename)
         
     except Exception as e:
         logger.error(f"File download error: {e}")
@@ -675,39 +4474,110 @@ def download_file(download_id):
 
 @app.route('/download_playlist/<playlist_id>')
 def download_playlist_file(playlist_id):
+    """Stream the playlist ZIP, starting before the last track has finished"""
     try:
         progress = playlist_progress.get(playlist_id)
+        files = playlist_files.get(playlist_id)
+        if files is None and state_db:
+            # The playlist ran on another node
+            files = StoredPlaylistFiles(playlist_id)
         
-        if not progress or progress.get('status') != 'completed':
-            return jsonify({'error': 'Playlist download not completed or not found'}), 404
-            
-        zip_path = progress.get('zip_path')
-        zip_filename = progress.get('zip_filename')
+        if not progress or progress.get('status') not in ('downloading', 'completed', 'partial') or files is None:
+            return jsonify({'error': 'Playlist download not started or not found'}), 404
         
-        if not zip_path or not os.path.exists(zip_path):
-            return jsonify({'error': 'ZIP file not found'}), 404
-            
-        # Schedule ZIP cleanup
-        def cleanup_zip():
-            time.sleep(CONFIG['CLEANUP_DELAY'])
-            try:
-                if os.path.exists(zip_path):
-                    os.remove(zip_path)
-                    logger.info(f"Cleaned up ZIP file: {zip_path}")
-            except Exception as e:
-                logger.error(f"Failed to cleanup ZIP file: {e}")
-                
-        threading.Thread(target=cleanup_zip, daemon=True).start()
+        zip_filename = progress.get('zip_filename', f"playlist_{playlist_id}.zip")
         
-        return send_file(zip_path, as_attachment=True, download_name=zip_filename)
+        def delivered():
+            # Sync entries count as received once the client has the whole archive
+            if playlist_archive is not None:
+                playlist_archive.deliver(job=playlist_id)
+        
+        if progress.get('status') in ('completed', 'partial'):
+            expire_playlist(playlist_id, CONFIG['CLEANUP_DELAY'])
+            # The archive layout is fixed now, so it can be resumed with Range requests
+            return serve_zip_archive([file_path for file_path in files if file_path], zip_filename, delivered)
+        
+        # No Content-Length, so the archive goes out with chunked transfer encoding
+        return Response(
+            after_sent(stream_zip(files), delivered),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename="{zip_filename}"'}
+        )
         
     except Exception as e:
         logger.error(f"Playlist file download error: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/download_playlist/<playlist_id>/manifest')
+def playlist_manifest(playlist_id):
+    """Tracks of a playlist job with their status and per-track download URLs
+    
+    For a sync run these are the new tracks only, so a mirror can fetch them
+    one by one instead of as a ZIP.
+    """
+    progress = playlist_progress.get(playlist_id)
+    if not progress:
+        return jsonify({'error': 'Playlist not found'}), 404
+    
+    tracks = []
+    for index in range(progress.get('total_tracks') or 0):
+        download_id = f"{playlist_id}_track_{index}"
+        record = download_progress.get(download_id)
+        track = {'index': index, 'download_id': download_id, 'status': record.get('status') if record else 'pending'}
+        if record:
+            for key in ('title', 'artist', 'filename', 'error'):
+                if record.get(key):
+                    track[key] = record.get(key)
+            if track['status'] == 'completed':
+                track['download_url'] = f'/download_file/{download_id}'
+        tracks.append(track)
+    
+    return jsonify({
+        'playlist_id': playlist_id,
+        'status': progress.get('status'),
+        'playlist_title': progress.get('playlist_title'),
+        'total_tracks': progress.get('total_tracks') or 0,
+        'completed_tracks': progress.get('completed_tracks') or 0,
+        'skipped_tracks': progress.get('skipped_tracks'),
+        'tracks': tracks
+    })
+
+def watch_shared_state():
+    """Wake local progress streams when other nodes write progress"""
+    while True:
+        try:
+            # The version first: records saved after it are reported again next time
+            version = state_db.version()
+            since = progress_notifier.version
+            if version > since:
+                progress_notifier.observe(version, download_progress.backend.changed_since(since)
+                                          + playlist_progress.backend.changed_since(since))
+        except sqlite3.Error as e:
+            logger.error(f"Could not read shared state version: {e}")
+        time.sleep(CONFIG['STATE_POLL_INTERVAL'])
+
+def start_services():
+    """Start the background threads this node's ROLE needs"""
+    # Every role maps URLs to media ids, for job claims and the result cache
+    warm_extractors()
+    open_journal()
+    if CONFIG['ROLE'] != 'api':
+        # Before the janitor starts, so it does not expire the tracks being resumed
+        resume_interrupted_playlists()
+    janitor.start()
+    if state_db:
+        logger.info(f"Sharing state through {CONFIG['STATE_DB']} as role {CONFIG['ROLE']} ({NODE_ID})")
+        threading.Thread(target=watch_shared_state, name='state-watcher', daemon=True).start()
+    if CONFIG['ROLE'] != 'api':
+        # Build the YoutubeDL instances while the first jobs are being queued
+        threading.Thread(target=ydl_pool.warm, name='ydl-warmup', daemon=True).start()
+        job_queue.start()
+
 if __name__ == '__main__':
     logger.info("Starting MP3 Downloader...")
     logger.info(f"Download directory: {CONFIG['DOWNLOAD_DIR']}")
     logger.info(f"Audio format: {CONFIG['AUDIO_FORMAT']} at {CONFIG['AUDIO_QUALITY']}kbps")
     
+    start_services()
+    
     app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
\ No newline at end of file
@@ -1,15 +1,60 @@
+import asyncio
+import io
+import json
 import unittest
 import tempfile
 import os
+import shutil
 import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch, MagicMock
 
 # Add parent directory to path for imports
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import asgi
+import main
 from main import app, detect_platform, get_ydl_opts, add_metadata
 from config import *
 
+def make_temp_dir(test):
+    """Temporary directory removed once the test has finished"""
+    path = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, path, ignore_errors=True)
+    return path
+
+def fake_finish_track(directory, name='{job.track_index:02d}.mp3', finished=None, complete=False):
+    """side_effect for main.finish_track that writes a small file instead of transcoding
+    
+    `name` is formatted with the job. Jobs are appended to `finished`, and
+    with `complete` the track is recorded as completed like the real stage.
+    """
+    def finish(job):
+        if finished is not None:
+            finished.append(job)
+        path = os.path.join(directory, name.format(job=job))
+        with open(path, 'wb') as f:
+            f.write(b'audio')
+        if complete:
+            main.complete_track(job, path)
+        return path
+    return finish
+
+def fake_ydl(mock_ydl, info=None):
+    """The YoutubeDL a patched yt_dlp.YoutubeDL yields, to the fetch pool and playlist listing alike"""
+    ydl = mock_ydl.return_value.__enter__.return_value
+    ydl.params = {}
+    if info is not None:
+        ydl.extract_info.return_value = info
+    return ydl
+
+def fresh_ydl_pool():
+    """Patch in a pool that builds its YoutubeDL from the current yt_dlp.YoutubeDL"""
+    return patch('main.ydl_pool', main.YoutubeDLPool(1, 100))
+
 class TestMP3Downloader(unittest.TestCase):
     
     def setUp(self):
@@ -136,6 +181,1813 @@ class TestMP3Downloader(unittest.TestCase):
         finally:
             os.unlink(temp_path)
 
+class TestURLClassifier(unittest.TestCase):
+    """Test URL validation, platform lookup and playlist detection."""
+    
+    def test_domains_match_on_label_boundaries(self):
+        """Subdomains find their platform; lookalike domains do not."""
+        names = {url: detect_platform(url)['name'] for url in (
+            'https://m.youtube.com/watch?v=x',
+            'https://music.youtube.com/watch?v=x',
+            'https://www.youtube.com:443/watch?v=x',
+            'https://notyoutube.com/watch?v=x',
+            'https://youtube.com.evil.example/watch?v=x',
+        )}
+        self.assertEqual(list(names.values()),
+                         ['YouTube', 'YouTube Music', 'YouTube', 'Unknown Platform', 'Unknown Platform'])
+        self.assertEqual(detect_platform(None)['name'], 'Invalid URL')
+    
+    def test_playlist_patterns_are_per_platform(self):
+        """Playlist detection uses the platform's own pattern, else the generic markers."""
+        self.assertTrue(main.is_playlist_url('https://www.youtube.com/watch?v=x&list=PL1'))
+        self.assertTrue(main.is_playlist_url('https://soundcloud.com/someone/sets/album'))
+        self.assertFalse(main.is_playlist_url('https://soundcloud.com/artist/track'))
+        self.assertTrue(main.is_playlist_url('https://example.com/album/1'))
+    
+    def test_results_are_cached(self):
+        """Repeated URLs are served from the LRU."""
+        classifier = main.URLClassifier(main.PLATFORM_SUPPORT, cache_size=2)
+        for url in ('https://youtu.be/a', 'https://youtu.be/a', 'https://youtu.be/b'):
+            classifier.classify(url)
+        self.assertEqual(classifier.stats(), {'hits': 1, 'misses': 2, 'entries': 2})
+        self.assertFalse(classifier.classify('ftp://youtu.be/a').well_formed)
+
+class TestPlaylistScheduling(unittest.TestCase):
+    """Test the track pipeline used by single downloads and playlists."""
+    
+    def setUp(self):
+        self.download_dir = make_temp_dir(self)
+        self.config_patch = patch.dict(main.CONFIG, {'DOWNLOAD_DIR': self.download_dir})
+        self.config_patch.start()
+    
+    def tearDown(self):
+        self.config_patch.stop()
+    
+    def _mock_playlist(self, mock_ydl, count):
+        fake_ydl(mock_ydl, {
+            'title': 'Test Playlist',
+            'entries': [{'id': str(i), 'url': f'https://www.youtube.com/watch?v={i}'} for i in range(count)]
+        })
+    
+    @patch('main.yt_dlp.YoutubeDL')
+    def test_playlist_tracks_run_concurrently_within_limit(self, mock_ydl):
+        """Tracks run in parallel, never beyond MAX_CONCURRENT_DOWNLOADS, and keep ZIP order."""
+        self._mock_playlist(mock_ydl, 8)
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+        
+        def fake_fetch(job):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            # Later tracks finish first to check that ordering is by index
+            time.sleep(0.01 * (8 - job.track_index))
+            with lock:
+                state['running'] -= 1
+        
+        with patch('main.fetch_track', side_effect=fake_fetch), \
+                patch('main.finish_track', side_effect=fake_finish_track(self.download_dir)):
+            main.download_playlist('https://www.youtube.com/playlist?list=x', 'pl-test')
+        
+        progress = main.playlist_progress['pl-test']
+        self.assertEqual(progress['status'], 'completed')
+        self.assertEqual(progress['completed_tracks'], 8)
+        self.assertGreater(state['peak'], 1)
+        self.assertLessEqual(state['peak'], main.CONFIG['MAX_CONCURRENT_DOWNLOADS'])
+        response = app.test_client().get('/download_playlist/pl-test')
+        with zipfile.ZipFile(io.BytesIO(response.data)) as zipf:
+            self.assertEqual(zipf.namelist(), [f'{i:02d}.mp3' for i in range(8)])
+    
+    @patch('main.yt_dlp.YoutubeDL')
+    def test_playlist_downloads_while_listing(self, mock_ydl):
+        """Tracks start before the listing ends, which only runs a window ahead of finished tracks."""
+        first_fetch = threading.Event()
+        finished = []
+        state = {'ahead': 0, 'waited': None}
+    
+        def listing():
+            for i in range(10):
+                state['ahead'] = max(state['ahead'], i - len(finished))
+                yield {'id': str(i), 'url': f'https://www.youtube.com/watch?v=lazy{i}'}
+                if i == 0:
+                    state['waited'] = first_fetch.wait(5)
+    
+        fake_ydl(mock_ydl, {'title': 'Lazy', 'playlist_count': None, 'entries': listing()})
+        finish = fake_finish_track(self.download_dir, 'lazy{job.track_index:02d}.mp3', finished)
+        with patch.dict(main.CONFIG, {'PLAYLIST_TRACK_WINDOW': 2}), patch('main.playlist_journal', None), \
+                patch('main.fetch_track', side_effect=lambda job: first_fetch.set()), \
+                patch('main.finish_track', side_effect=finish):
+            main.download_playlist('https://www.youtube.com/playlist?list=lazy', 'pl-lazy')
+    
+        self.assertTrue(state['waited'])
+        self.assertLessEqual(state['ahead'], 3)
+        progress = main.playlist_progress['pl-lazy']
+        self.assertEqual((progress['status'], progress['completed_tracks'], progress['total_tracks']),
+                         ('completed', 10, 10))
+        self.assertEqual(len(main.playlist_files['pl-lazy'].ready()), 10)
+    
+    def test_paged_entries_are_fetched_on_demand(self):
+        """Paged listings are read one page at a time as entries are consumed."""
+        pages = []
+    
+        def get_page(n):
+            pages.append(n)
+            return [{'id': str(n * 100 + i)} for i in range(100 if n < 2 else 30)]
+    
+        entries = main.iter_playlist_entries(main.yt_dlp.utils.OnDemandPagedList(get_page, 100))
+        self.assertEqual(next(entries)['id'], '0')
+        self.assertEqual(pages, [0])
+        self.assertEqual(sum(1 for _ in entries), 229)
+        self.assertEqual(pages, [0, 1, 2])
+    
+    def test_batch_route_accepts_valid_urls(self):
+        """Invalid, playlist and duplicate URLs are rejected individually; the rest are queued as one job."""
+        urls = [
+            'https://www.youtube.com/watch?v=batch1',
+            'not a url',
+            'https://soundcloud.com/someone/sets/album',
+            'https://youtube.com/watch?v=batch1',
+            'https://soundcloud.com/someone/track',
+        ]
+        with patch('main.job_queue.submit') as submit:
+            response = app.test_client().post('/download/batch', json={'urls': urls})
+        
+        data = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['index'] for item in data['accepted']], [0, 4])
+        self.assertEqual([item['index'] for item in data['rejected']], [1, 2, 3])
+        self.assertEqual(data['accepted'][1]['download_id'], f"{data['batch_id']}_track_1")
+        submit.assert_called_once_with(data['batch_id'], main.run_batch_download, [urls[0], urls[4]], data['batch_id'])
+        
+        response = app.test_client().post('/download/batch', json={'urls': ['not a url']})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(response.get_json()['rejected']), 1)
+    
+    def test_batch_downloads_as_one_playlist(self):
+        """A batch shares one progress record and one ZIP, without extracting a playlist."""
+        urls = ['https://soundcloud.com/a/one', 'https://soundcloud.com/a/two']
+        finish = fake_finish_track(self.download_dir, 'batch{job.track_index}.mp3')
+        with patch('main.playlist_journal', None), patch('main.yt_dlp.YoutubeDL') as mock_ydl, \
+                patch('main.fetch_track', return_value=None), patch('main.finish_track', side_effect=finish):
+            main.run_batch_download(urls, 'batch-run')
+        
+        mock_ydl.assert_not_called()
+        progress = main.playlist_progress['batch-run']
+        self.assertEqual((progress['status'], progress['completed_tracks']), ('completed', 2))
+        response = app.test_client().get('/download_playlist/batch-run')
+        with zipfile.ZipFile(io.BytesIO(response.data)) as zipf:
+            self.assertEqual(zipf.namelist(), ['batch0.mp3', 'batch1.mp3'])
+    
+    def test_zip_streams_before_playlist_finishes(self):
+        """ZIP bytes are produced as tracks finish, with STORED entries in track order."""
+        files = main.PlaylistFiles()
+        files.set_total(3)
+        paths = []
+        for i in range(3):
+            path = os.path.join(self.download_dir, f'track{i}.mp3')
+            with open(path, 'wb') as f:
+                f.write(bytes([i]) * 1000)
+            paths.append(path)
+        
+        stream = main.stream_zip(files)
+        files.add(1, paths[1])
+        files.add(0, paths[0])
+        # Track 0 is available, so data flows while track 2 is still pending
+        first_chunk = next(stream)
+        self.assertTrue(first_chunk.startswith(b'PK'))
+        
+        files.add(2, paths[2])
+        files.finish()
+        data = first_chunk + b''.join(stream)
+        with zipfile.ZipFile(io.BytesIO(data)) as zipf:
+            self.assertEqual(zipf.namelist(), ['track0.mp3', 'track1.mp3', 'track2.mp3'])
+            self.assertTrue(all(info.compress_type == zipfile.ZIP_STORED for info in zipf.infolist()))
+            self.assertEqual(zipf.read('track2.mp3'), bytes([2]) * 1000)
+
+    def test_failed_fetch_skips_transcode(self):
+        """A download-stage failure is recorded and never reaches the transcode stage."""
+        finish = MagicMock()
+        with patch('main.fetch_track', side_effect=Exception('Video unavailable')), \
+                patch('main.finish_track', finish):
+            result = main.download_single_track('https://www.youtube.com/watch?v=x', 'dl-fail')
+        
+        self.assertIsNone(result)
+        finish.assert_not_called()
+        self.assertEqual(main.download_progress['dl-fail']['status'], 'error')
+        self.assertIn('not available', main.download_progress['dl-fail']['error'])
+    
+    def test_stuck_conversion_fails_the_track(self):
+        """FFmpeg is killed after FFMPEG_TIMEOUT and the track ends with an error."""
+        ffmpeg = os.path.join(self.download_dir, 'ffmpeg')
+        with open(ffmpeg, 'w') as f:
+            f.write('#!/bin/sh\nexec sleep 30\n')
+        os.chmod(ffmpeg, 0o755)
+        
+        def fake_fetch(job):
+            job.temp_dir = self.download_dir
+            job.source_path = os.path.join(self.download_dir, 'stuck.webm')
+            with open(job.source_path, 'wb') as f:
+                f.write(b'audio')
+        
+        started = time.monotonic()
+        with patch.dict(main.CONFIG, {'FFMPEG_PATH': ffmpeg, 'FFMPEG_TIMEOUT': 0.2}), \
+                patch('main.fetch_track', side_effect=fake_fetch):
+            result = main.download_single_track('https://www.youtube.com/watch?v=stuck', 'dl-stuck')
+        
+        self.assertIsNone(result)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual(main.download_progress['dl-stuck']['status'], 'error')
+        self.assertIn('timed out', main.download_progress['dl-stuck']['error'])
+    
+    @patch('main.yt_dlp.YoutubeDL')
+    def test_fetch_resolves_each_url_once(self, mock_ydl):
+        """The download stage extracts and downloads in a single resolution."""
+        def fake_extract(url, download=False, ie_key=None):
+            with open(os.path.join(ydl.params['paths']['home'], 'Song.webm'), 'wb') as f:
+                f.write(b'audio')
+            return {'title': 'Song', 'uploader': 'Artist'}
+        
+        ydl = fake_ydl(mock_ydl)
+        ydl.extract_info.side_effect = fake_extract
+        job = main.TrackJob('https://www.youtube.com/watch?v=x', 'dl-once',
+                            entry={'ie_key': 'Youtube', 'title': 'Song'})
+        try:
+            with fresh_ydl_pool():
+                main.fetch_track(job)
+        finally:
+            main.cleanup_temp_dir(job.temp_dir)
+            main.release_partial(job, keep=False)
+        
+        # Other tests may have background jobs using the same mock
+        calls = [c for c in ydl.extract_info.call_args_list if c.args[0] == job.url]
+        self.assertEqual(calls, [unittest.mock.call(job.url, download=True, ie_key='Youtube')])
+        ydl.download.assert_not_called()
+        self.assertEqual((job.title, job.artist), ('Song', 'Artist'))
+    
+    def test_pipeline_stats_route(self):
+        """Per-stage queue depth and timings are exposed."""
+        data = app.test_client().get('/pipeline_stats').get_json()
+        self.assertIn('jobs', data)
+        for stage in ('download', 'transcode'):
+            self.assertIn('queued', data['stages'][stage])
+            self.assertIn('avg_seconds', data['stages'][stage])
+
+class TestPlaylistJournal(unittest.TestCase):
+    """Test resuming interrupted playlists from the journal."""
+    
+    def setUp(self):
+        self.download_dir = make_temp_dir(self)
+        self.journal = main.PlaylistJournal(main.StateDB(os.path.join(self.download_dir, 'journal.db')))
+        self.journal_patch = patch('main.playlist_journal', self.journal)
+        self.journal_patch.start()
+        self.entries = [{'id': str(i), 'url': f'https://www.youtube.com/watch?v=journal{i}', 'title': f'Song {i}'}
+                        for i in range(3)]
+        self.done_path = os.path.join(self.download_dir, '00.mp3')
+        with open(self.done_path, 'wb') as f:
+            f.write(b'audio')
+    
+    def tearDown(self):
+        self.journal_patch.stop()
+    
+    def _interrupt(self, playlist_id):
+        """Journal a run that finished track 0, failed track 1 and then died"""
+        self.journal.start(playlist_id, 'https://www.youtube.com/playlist?list=j', 'youtube:j')
+        self.journal.record_entries(playlist_id, 'Journaled', self.entries)
+        self.journal.record_track(playlist_id, 0, self.done_path)
+        self.journal.record_track(playlist_id, 1, None)
+    
+    def test_journal_opens_with_services_under_download_dir(self):
+        """Importing main opens no journal; start_services() opens it in DOWNLOAD_DIR."""
+        with patch('main.playlist_journal', None), patch('main.playlist_archive', None), \
+                patch.dict(main.CONFIG, {'DOWNLOAD_DIR': self.download_dir, 'JOURNAL_DB': None}):
+            main.open_journal()
+            self.assertEqual(main.playlist_journal.db.path, os.path.join(self.download_dir, '.state', 'journal.db'))
+            self.assertIs(main.playlist_archive.db, main.playlist_journal.db)
+    
+    def test_replay(self):
+        self._interrupt('pl-replay')
+        state = self.journal.replay('pl-replay')
+        self.assertEqual(state['url'], 'https://www.youtube.com/playlist?list=j')
+        self.assertEqual([entry['title'] for entry in state['entries']], ['Song 0', 'Song 1', 'Song 2'])
+        self.assertEqual(state['tracks'], {0: {'file_path': self.done_path}, 1: {'file_path': None}})
+        self.assertEqual(self.journal.interrupted(), ['pl-replay'])
+        
+        self.journal.finish('pl-replay')
+        self.assertIsNone(self.journal.replay('pl-replay'))
+        self.assertEqual(self.journal.interrupted(), [])
+    
+    def test_replay_entry_pages(self):
+        """Pages are concatenated; an unfinished listing is not complete and a new one starts over."""
+        self.journal.start('pl-pages', 'https://www.youtube.com/playlist?list=p', 'youtube:p')
+        self.journal.record_entries('pl-pages', 'Paged', self.entries[:2], 0, complete=False)
+        self.journal.record_entries('pl-pages', 'Paged', self.entries[2:], 2, complete=False)
+        state = self.journal.replay('pl-pages')
+        self.assertEqual([entry['id'] for entry in state['entries']], ['0', '1', '2'])
+        self.assertFalse(state['entries_complete'])
+    
+        self.journal.record_entries('pl-pages', 'Paged', self.entries[:1], 0, complete=True)
+        state = self.journal.replay('pl-pages')
+        self.assertEqual([entry['id'] for entry in state['entries']], ['0'])
+        self.assertTrue(state['entries_complete'])
+    
+    @patch('main.yt_dlp.YoutubeDL')
+    def test_resumed_playlist_skips_finished_tracks(self, mock_ydl):
+        """A resumed run reuses finished files, retries the rest and does not re-extract."""
+        self._interrupt('pl-resume')
+        fetched = []
+        finish = fake_finish_track(self.download_dir, finished=fetched)
+        
+        with patch('main.fetch_track', return_value=None), patch('main.finish_track', side_effect=finish):
+            main.run_playlist_download('https://www.youtube.com/playlist?list=j', 'pl-resume', 'youtube:j')
+        
+        mock_ydl.assert_not_called()
+        self.assertEqual(sorted(job.track_index for job in fetched), [1, 2])
+        progress = main.playlist_progress['pl-resume']
+        self.assertEqual((progress['status'], progress['completed_tracks']), ('completed', 3))
+        self.assertEqual(progress['playlist_title'], 'Journaled')
+        self.assertEqual(main.download_progress['pl-resume_track_0']['file_path'], self.done_path)
+        self.assertEqual(main.playlist_files['pl-resume'].ready(),
+                         [os.path.join(self.download_dir, f'{i:02d}.mp3') for i in range(3)])
+        self.assertIsNone(self.journal.replay('pl-resume'))
+    
+    def test_batch_resumes_after_crash(self):
+        """A batch that died mid-run is resumed from its journaled entries."""
+        urls = [f'https://soundcloud.com/a/crash{i}' for i in range(4)]
+        self.journal.start('batch-crash', 'batch:batch-crash', None)
+        with patch('main.submit_track', side_effect=KeyboardInterrupt), self.assertRaises(KeyboardInterrupt):
+            main.download_playlist('batch:batch-crash', 'batch-crash', [{'url': url} for url in urls])
+        state = self.journal.replay('batch-crash')
+        self.assertTrue(state['entries_complete'])
+        self.assertEqual([entry['url'] for entry in state['entries']], urls)
+        
+        fetched = []
+        finish = fake_finish_track(self.download_dir, 'crash{job.track_index}.mp3', fetched)
+        with patch('main.yt_dlp.YoutubeDL') as mock_ydl, patch('main.fetch_track', return_value=None), \
+                patch('main.finish_track', side_effect=finish):
+            main.run_playlist_download(state['url'], 'batch-crash', state['media_id'])
+        
+        mock_ydl.assert_not_called()
+        self.assertEqual(sorted(job.url for job in fetched), urls)
+        self.assertEqual(main.playlist_progress['batch-crash']['status'], 'completed')
+    
+    def test_listing_failure_leaves_a_partial_playlist(self):
+        """Tracks listed before the listing failed are delivered, and the journal keeps the listing open."""
+        url = 'https://www.youtube.com/playlist?list=broken'
+        
+        def listing(fail):
+            for i, entry in enumerate(self.entries):
+                if fail and i == 2:
+                    raise Exception('HTTP Error 500 on page 2')
+                yield entry
+        
+        fetched = []
+        finish = fake_finish_track(self.download_dir, 'broken{job.track_index}.mp3', fetched, complete=True)
+        with patch('main.yt_dlp.YoutubeDL') as mock_ydl, patch('main.fetch_track', return_value=None), \
+                patch('main.finish_track', side_effect=finish):
+            fake_ydl(mock_ydl, {'title': 'Broken', 'playlist_count': None, 'entries': listing(True)})
+            main.run_playlist_download(url, 'pl-broken', 'youtube:broken')
+            
+            progress = main.playlist_progress['pl-broken']
+            self.assertEqual((progress['status'], progress['completed_tracks']), ('partial', 2))
+            self.assertIn('HTTP Error 500 on page 2', progress['error'])
+            response = app.test_client().get('/download_playlist/pl-broken')
+            with zipfile.ZipFile(io.BytesIO(response.data)) as zipf:
+                self.assertEqual(len(zipf.namelist()), 2)
+            self.assertFalse(self.journal.replay('pl-broken')['entries_complete'])
+            self.assertEqual(self.journal.interrupted(), ['pl-broken'])
+            
+            # The resumed run lists the playlist again and only downloads what is new
+            fake_ydl(mock_ydl, {'title': 'Broken', 'playlist_count': None, 'entries': listing(False)})
+            main.run_playlist_download(url, 'pl-broken', 'youtube:broken')
+        
+        self.assertEqual(sorted(job.track_index for job in fetched), [0, 1, 2])
+        self.assertEqual(main.playlist_progress['pl-broken']['status'], 'completed')
+        self.assertIsNone(self.journal.replay('pl-broken'))
+    
+    def test_startup_requeues_interrupted_playlists(self):
+        self._interrupt('pl-restart')
+        queue = MagicMock()
+        with patch('main.job_queue', queue):
+            main.resume_interrupted_playlists()
+        
+        queue.submit.assert_called_once_with('pl-restart', main.run_playlist_download,
+                                             'https://www.youtube.com/playlist?list=j', 'pl-restart', 'youtube:j')
+        self.assertEqual(main.playlist_progress['pl-restart']['status'], 'queued')
+        # The finished track is protected from the janitor's startup sweep
+        self.assertIn(('file', self.done_path), main.janitor._deadlines)
+        main.release_inflight('youtube:j', 'pl-restart')
+
+class TestPlaylistSync(unittest.TestCase):
+    """Test playlist ranges and sync mode."""
+    
+    def setUp(self):
+        self.download_dir = make_temp_dir(self)
+        db = main.StateDB(os.path.join(self.download_dir, 'state.db'))
+        self.patches = [
+            patch.dict(main.CONFIG, {'DOWNLOAD_DIR': self.download_dir}),
+            patch('main.playlist_journal', main.PlaylistJournal(db)),
+            patch('main.playlist_archive', main.PlaylistArchive(db)),
+        ]
+        for p in self.patches:
+            p.start()
+    
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+    
+    def _run(self, playlist_id, count, options, listed=None):
+        """Run a playlist of count entries; returns the ids downloaded"""
+        fetched = []
+        
+        def listing():
+            for i in range(count):
+                if listed is not None:
+                    listed.append(i)
+                yield {'id': str(i), 'ie_key': 'Youtube', 'url': f'https://www.youtube.com/watch?v=sync{i}'}
+        
+        finish = fake_finish_track(self.download_dir, f'{playlist_id}-{{job.track_index}}.mp3', fetched, complete=True)
+        with patch('main.yt_dlp.YoutubeDL') as mock_ydl, patch('main.fetch_track', return_value=None), \
+                patch('main.finish_track', side_effect=finish):
+            fake_ydl(mock_ydl, {'title': 'Mirror', 'playlist_count': count, 'entries': listing()})
+            main.run_playlist_download('https://www.youtube.com/playlist?list=mirror', playlist_id,
+                                       None, None, options)
+        return sorted((job.url.rsplit('sync', 1)[1] for job in fetched), key=int)
+    
+    def test_items_match_yt_dlp(self):
+        """Positions, ranges, steps and negative positions select what yt-dlp would."""
+        for items in ('1-3,7,10:', '-2:', '2:8:3', '::-2', '5,1', '7:6,5'):
+            expected = sorted({
+                i - 1 for spec in main.yt_dlp.utils.PlaylistEntries.parse_playlist_items(items)
+                for i, _ in main.yt_dlp.utils.PlaylistEntries(MagicMock(params={}), {'entries': list(range(12))})[spec]
+            })
+            self.assertEqual(list(main.PlaylistSelection(items).select(range(12), 12)), expected, items)
+        self.assertEqual(main.PlaylistSelection.from_request({'start': 3, 'end': 5}).items, '3:5')
+        self.assertIsNone(main.PlaylistSelection.from_request({}))
+        # Malformed, or selecting nothing whatever the playlist length
+        for bad in ({'items': '1,,2'}, {'start': 0}, {'items': '1', 'end': 2}, {'items': '3-1'},
+                    {'items': '1:5:-1'}, {'items': '0'}, {'items': '-1:-3'}, {'start': 5, 'end': 2},
+                    {'items': '3-1,7:6'}, {'items': '0,5'}):
+            with self.assertRaises(ValueError):
+                main.PlaylistSelection.from_request(bad)
+    
+    def test_range_stops_listing_after_last_item(self):
+        listed = []
+        self.assertEqual(self._run('pl-range', 500, {'items': '2-4'}, listed), ['1', '2', '3'])
+        self.assertLess(len(listed), 10)
+        progress = main.playlist_progress['pl-range']
+        self.assertEqual((progress['status'], progress['total_tracks']), ('completed', 3))
+    
+    def test_sync_downloads_only_new_entries(self):
+        """A sync fetches only entries its sync id has received, and its ZIP and manifest hold only those."""
+        client = app.test_client()
+        self.assertEqual(self._run('pl-sync1', 3, {'sync': 'phone'}), ['0', '1', '2'])
+        # Nothing was collected, so the next sync downloads the same tracks again
+        self.assertEqual(self._run('pl-sync2', 3, {'sync': 'phone'}), ['0', '1', '2'])
+        self.assertTrue(client.get('/download_playlist/pl-sync2').data)
+        
+        self.assertEqual(self._run('pl-sync3', 5, {'sync': 'phone'}), ['3', '4'])
+        progress = main.playlist_progress['pl-sync3']
+        self.assertEqual((progress['completed_tracks'], progress['skipped_tracks']), (2, 3))
+        with zipfile.ZipFile(io.BytesIO(client.get('/download_playlist/pl-sync3').data)) as zipf:
+            self.assertEqual(zipf.namelist(), ['pl-sync3-0.mp3', 'pl-sync3-1.mp3'])
+        manifest = client.get('/download_playlist/pl-sync3/manifest').get_json()
+        self.assertEqual([track['download_url'] for track in manifest['tracks']],
+                         ['/download_file/pl-sync3_track_0', '/download_file/pl-sync3_track_1'])
+        
+        self.assertEqual(self._run('pl-sync4', 5, {'sync': 'phone'}), [])
+        self.assertEqual(main.playlist_progress['pl-sync4']['status'], 'completed')
+        # Each sync id keeps its own archive
+        self.assertEqual(self._run('pl-sync5', 5, {'sync': 'laptop'}), ['0', '1', '2', '3', '4'])
+    
+    def test_sync_marks_tracks_fetched_one_by_one(self):
+        """Tracks fetched through /download_file count as received; a partial ZIP does not."""
+        client = app.test_client()
+        self.assertEqual(self._run('pl-one1', 3, {'sync': 'phone'}), ['0', '1', '2'])
+        self.assertTrue(client.get('/download_file/pl-one1_track_1').data)
+        self.assertEqual(len(client.get('/download_playlist/pl-one1', headers={'Range': 'bytes=0-99'}).data), 100)
+        self.assertEqual(self._run('pl-one2', 3, {'sync': 'phone'}), ['0', '2'])
+    
+    def test_route_passes_range_and_sync(self):
+        client = app.test_client()
+        url = 'https://www.youtube.com/playlist?list=route'
+        for items in ('1-x', '3-1'):
+            response = client.post('/download_playlist', json={'url': url, 'items': items})
+            self.assertEqual(response.status_code, 400)
+        
+        response = client.post('/download_playlist', json={'url': url, 'sync': True})
+        self.assertEqual(response.status_code, 400)
+        
+        with patch('main.job_queue.submit') as submit:
+            response = client.post('/download_playlist', json={'url': url, 'start': 2, 'end': 4, 'sync': 'phone'})
+        data = response.get_json()
+        self.assertEqual((data['items'], data['sync']), ('2:4', 'phone'))
+        options = {'items': '2:4', 'sync': 'phone'}
+        media_id = submit.call_args.args[4]
+        self.assertEqual(submit.call_args.args[5:], (None, options))
+        main.release_inflight(media_id, data['playlist_id'])
+
+class TestFileServing(unittest.TestCase):
+    """Test Range and conditional requests for finished downloads."""
+    
+    def setUp(self):
+        self.app = app.test_client()
+        self.download_dir = make_temp_dir(self)
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.download_dir, f'song {i}.mp3')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(5000 + i))
+            self.paths.append(path)
+        
+        files = main.PlaylistFiles()
+        for i, path in enumerate(self.paths):
+            files.add(i, path)
+        files.set_total(3)
+        files.finish()
+        main.playlist_files['pl-range'] = files
+        main.playlist_progress['pl-range'] = {'status': 'completed', 'zip_filename': 'playlist.zip'}
+        main.download_progress['dl-range'] = {
+            'status': 'completed', 'file_path': self.paths[0], 'filename': 'song.mp3'
+        }
+    
+    def test_layout_matches_stream(self):
+        """The finished-archive layout is byte-identical to the streamed archive."""
+        streamed = b''.join(main.stream_zip(self.paths))
+        segments, _ = main.zip_layout(self.paths)
+        self.assertEqual(b''.join(main.iter_segments(segments, 0, len(streamed))), streamed)
+        with zipfile.ZipFile(io.BytesIO(streamed)) as zipf:
+            self.assertIsNone(zipf.testzip())
+            self.assertEqual(zipf.namelist(), ['song 0.mp3', 'song 1.mp3', 'song 2.mp3'])
+    
+    def test_playlist_range_and_conditional_requests(self):
+        """Completed archives support Range, If-Range and If-None-Match."""
+        full = self.app.get('/download_playlist/pl-range')
+        self.assertEqual(full.status_code, 200)
+        self.assertEqual(int(full.headers['Content-Length']), len(full.data))
+        etag = full.headers['ETag']
+        
+        partial = self.app.get('/download_playlist/pl-range', headers={'Range': 'bytes=100-4999'})
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial.data, full.data[100:5000])
+        self.assertEqual(partial.headers['Content-Range'], f'bytes 100-4999/{len(full.data)}')
+        
+        resumed = self.app.get('/download_playlist/pl-range',
+                               headers={'Range': 'bytes=9000-', 'If-Range': etag})
+        self.assertEqual(resumed.data, full.data[9000:])
+        
+        stale = self.app.get('/download_playlist/pl-range',
+                             headers={'Range': 'bytes=9000-', 'If-Range': '"stale"'})
+        self.assertEqual(stale.status_code, 200)
+        self.assertEqual(stale.data, full.data)
+        
+        cached = self.app.get('/download_playlist/pl-range', headers={'If-None-Match': etag})
+        self.assertEqual(cached.status_code, 304)
+    
+    def test_download_file_range(self):
+        """Single files support resumed transfers."""
+        response = self.app.get('/download_file/dl-range', headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        with open(self.paths[0], 'rb') as f:
+            self.assertEqual(response.data, f.read()[10:20])
+        self.assertIn('ETag', response.headers)
+    
+    def test_x_accel_redirect_offload(self):
+        """With nginx offload, the body is left to the proxy."""
+        with patch.dict(main.CONFIG, {'SENDFILE_OFFLOAD': 'x-accel-redirect',
+                                      'DOWNLOAD_DIR': self.download_dir}):
+            response = self.app.get('/download_file/dl-range')
+        self.assertEqual(response.headers['X-Accel-Redirect'], '/protected-downloads/song%200.mp3')
+        self.assertEqual(response.data, b'')
+
+class TestJanitor(unittest.TestCase):
+    """Test the expiry scheduler for files and job records."""
+    
+    def setUp(self):
+        self.download_dir = make_temp_dir(self)
+        self.config_patch = patch.dict(main.CONFIG, {
+            'DOWNLOAD_DIR': self.download_dir,
+            'CLEANUP_DELAY': 100,
+            'DISK_HIGH_WATERMARK': 25,
+            'DISK_LOW_WATERMARK': 15
+        })
+        self.config_patch.start()
+        self.partials_patch = patch('main.partial_downloads', main.PartialDownloads(make_temp_dir(self)))
+        self.partials_patch.start()
+        self.expired = []
+        self.janitor = main.Janitor({
+            'file': lambda path: (self.expired.append(path), main.remove_file(path)),
+            'download': self.expired.append
+        })
+    
+    def tearDown(self):
+        self.partials_patch.stop()
+        self.config_patch.stop()
+    
+    def _make_file(self, name, size=10):
+        path = os.path.join(self.download_dir, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+    
+    def test_rescheduling_replaces_deadline(self):
+        """A key scheduled twice expires once, at its latest deadline."""
+        self.janitor.schedule_at('download', 'a', 10)
+        self.janitor.schedule_at('download', 'b', 20)
+        self.janitor.schedule_at('download', 'a', 30)
+        
+        self.assertEqual(self.janitor.run_due(now=25), 5)
+        self.assertEqual(self.expired, ['b'])
+        self.assertIsNone(self.janitor.run_due(now=40))
+        self.assertEqual(self.expired, ['b', 'a'])
+    
+    def test_watermarks_expire_soonest_files_first(self):
+        """Over the high watermark, files are expired in deadline order down to the low watermark."""
+        paths = [self._make_file(f'{i}.mp3') for i in range(3)]
+        for deadline, path in zip((300, 100, 200), paths):
+            self.janitor.schedule_at('file', path, deadline)
+        
+        self.janitor.enforce_watermarks()
+        self.assertEqual(self.expired, [paths[1], paths[2]])
+        self.assertTrue(os.path.exists(paths[0]))
+    
+    def test_watermarks_skip_files_the_cache_links_to(self):
+        """Removing a file that is also in the result cache frees nothing, so it is kept."""
+        cached, plain = self._make_file('cached.mp3', 20), self._make_file('plain.mp3', 10)
+        os.link(cached, os.path.join(make_temp_dir(self), 'cache-entry.mp3'))
+        self.janitor.schedule_at('file', cached, 100)
+        self.janitor.schedule_at('file', plain, 200)
+        
+        self.janitor.enforce_watermarks()
+        self.assertEqual(self.expired, [plain])
+        self.assertTrue(os.path.exists(cached))
+    
+    def test_rebuild_schedules_existing_files(self):
+        """Files left in DOWNLOAD_DIR are picked up again after a restart."""
+        path = self._make_file('left-over.mp3')
+        os.utime(path, (1000, 1000))
+        os.makedirs(os.path.join(self.download_dir, '.cache'))
+        partial = main.partial_downloads.path('Youtube:left-over')
+        os.makedirs(partial)
+        
+        self.janitor.rebuild()
+        self.assertEqual(self.janitor.stats()['scheduled'], 2)
+        self.janitor.run_due(now=1000 + 100)
+        self.assertFalse(os.path.exists(path))
+        self.assertIn(('partial', partial), self.janitor._deadlines)
+    
+    def test_shared_deadlines_hold_for_every_node(self):
+        """A deadline moved on one node is honoured by the others, and each expiry runs once."""
+        state_dir = make_temp_dir(self)
+        path = os.path.join(state_dir, 'state.db')
+        worker_expired, api_expired = [], []
+        worker = main.Janitor({'download': worker_expired.append, 'retry': worker_expired.append}, main.StateDB(path))
+        api = main.Janitor({'download': api_expired.append}, main.StateDB(path))
+        
+        # The worker finished the job; the API node served it later and moved the deadline
+        worker.schedule_at('download', 'job', 100)
+        api.schedule_at('download', 'job', 300)
+        # Node-local kinds stay in the node's own heap
+        worker.schedule_at('retry', 'job', 100)
+        
+        self.assertEqual(worker.run_due(now=200), 100)
+        self.assertEqual(worker_expired, ['job'])
+        self.assertEqual(api.run_due(now=200), 100)
+        self.assertEqual(api_expired, [])
+        
+        self.assertIsNone(worker.run_due(now=300))
+        self.assertIsNone(api.run_due(now=300))
+        self.assertEqual(worker_expired + api_expired, ['job', 'job'])
+        self.assertEqual(api.stats()['scheduled'], 0)
+    
+    def test_playlist_tracks_outlive_the_unclaimed_ttl(self):
+        """Tracks finished early in a long playlist stay until the playlist itself expires."""
+        janitor = main.Janitor({
+            'file': main.remove_file,
+            'download': main.forget_download,
+            'playlist': main.forget_playlist,
+            'playlist_files': main.forget_playlist_files
+        })
+        
+        def fetch(job):
+            if job.track_index == 1:
+                # Track 0 is done; its TTLs pass while this track is still running
+                deadline = time.time() + 5
+                while main.download_progress.get('pl-long_track_0', {}).get('status') != 'completed':
+                    self.assertLess(time.time(), deadline)
+                    time.sleep(0.01)
+                time.sleep(0.01)
+                janitor.run_due(now=time.time() + 10)
+                main.download_progress.prune()
+        
+        with patch('main.janitor', janitor), patch('main.playlist_journal', None), \
+                patch.dict(main.CONFIG, {'UNCLAIMED_FILE_TTL': 0.5, 'PROGRESS_TTL': 0}), \
+                patch('main.yt_dlp.YoutubeDL') as mock_ydl, patch('main.fetch_track', side_effect=fetch), \
+                patch('main.finish_track', side_effect=fake_finish_track(self.download_dir, 'long{job.track_index}.mp3',
+                                                                         complete=True)):
+            fake_ydl(mock_ydl, {'title': 'Long', 'entries': [
+                {'id': str(i), 'url': f'https://www.youtube.com/watch?v=long{i}'} for i in range(2)]})
+            main.download_playlist('https://www.youtube.com/playlist?list=long', 'pl-long')
+            
+            self.assertEqual(main.download_progress['pl-long_track_0']['status'], 'completed')
+            response = app.test_client().get('/download_playlist/pl-long')
+            self.assertEqual(response.status_code, 200)
+            with zipfile.ZipFile(io.BytesIO(response.data)) as zipf:
+                self.assertEqual(len(zipf.namelist()), 2)
+            
+            # The playlist's own deadline removes its tracks
+            janitor.run_due(now=time.time() + 200)
+            self.assertNotIn('pl-long_track_0', main.download_progress)
+            self.assertFalse(os.path.exists(os.path.join(self.download_dir, 'long0.mp3')))
+
+class TestResultCache(unittest.TestCase):
+    """Test the on-disk result cache."""
+    
+    def setUp(self):
+        self.download_dir = make_temp_dir(self)
+        self.config_patch = patch.dict(main.CONFIG, {'DOWNLOAD_DIR': self.download_dir})
+        self.config_patch.start()
+        self.cache = main.ResultCache(os.path.join(self.download_dir, '.cache'), max_bytes=10)
+    
+    def tearDown(self):
+        self.config_patch.stop()
+    
+    def _make_file(self, name, size):
+        path = os.path.join(self.download_dir, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+    
+    def test_media_key_matches_extractor(self):
+        """URLs map to (extractor, media id) without network access."""
+        self.assertEqual(main.media_key('https://www.youtube.com/watch?v=dQw4w9WgXcQ'),
+                         ('Youtube', 'dQw4w9WgXcQ'))
+        self.assertEqual(main.media_key('https://youtu.be/dQw4w9WgXcQ'),
+                         ('Youtube', 'dQw4w9WgXcQ'))
+    
+    def test_warm_extractors_compiles_url_patterns(self):
+        """After warming, no extractor compiles its URL pattern on a request."""
+        main.warm_extractors()
+        cold = [extractor.ie_key() for extractor in main.get_extractor_classes()
+                if extractor._VALID_URL and '_VALID_URL_RE' not in extractor.__dict__]
+        self.assertEqual(cold, [])
+    
+    def test_hit_links_file_and_lru_eviction(self):
+        """Hits hard-link the cached file; the least recently used entry is evicted."""
+        first = self._make_file('first.mp3', 4)
+        self.cache.store('a', first, {'title': 'First', 'filename': 'first.mp3'})
+        self.cache.store('b', self._make_file('second.mp3', 4), {'filename': 'second.mp3'})
+        
+        dest = os.path.join(self.download_dir, 'copy.mp3')
+        metadata = self.cache.lookup('a', dest)
+        self.assertEqual(metadata['title'], 'First')
+        self.assertEqual(os.stat(dest).st_ino, os.stat(first).st_ino)
+        self.assertIsNone(self.cache.lookup('missing', dest + '.2'))
+        
+        # 'b' is now least recently used and goes when the budget is exceeded
+        self.cache.store('c', self._make_file('third.mp3', 4), {'filename': 'third.mp3'})
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 1, 1))
+        self.assertIsNone(self.cache.lookup('b', dest + '.3'))
+        
+        # The index survives a restart
+        reloaded = main.ResultCache(self.cache.directory, max_bytes=10)
+        self.assertEqual(reloaded.stats()['entries'], 2)
+    
+    def test_shared_index_spans_nodes(self):
+        """With STATE_DB, nodes see each other's entries and evict within one budget."""
+        db = main.StateDB(os.path.join(make_temp_dir(self), 'state.db'))
+        first = main.SharedResultCache(self.cache.directory, 10, db)
+        second = main.SharedResultCache(self.cache.directory, 10, db)
+        first.store('shared-a', self._make_file('a.mp3', 4), {'filename': 'a.mp3'})
+        second.store('shared-b', self._make_file('b.mp3', 4), {'filename': 'b.mp3'})
+        
+        dest = os.path.join(self.download_dir, 'copy.mp3')
+        self.assertEqual(second.lookup('shared-a', dest)['filename'], 'a.mp3')
+        # 'b' is the least recently used entry of either node
+        first.store('shared-c', self._make_file('c.mp3', 4), {'filename': 'c.mp3'})
+        self.assertIsNone(second.lookup('shared-b', dest + '.2'))
+        self.assertEqual((second.stats()['entries'], second.stats()['bytes']), (2, 8))
+    
+    @patch('main.yt_dlp.YoutubeDL')
+    def test_cached_track_skips_download(self, mock_ydl):
+        """A cache hit completes the track without running yt-dlp."""
+        key = main.ResultCache.make_key('Youtube', 'cachedAAAAA')
+        self.cache.store(key, self._make_file('song.mp3', 4),
+                         {'title': 'Song', 'artist': 'Artist', 'filename': 'song.mp3'})
+        job = main.TrackJob('https://www.youtube.com/watch?v=cachedAAAAA', 'dl-cached')
+        
+        with patch('main.result_cache', self.cache):
+            final_path = main.fetch_track(job)
+        
+        mock_ydl.assert_not_called()
+        self.assertEqual(final_path, os.path.join(self.download_dir, 'dl-cached_song.mp3'))
+        self.assertEqual(main.download_progress['dl-cached']['status'], 'completed')
+
+class TestPartialDownloads(unittest.TestCase):
+    """Test keeping unfinished source downloads for the next attempt."""
+    
+    def setUp(self):
+        self.partial_dir = make_temp_dir(self)
+        self.partials = main.PartialDownloads(self.partial_dir)
+        self.partials_patch = patch('main.partial_downloads', self.partials)
+        self.partials_patch.start()
+        self.janitor_patch = patch('main.janitor')
+        self.janitor = self.janitor_patch.start()
+    
+    def tearDown(self):
+        self.janitor_patch.stop()
+        self.partials_patch.stop()
+    
+    def test_directory_is_held_by_one_attempt(self):
+        """A held directory is not handed out again, or removed, until released."""
+        path = self.partials.acquire('Youtube:held')
+        self.assertIsNone(self.partials.acquire('Youtube:held'))
+        with open(os.path.join(path, 'Song.webm.part'), 'wb') as f:
+            f.write(b'half')
+        
+        self.partials.remove(path)
+        self.assertTrue(os.path.isdir(path))
+        self.partials.release(path, keep=True)
+        
+        self.assertEqual(self.partials.acquire('Youtube:held'), path)
+        self.assertEqual(self.partials.stats()['resumed'], 1)
+        self.partials.release(path, keep=False)
+        self.assertFalse(os.path.exists(path))
+    
+    def test_abandoned_directory_is_removed(self):
+        """The janitor handler deletes directories nobody holds."""
+        path = self.partials.acquire('Youtube:abandoned')
+        self.partials.release(path, keep=True)
+        self.assertEqual([p for p, _ in self.partials.existing()], [path])
+        
+        self.partials.remove(path)
+        self.assertFalse(os.path.exists(path))
+    
+    @patch('main.finish_track')
+    @patch('main.yt_dlp.YoutubeDL')
+    def test_retry_resumes_from_part_file(self, mock_ydl, mock_finish):
+        """A failed attempt keeps its .part file; the retry downloads into the same directory."""
+        seen = []
+        
+        def fake_extract(url, download=False, ie_key=None):
+            source_dir = ydl.params['paths']['home']
+            seen.append((source_dir, mock_ydl.call_args[0][0]['continuedl'], sorted(os.listdir(source_dir))))
+            if len(seen) == 1:
+                with open(os.path.join(source_dir, 'Mix.webm.part'), 'wb') as f:
+                    f.write(b'first half')
+                raise Exception("Connection reset")
+            os.rename(os.path.join(source_dir, 'Mix.webm.part'), os.path.join(source_dir, 'Mix.webm'))
+            return {'title': 'Mix', 'uploader': 'DJ'}
+        
+        ydl = fake_ydl(mock_ydl)
+        ydl.extract_info.side_effect = fake_extract
+        mock_finish.side_effect = lambda job: job.source_path
+        url = 'https://www.youtube.com/watch?v=partialMix1'
+        
+        # Retry by hand, as a second request for the same media would
+        with patch.dict(main.CONFIG, {'CACHE_MAX_BYTES': 0, 'TRACK_RETRIES': 0}), \
+                fresh_ydl_pool():
+            self.assertIsNone(main.submit_track(url, 'dl-partial-1').result(timeout=5))
+            kept = self.partials.path('Youtube:partialMix1')
+            self.assertIn('Mix.webm.part', os.listdir(kept))
+            self.janitor.schedule.assert_any_call('partial', kept, main.CONFIG['PARTIAL_TTL'])
+            
+            source_path = main.submit_track(url, 'dl-partial-2').result(timeout=5)
+        
+        self.assertEqual([(d, c) for d, c, _ in seen], [(kept, True), (kept, True)])
+        self.assertIn('Mix.webm.part', seen[1][2])
+        self.assertEqual(source_path, os.path.join(kept, 'Mix.webm'))
+        # Released without keeping once the track is done
+        self.assertFalse(os.path.exists(kept))
+
+class TestYoutubeDLPool(unittest.TestCase):
+    """Test reusing YoutubeDL instances across fetches."""
+    
+    class FakeYoutubeDL:
+        def __init__(self, options):
+            self.params = options
+            self.closed = False
+        
+        def __enter__(self):
+            return self
+        
+        def __exit__(self, *exc_info):
+            self.closed = True
+    
+    def test_instances_are_reused_with_per_fetch_settings(self):
+        """A returned instance serves the next fetch with its directory and hook, until max_uses."""
+        pool = main.YoutubeDLPool(1, 2, factory=self.FakeYoutubeDL)
+        first_hook, second_hook = MagicMock(), MagicMock()
+        
+        with pool.session('/tmp/first', first_hook, ratelimit=1000) as first:
+            self.assertEqual((first.params['paths'], first.params['ratelimit']), ({'home': '/tmp/first'}, 1000))
+            first.params['progress_hooks'][0]({'status': 'downloading'})
+        first.params['progress_hooks'][0]({'status': 'late'})
+        first_hook.assert_called_once_with({'status': 'downloading'})
+        
+        with pool.session('/tmp/second', second_hook) as second:
+            self.assertIs(second, first)
+            self.assertEqual((second.params['paths'], second.params['ratelimit']), ({'home': '/tmp/second'}, None))
+        self.assertTrue(first.closed)
+        
+        with pool.session('/tmp/third', second_hook) as third:
+            self.assertIsNot(third, first)
+        self.assertEqual(pool.stats(), {'idle': 1, 'created': 2, 'reused': 1, 'retired': 1})
+    
+    def test_concurrent_fetches_get_their_own_instance(self):
+        pool = main.YoutubeDLPool(1, 100, factory=self.FakeYoutubeDL)
+        pool.warm()
+        with pool.session('/tmp/a', None) as a, pool.session('/tmp/b', None) as b:
+            self.assertIsNot(a, b)
+            self.assertEqual((a.params['paths']['home'], b.params['paths']['home']), ('/tmp/a', '/tmp/b'))
+        # Only `size` instances are kept idle
+        self.assertEqual(pool.stats(), {'idle': 1, 'created': 2, 'reused': 1, 'retired': 1})
+
+class TestTrackRetries(unittest.TestCase):
+    """Test retrying failed fetches and per-platform circuit breaking."""
+    
+    def setUp(self):
+        self.config_patch = patch.dict(main.CONFIG, {
+            'TRACK_RETRIES': 2,
+            'RETRY_BASE_DELAY': 1.0,
+            'BREAKER_THRESHOLD': 2,
+            'BREAKER_COOLDOWN': 30.0
+        })
+        self.config_patch.start()
+        self.breakers_patch = patch.dict(main.circuit_breakers, clear=True)
+        self.breakers_patch.start()
+        # Run retries straight away instead of after their delay
+        self.delays = []
+        self.janitor_patch = patch('main.janitor')
+        janitor = self.janitor_patch.start()
+        janitor.schedule.side_effect = lambda kind, target, delay: (self.delays.append(delay), main.run_retry(target))
+    
+    def tearDown(self):
+        self.janitor_patch.stop()
+        self.breakers_patch.stop()
+        self.config_patch.stop()
+    
+    def test_classify_errors(self):
+        """Known permanent failures get their user-facing message; anything else may be retried."""
+        message, retryable = main.classify_track_error(Exception('ERROR: Video unavailable'))
+        self.assertIn('not available', message)
+        self.assertFalse(retryable)
+        self.assertEqual(main.classify_track_error(Exception('HTTP Error 503')), ('HTTP Error 503', True))
+    
+    def test_backoff_grows_with_jitter(self):
+        """Each attempt waits between half and all of a doubling, capped delay."""
+        with patch.dict(main.CONFIG, {'RETRY_MAX_DELAY': 3.0}):
+            for attempt, cap in ((1, 1.0), (2, 2.0), (3, 3.0), (6, 3.0)):
+                delay = main.retry_backoff(attempt)
+                self.assertGreaterEqual(delay, cap / 2)
+                self.assertLessEqual(delay, cap)
+    
+    def test_transient_failure_is_retried(self):
+        """A fetch that fails with a retryable error is fetched again and the track completes."""
+        fetch = MagicMock(side_effect=[Exception('HTTP Error 503'), None])
+        with patch('main.fetch_track', fetch), patch('main.finish_track', return_value='/done.mp3'):
+            result = main.submit_track('https://soundcloud.com/a/retry', 'dl-retry').result(timeout=5)
+        
+        self.assertEqual(result, '/done.mp3')
+        self.assertEqual(fetch.call_count, 2)
+        self.assertEqual(len(self.delays), 1)
+        self.assertEqual(main.circuit_breakers['SoundCloud'].failures, 1)
+    
+    def test_permanent_failure_and_exhausted_retries_fail(self):
+        """Permanent errors fail at once; retryable ones fail after TRACK_RETRIES retries."""
+        fetch = MagicMock(side_effect=Exception('Video unavailable'))
+        with patch('main.fetch_track', fetch):
+            self.assertIsNone(main.submit_track('https://vimeo.com/1', 'dl-permanent').result(timeout=5))
+        self.assertEqual(fetch.call_count, 1)
+        
+        fetch = MagicMock(side_effect=Exception('Connection reset'))
+        with patch('main.fetch_track', fetch), patch.dict(main.CONFIG, {'BREAKER_THRESHOLD': 10}):
+            self.assertIsNone(main.submit_track('https://vimeo.com/2', 'dl-exhausted').result(timeout=5))
+        self.assertEqual(fetch.call_count, 3)
+        self.assertEqual(main.download_progress['dl-exhausted']['status'], 'error')
+    
+    def test_breaker_opens_and_probes(self):
+        """Repeated failures open the breaker; after the cooldown one probe decides whether it closes."""
+        breaker = main.CircuitBreaker('Bandcamp')
+        breaker.record_failure(now=0)
+        self.assertEqual(breaker.retry_after(now=1), 0)
+        breaker.record_failure(now=1)
+        self.assertEqual(breaker.state(), 'open')
+        self.assertGreaterEqual(breaker.retry_after(now=11), 20)
+        
+        # Cooldown over: one probe goes through, others keep waiting
+        self.assertEqual(breaker.retry_after(now=31), 0)
+        self.assertGreater(breaker.retry_after(now=31), 0)
+        breaker.record_failure(now=32)
+        self.assertEqual((breaker.state(), breaker.trips), ('open', 2))
+        
+        self.assertEqual(breaker.retry_after(now=62), 0)
+        breaker.record_success()
+        self.assertEqual(breaker.state(), 'closed')
+        self.assertEqual(breaker.retry_after(now=63), 0)
+    
+    @patch('main.yt_dlp.YoutubeDL')
+    def test_extraction_errors_reach_the_classifier(self, mock_ydl):
+        """An extractor error surfaces with its own message, so a 429 is retried and counts for the breaker."""
+        ydl = fake_ydl(mock_ydl)
+        ydl.extract_info.side_effect = main.yt_dlp.utils.DownloadError('ERROR: [soundcloud] x: HTTP Error 429: Too Many Requests')
+        job = main.TrackJob('https://soundcloud.com/a/limited', 'dl-429')
+        
+        with fresh_ydl_pool(), patch.dict(main.CONFIG, {'CACHE_MAX_BYTES': 0}):
+            try:
+                with self.assertRaises(main.yt_dlp.utils.DownloadError) as raised:
+                    main.fetch_track(job)
+            finally:
+                main.cleanup_temp_dir(job.temp_dir)
+                main.release_partial(job, keep=False)
+        
+        self.assertFalse(mock_ydl.call_args[0][0]['ignoreerrors'])
+        self.assertIsNotNone(main.track_retry_delay(job, raised.exception))
+        self.assertEqual(main.circuit_breakers['SoundCloud'].failures, 1)
+    
+    def test_probe_failing_permanently_releases_breaker(self):
+        """A probe that fails with a permanent error lets a later fetch probe again."""
+        breaker = main.platform_breaker('https://bandcamp.com/track/probe')
+        breaker.record_failure(now=0)
+        breaker.record_failure(now=0)
+        self.assertEqual(breaker.retry_after(now=31), 0)
+        self.assertEqual(breaker.state(), 'half-open')
+        
+        job = main.TrackJob('https://bandcamp.com/track/probe', 'dl-probe')
+        self.assertIsNone(main.track_retry_delay(job, Exception('ERROR: Video unavailable')))
+        self.assertEqual(breaker.state(), 'open')
+        self.assertEqual(breaker.retry_after(now=32), 0)
+    
+    def test_open_breaker_defers_fetch(self):
+        """A fetch for a platform with an open breaker is deferred, not failed."""
+        breaker = main.platform_breaker('https://bandcamp.com/track/x')
+        breaker.record_failure()
+        breaker.record_failure()
+        job = main.TrackJob('https://bandcamp.com/track/x', 'dl-deferred')
+        
+        with patch.dict(main.CONFIG, {'CACHE_MAX_BYTES': 0}), self.assertRaises(main.HostDeferred) as raised:
+            main.fetch_track(job)
+        self.assertEqual(raised.exception.platform, 'Bandcamp')
+        self.assertEqual(main.track_retry_delay(job, raised.exception), raised.exception.retry_after)
+        self.assertEqual(job.attempts, 0)
+    
+    def test_deferral_is_capped(self):
+        """A track deferred for longer than TRACK_MAX_DEFERRAL in total fails instead of waiting on."""
+        fetch = MagicMock(side_effect=main.HostDeferred('Bandcamp', 30))
+        with patch('main.fetch_track', fetch), patch.dict(main.CONFIG, {'TRACK_MAX_DEFERRAL': 100}):
+            self.assertIsNone(main.submit_track('https://bandcamp.com/track/down', 'dl-down').result(timeout=5))
+        
+        # Three deferrals fit in 100s, the fourth fetch gives up
+        self.assertEqual(fetch.call_count, 4)
+        self.assertEqual(self.delays[:3], [30, 30, 30])
+        self.assertEqual(main.download_progress['dl-down']['error'], 'Bandcamp is not responding, try again later')
+
+class TestPlatformQuotas(unittest.TestCase):
+    """Test per-platform fetch slots and bandwidth limits."""
+    
+    def test_full_platform_does_not_block_others(self):
+        """An item of a platform at its limit waits while later items of other platforms run."""
+        platforms = {'a': {'name': 'A', 'max_concurrent': 1}, 'b': {'name': 'B'}}
+        stage = main.PlatformStage('test', 3, lambda key, event: platforms[key])
+        release = threading.Event()
+        order = []
+        
+        def work(key, event):
+            order.append(key)
+            event.wait(5)
+            return key
+        
+        first = stage.submit(work, 'a', release)
+        second = stage.submit(work, 'a', release)
+        third = stage.submit(work, 'b', threading.Event())
+        for _ in range(100):
+            if len(order) == 2:
+                break
+            time.sleep(0.01)
+        
+        self.assertEqual(order, ['a', 'b'])
+        self.assertEqual(stage.stats()['platforms']['A'], {'running': 1, 'queued': 1, 'limit': 1})
+        release.set()
+        self.assertEqual((first.result(5), second.result(5)), ('a', 'a'))
+        self.assertEqual(order, ['a', 'b', 'a'])
+    
+    def test_platform_family_shares_slots(self):
+        """YouTube and YouTube Music draw on one set of slots, so max_concurrent caps them together."""
+        youtube = dict(main.PLATFORM_SUPPORT['youtube.com'], max_concurrent=1)
+        music = dict(main.PLATFORM_SUPPORT['music.youtube.com'], max_concurrent=1)
+        stage = main.PlatformStage('test', 3, lambda platform, event: platform)
+        release = threading.Event()
+        
+        first = stage.submit(lambda platform, event: event.wait(5), youtube, release)
+        self.assertFalse(stage.has_slot(music))
+        second = stage.submit(lambda platform, event: event.wait(5), music, release)
+        self.assertEqual(stage.stats()['platforms'], {'youtube': {'running': 1, 'queued': 1, 'limit': 1}})
+        release.set()
+        self.assertTrue(first.result(5) and second.result(5))
+        self.assertTrue(stage.has_slot(music))
+    
+    def test_token_bucket_sleeps_off_debt(self):
+        """Bytes beyond the bucket's balance are paid for by sleeping at the configured rate."""
+        with patch('main.time.monotonic', return_value=50.0), patch('main.time.sleep') as sleep:
+            bucket = main.TokenBucket(1000)
+            self.assertEqual(bucket.consume(1000), 0)
+            self.assertEqual(bucket.consume(500), 0.5)
+        sleep.assert_called_once_with(0.5)
+    
+    def test_hook_charges_received_bytes(self):
+        """The progress hook charges each chunk's new bytes, not bytes resumed from an earlier attempt."""
+        bucket = MagicMock()
+        hook = main.DownloadProgressHook('hook-bw', buckets=(bucket,))
+        for downloaded in (4000, 4500, 6000):
+            hook({'status': 'downloading', 'downloaded_bytes': downloaded, 'total_bytes': 10000})
+        self.assertEqual([c.args[0] for c in bucket.consume.call_args_list], [500, 1500])
+    
+    def test_platform_ratelimit_bucket_is_shared(self):
+        """Fetches from a platform with a ratelimit share one bucket."""
+        platform = {'name': 'Limited', 'ratelimit': 2000}
+        with patch.dict(main.CONFIG, {'MAX_BANDWIDTH': 0}), patch.dict(main.bandwidth_buckets, clear=True):
+            buckets = main.platform_buckets(platform)
+            self.assertEqual([b.rate for b in buckets], [2000])
+            self.assertIs(main.platform_buckets(platform)[0], buckets[0])
+
+class TestRateLimiting(unittest.TestCase):
+    """Test the per-client submission rate limit."""
+    
+    def setUp(self):
+        self.config_patch = patch.dict(main.CONFIG, {'RATE_LIMIT_ENABLED': True, 'RATE_LIMIT_PER_MINUTE': 3})
+        self.config_patch.start()
+        self.state_dir = make_temp_dir(self)
+    
+    def tearDown(self):
+        self.config_patch.stop()
+    
+    def _check_limiter(self, limiter):
+        # The whole minute's allowance may be used at once, then one request every 20s
+        self.assertEqual([limiter.hit('a', now=1000) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(limiter.hit('a', now=1000), 20)
+        self.assertEqual(limiter.hit('b', now=1000), 0)
+        self.assertEqual(limiter.hit('a', now=1020), 0)
+        self.assertAlmostEqual(limiter.hit('a', now=1030), 10)
+        
+        limiter.prune(now=1060)
+        self.assertEqual(limiter.clients(), 1)
+        self.assertEqual((limiter.stats()['allowed'], limiter.stats()['limited']), (5, 2))
+    
+    def test_limiter_allows_burst_then_rate(self):
+        """Clients are limited independently and forgotten once back at a full allowance."""
+        self._check_limiter(main.RateLimiter())
+    
+    def test_take_grants_part_of_a_request(self):
+        """take() admits as many of several requests as the allowance has room for."""
+        for limiter in (main.RateLimiter(), main.SharedRateLimiter(main.StateDB(os.path.join(self.state_dir, 'state.db')))):
+            self.assertEqual(limiter.take('a', 2, now=1000), (2, 0))
+            granted, retry_after = limiter.take('a', 5, now=1000)
+            self.assertEqual(granted, 1)
+            self.assertAlmostEqual(retry_after, 20)
+            self.assertEqual(limiter.take('a', 1, now=1000)[0], 0)
+            self.assertEqual((limiter.stats()['allowed'], limiter.stats()['limited']), (3, 5))
+    
+    def test_batch_urls_count_against_the_limit(self):
+        """Each batch URL is one submission; those over the allowance are rejected."""
+        client = app.test_client()
+        urls = [f'https://www.youtube.com/watch?v=limit{i}' for i in range(5)]
+        with patch('main.rate_limiter', main.RateLimiter()), patch('main.job_queue.submit') as submit:
+            response = client.post('/download/batch', json={'urls': urls}, environ_base={'REMOTE_ADDR': '10.0.0.9'})
+            again = client.post('/download/batch', json={'urls': urls[:1]}, environ_base={'REMOTE_ADDR': '10.0.0.9'})
+        
+        data = response.get_json()
+        self.assertEqual([item['index'] for item in data['accepted']], [0, 1, 2])
+        self.assertEqual([item['index'] for item in data['rejected']], [3, 4])
+        self.assertIn('Rate limit', data['rejected'][0]['error'])
+        self.assertEqual(submit.call_args.args[2], urls[:3])
+        self.assertEqual(again.status_code, 429)
+        self.assertGreater(int(again.headers['Retry-After']), 0)
+    
+    def test_shared_limiter(self):
+        """The STATE_DB limiter enforces the same limit for every node."""
+        db = main.StateDB(os.path.join(make_temp_dir(self), 'state.db'))
+        self._check_limiter(main.SharedRateLimiter(db))
+        self.assertGreater(main.SharedRateLimiter(db).hit('a', now=1030), 0)
+    
+    def test_download_returns_429(self):
+        """Submissions over the limit get 429 with Retry-After."""
+        client = app.test_client()
+        with patch('main.rate_limiter', main.RateLimiter()):
+            statuses = [client.post('/download', json={'url': 'not a url'},
+                                    environ_base={'REMOTE_ADDR': '10.0.0.7'}).status_code for _ in range(3)]
+            response = client.post('/download', json={'url': 'not a url'}, environ_base={'REMOTE_ADDR': '10.0.0.7'})
+            other = client.post('/download', json={'url': 'not a url'}, environ_base={'REMOTE_ADDR': '10.0.0.8'})
+        
+        self.assertEqual(statuses, [400, 400, 400])
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+        self.assertEqual(other.status_code, 400)
+    
+    def test_clients_behind_proxy_are_limited_separately(self):
+        """Behind a trusted proxy, clients are keyed by the address the proxy forwarded."""
+        client = app.test_client()
+        
+        def submit(forwarded_for):
+            return client.post('/download', json={'url': 'not a url'}, headers={'X-Forwarded-For': forwarded_for},
+                               environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code
+        
+        with patch('main.rate_limiter', main.RateLimiter()), patch.object(app, 'wsgi_app', app.wsgi_app):
+            main.trust_proxies(1)
+            # A spoofed leading entry does not change the key; the proxy's own entry does
+            statuses = [submit(f'198.51.100.{i}, 203.0.113.5') for i in range(4)]
+            other = submit('203.0.113.6')
+        
+        self.assertEqual(statuses, [400, 400, 400, 429])
+        self.assertEqual(other, 400)
+
+class TestProgressStore(unittest.TestCase):
+    """Test the bounded, expiring progress store."""
+    
+    def setUp(self):
+        self.now = 1000.0
+        self.config_patch = patch.dict(main.CONFIG, {
+            'PROGRESS_TTL': 60,
+            'PROGRESS_IDLE_TTL': 600,
+            'PROGRESS_MAX_ENTRIES': 3,
+            'PROGRESS_PRUNE_INTERVAL': 10
+        })
+        self.config_patch.start()
+        self.store = main.ProgressStore(main.DownloadRecord, clock=lambda: self.now)
+    
+    def tearDown(self):
+        self.config_patch.stop()
+    
+    def test_records_are_compact_mappings(self):
+        """Records use slots, keep unusual keys in extra and omit unset fields."""
+        self.store['a'] = {'status': 'queued', 'percentage': 0, 'queue_position': 2}
+        record = self.store['a']
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertEqual(record.to_dict(), {'status': 'queued', 'percentage': 0, 'queue_position': 2})
+        
+        # Replacing a record reuses the same object
+        self.store['a'] = {'status': 'downloading', 'percentage': 50}
+        self.assertIs(self.store['a'], record)
+        self.assertNotIn('queue_position', record)
+        self.assertEqual(record['percentage'], 50)
+    
+    def test_finished_records_expire(self):
+        """Finished jobs expire after PROGRESS_TTL, idle ones after PROGRESS_IDLE_TTL."""
+        self.store['done'] = {'status': 'completed'}
+        self.store['running'] = {'status': 'downloading'}
+        
+        self.now += 61
+        self.store.prune()
+        self.assertNotIn('done', self.store)
+        self.assertIn('running', self.store)
+        
+        self.now += 600
+        self.store.prune()
+        self.assertEqual(len(self.store), 0)
+    
+    def test_max_entries_evicts_least_recently_updated(self):
+        """The store never holds more than PROGRESS_MAX_ENTRIES records."""
+        for key in ('a', 'b', 'c'):
+            self.store[key] = {'status': 'downloading'}
+        self.store.update('a', {'percentage': 10})
+        self.store['d'] = {'status': 'queued'}
+        
+        self.assertEqual(len(self.store), 3)
+        self.assertNotIn('b', self.store)
+        self.assertEqual(self.store.stats()['evictions'], 1)
+
+class TestProgressHook(unittest.TestCase):
+    """Test the throttled yt-dlp progress hook."""
+    
+    def _chunk(self, downloaded, total=100000):
+        return {'status': 'downloading', 'downloaded_bytes': downloaded, 'total_bytes': total,
+                'speed': 1000, 'eta': 5, 'info_dict': {'title': 'Song'}}
+    
+    def test_updates_are_coalesced(self):
+        """Small changes within the interval are dropped; the record is reused."""
+        main.download_progress['hook-a'] = {'status': 'starting'}
+        record = main.download_progress['hook-a']
+        hook = main.DownloadProgressHook('hook-a', 'hook-pl', 0)
+        
+        with patch('main.time.monotonic', return_value=100.0), \
+                patch.object(main.download_progress, 'touch', wraps=main.download_progress.touch) as touch:
+            # 1000 chunks covering 5% in the same instant: one write per 1%
+            for i in range(1, 1001):
+                hook(self._chunk(i * 5))
+        
+        self.assertEqual(touch.call_count, 5)
+        self.assertIs(main.download_progress['hook-a'], record)
+        self.assertEqual(record.status, 'downloading')
+        self.assertTrue(4 <= record.percentage < 5)
+        
+        # Time passing lets a small change through
+        with patch('main.time.monotonic', return_value=101.0):
+            hook(self._chunk(5001))
+        self.assertEqual(record.downloaded_bytes, 5001)
+        
+        track = main.playlist_progress['hook-pl'].tracks[0]
+        self.assertEqual(track['title'], 'Song')
+        self.assertEqual(track['status'], 'downloading')
+
+class TestProgressEvents(unittest.TestCase):
+    """Test the Server-Sent Events progress stream."""
+    
+    def _events(self, stream, count):
+        return [json.loads(next(stream).split('data: ', 1)[1]) for _ in range(count)]
+    
+    def test_stream_pushes_changes_until_jobs_finish(self):
+        """One stream covers several jobs, sends only changes and ends when all are done."""
+        main.download_progress['sse-a'] = {'status': 'downloading', 'percentage': 10}
+        main.playlist_progress['sse-pl'] = {'status': 'completed', 'overall_percentage': 100}
+        stream = main.stream_progress_events([('download', 'sse-a'), ('playlist', 'sse-pl')])
+        
+        first = self._events(stream, 2)
+        self.assertEqual([(e['type'], e['id']) for e in first],
+                         [('download', 'sse-a'), ('playlist', 'sse-pl')])
+        
+        def finish():
+            time.sleep(0.05)
+            main.download_progress['sse-a'] = {'status': 'completed', 'percentage': 100}
+        threading.Thread(target=finish).start()
+        
+        # Only the changed job is sent again, then the stream closes
+        update = self._events(stream, 1)[0]
+        self.assertEqual((update['id'], update['progress']['status']), ('sse-a', 'completed'))
+        self.assertTrue(next(stream).startswith('event: done'))
+        self.assertRaises(StopIteration, next, stream)
+    
+    def test_streams_only_reread_changed_jobs(self):
+        """Writes to other jobs wake a stream without it re-reading the jobs it watches."""
+        main.download_progress['sse-watched'] = {'status': 'downloading', 'percentage': 10}
+        stream = main.stream_progress_events([('download', 'sse-watched')])
+        self._events(stream, 1)
+        
+        def write():
+            time.sleep(0.05)
+            for i in range(20):
+                main.download_progress['sse-other'] = {'status': 'downloading', 'percentage': i}
+                time.sleep(0.002)
+            main.download_progress['sse-watched'] = {'status': 'completed', 'percentage': 100}
+        threading.Thread(target=write).start()
+        
+        with patch('main.job_snapshot', wraps=main.job_snapshot) as snapshot:
+            update = self._events(stream, 1)[0]
+        self.assertEqual(update['progress']['status'], 'completed')
+        self.assertEqual({call.args for call in snapshot.call_args_list}, {('download', 'sse-watched')})
+        self.assertLessEqual(snapshot.call_count, 2)
+    
+    def test_notifier_reports_changed_keys(self):
+        notifier = main.ProgressNotifier()
+        notifier.publish(keys=[('downloads', 'a')])
+        notifier.publish(keys=[('playlists', 'b')])
+        self.assertEqual(notifier.changes_since(1), (2, {('playlists', 'b')}))
+        self.assertEqual(notifier.changes_since(0), (2, {('downloads', 'a'), ('playlists', 'b')}))
+        # A change from another node without its keys, or one too old to remember, means re-read everything
+        notifier.observe(5)
+        self.assertEqual(notifier.changes_since(2), (5, None))
+        with patch.object(main.ProgressNotifier, 'CHANGE_LOG_SIZE', 1):
+            notifier = main.ProgressNotifier()
+            notifier.publish(keys=())
+            notifier.publish(keys=())
+        self.assertEqual(notifier.changes_since(1), (2, set()))
+        self.assertEqual(notifier.changes_since(0), (2, None))
+    
+    def test_idle_stream_sends_keepalive(self):
+        """Without changes the stream only emits keep-alive comments."""
+        main.download_progress['sse-idle'] = {'status': 'downloading'}
+        with patch.dict(main.CONFIG, {'SSE_KEEPALIVE': 0.01}):
+            stream = main.stream_progress_events([('download', 'sse-idle')])
+            next(stream)
+            self.assertEqual(next(stream), ': keep-alive\n\n')
+    
+    def test_events_route_requires_ids(self):
+        response = app.test_client().get('/events')
+        self.assertEqual(response.status_code, 400)
+    
+    def test_batch_progress_returns_only_changes(self):
+        """The batch endpoint reports every job once, then only what changed since the cursor."""
+        client = app.test_client()
+        main.download_progress['batch-a'] = {'status': 'downloading', 'percentage': 10}
+        main.download_progress['batch-b'] = {'status': 'completed', 'percentage': 100}
+        main.playlist_progress['batch-pl'] = {'status': 'downloading', 'overall_percentage': 50}
+        body = {'downloads': ['batch-a', 'batch-b'], 'playlists': ['batch-pl']}
+        
+        first = client.post('/progress/batch', json=body)
+        self.assertEqual(first.status_code, 200)
+        data = first.get_json()
+        self.assertEqual(set(data['downloads']), {'batch-a', 'batch-b'})
+        self.assertEqual(data['playlists']['batch-pl']['overall_percentage'], 50)
+        
+        # Nothing changed: 304 via If-None-Match
+        unchanged = client.post('/progress/batch', json=body, headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(unchanged.status_code, 304)
+        
+        main.download_progress['batch-a'] = {'status': 'downloading', 'percentage': 60}
+        changed = client.post('/progress/batch', json=dict(body, since=data['cursor'])).get_json()
+        self.assertEqual(list(changed['downloads']), ['batch-a'])
+        self.assertEqual(changed['playlists'], {})
+        self.assertGreater(changed['cursor'], data['cursor'])
+    
+    def test_batch_progress_validates_body(self):
+        client = app.test_client()
+        self.assertEqual(client.post('/progress/batch', json={}).status_code, 400)
+        self.assertEqual(client.post('/progress/batch', json={'downloads': 'x'}).status_code, 400)
+        self.assertEqual(client.post('/progress/batch', json={'downloads': ['x'], 'since': 'abc'}).status_code, 400)
+
+class TestAsgi(unittest.TestCase):
+    """Test the ASGI entry point."""
+    
+    def _request(self, path, query=b'', headers=()):
+        return asyncio.run(self._serve(path, query, headers))
+    
+    async def _serve(self, path, query=b'', headers=()):
+        messages = []
+        requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query,
+                 'headers': [(name.encode(), value.encode()) for name, value in headers]}
+        
+        async def receive():
+            if requests:
+                return requests.pop()
+            # Client stays connected until the response ends
+            await asyncio.sleep(3600)
+        
+        async def send(message):
+            messages.append(message)
+        
+        await asgi.application(scope, receive, send)
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return messages[0]['status'], dict(messages[0]['headers']), body
+    
+    def test_file_range_through_bridge(self):
+        """Flask routes, including ranged file downloads, are served unchanged."""
+        with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as f:
+            data = os.urandom(600 * 1024)
+            f.write(data)
+        self.addCleanup(os.remove, f.name)
+        main.download_progress['asgi-file'] = {'status': 'completed', 'file_path': f.name, 'filename': 'song.mp3'}
+        
+        status, headers, body = self._request('/download_file/asgi-file', headers=[('Range', 'bytes=10-299999')])
+        self.assertEqual(status, 206)
+        self.assertEqual(body, data[10:300000])
+        self.assertEqual(headers[b'content-length'], b'299990')
+    
+    def test_event_stream_runs_on_the_loop(self):
+        """/events pushes changes from worker threads and ends when jobs finish."""
+        main.download_progress['asgi-sse'] = {'status': 'downloading', 'percentage': 10}
+        
+        def finish():
+            time.sleep(0.1)
+            main.download_progress['asgi-sse'] = {'status': 'completed', 'percentage': 100}
+        threading.Thread(target=finish).start()
+        
+        status, headers, body = self._request('/events', query=b'downloads=asgi-sse')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'content-type'], b'text/event-stream; charset=utf-8')
+        events = [json.loads(line[6:]) for line in body.decode().splitlines() if line.startswith('data: {"')]
+        self.assertEqual([event['progress']['status'] for event in events], ['downloading', 'completed'])
+        self.assertTrue(body.endswith(b'event: done\ndata: {}\n\n'))
+    
+    def test_event_streams_skip_unrelated_changes(self):
+        """Progress of other jobs wakes a stream but takes no snapshot thread."""
+        main.download_progress['asgi-watched'] = {'status': 'downloading', 'percentage': 10}
+        
+        def write():
+            time.sleep(0.1)
+            for i in range(20):
+                main.download_progress['asgi-other'] = {'status': 'downloading', 'percentage': i}
+                time.sleep(0.002)
+            main.download_progress['asgi-watched'] = {'status': 'completed', 'percentage': 100}
+        threading.Thread(target=write).start()
+        
+        with patch('main.changed_progress_events', wraps=main.changed_progress_events) as snapshot, \
+                patch('asgi.bridge_pool') as bridge_pool:
+            status, _, body = self._request('/events', query=b'downloads=asgi-watched')
+        self.assertTrue(body.endswith(b'event: done\ndata: {}\n\n'))
+        self.assertLessEqual(snapshot.call_count, 3)
+        bridge_pool.submit.assert_not_called()
+    
+    def test_pending_zip_streams_leave_bridge_free(self):
+        """ZIPs waiting on unfinished tracks hold no bridge thread, so other routes still answer."""
+        download_dir = make_temp_dir(self)
+        path = os.path.join(download_dir, 'late.mp3')
+        with open(path, 'wb') as f:
+            f.write(b'audio' * 100)
+        files = main.PlaylistFiles()
+        files.set_total(1)
+        main.playlist_files['asgi-zip'] = files
+        main.playlist_progress['asgi-zip'] = {'status': 'downloading', 'zip_filename': 'late.zip'}
+        main.download_progress['asgi-json'] = {'status': 'downloading', 'percentage': 5}
+        
+        async def scenario():
+            streams = [asyncio.ensure_future(self._serve('/download_playlist/asgi-zip')) for _ in range(3)]
+            # One bridge thread serves the route while three streams wait for their track
+            status, _, body = await asyncio.wait_for(self._serve('/progress/asgi-json'), 5)
+            self.assertFalse(any(stream.done() for stream in streams))
+            
+            files.add(0, path)
+            files.finish()
+            main.playlist_progress.update('asgi-zip', {'status': 'completed'})
+            return status, body, await asyncio.wait_for(asyncio.gather(*streams), 5)
+        
+        with patch.object(asgi, 'bridge_pool', ThreadPoolExecutor(max_workers=1)):
+            status, body, streamed = asyncio.run(scenario())
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['percentage'], 5)
+        for status, _, data in streamed:
+            self.assertEqual(status, 200)
+            with zipfile.ZipFile(io.BytesIO(data)) as zipf:
+                self.assertEqual(zipf.namelist(), ['late.mp3'])
+    
+    def test_event_stream_requires_ids(self):
+        status, _, body = self._request('/events')
+        self.assertEqual(status, 400)
+        self.assertIn(b'error', body)
+
+class TestSharedState(unittest.TestCase):
+    """Test progress and jobs shared between nodes through a StateDB."""
+    
+    def setUp(self):
+        path = os.path.join(make_temp_dir(self), 'state.db')
+        # Two connections to one file stand in for two nodes
+        self.node_a = main.StateDB(path)
+        self.node_b = main.StateDB(path)
+    
+    def _store(self, db, name='downloads', record_class=main.DownloadRecord):
+        return main.ProgressStore(record_class, main.SqliteProgressBackend(db, name, record_class))
+    
+    def test_progress_is_visible_to_other_nodes(self):
+        """Records written on one node are read, with global versions, on another."""
+        store_a, store_b = self._store(self.node_a), self._store(self.node_b)
+        store_a['job'] = {'status': 'downloading', 'percentage': 10}
+        self.assertEqual(store_b['job'].percentage, 10)
+        
+        # In-place changes are written through when the record is passed back
+        record = store_a['job']
+        record.percentage = 50
+        store_a.touch('job', record)
+        self.assertEqual(store_b['job'].percentage, 50)
+        
+        store_b['other'] = {'status': 'queued'}
+        self.assertGreater(store_a['other'].version, store_b['job'].version)
+        self.assertEqual(store_a.backend.keys(), ['job', 'other'])
+        
+        playlists_a = self._store(self.node_a, 'playlists', main.PlaylistRecord)
+        playlists_b = self._store(self.node_b, 'playlists', main.PlaylistRecord)
+        playlists_a['pl'] = {'status': 'downloading', 'tracks': {0: {'status': 'completed'}}}
+        self.assertEqual(playlists_b['pl'].tracks[0]['status'], 'completed')
+        self.assertIsNone(playlists_b.get('job'))
+    
+    def test_worker_node_runs_jobs_queued_by_api_node(self):
+        """Jobs queued on an API node keep their order and run on a worker node."""
+        api = main.SharedJobQueue(self.node_a, workers=1, max_queued=2)
+        worker = main.SharedJobQueue(self.node_b, workers=1, max_queued=2)
+        ran = []
+        finished = threading.Event()
+        
+        def fake_job(name):
+            ran.append(name)
+            if len(ran) == 2:
+                finished.set()
+        
+        with patch.dict(main.JOB_FUNCTIONS, {'fake_job': fake_job}):
+            api.submit('job-1', fake_job, 'first')
+            api.submit('job-2', fake_job, 'second')
+            self.assertEqual(api.position('job-2'), 2)
+            self.assertRaises(main.QueueFullError, api.submit, 'job-3', fake_job, 'third')
+            
+            worker.start()
+            self.assertTrue(finished.wait(5))
+        
+        self.assertEqual(ran, ['first', 'second'])
+        for _ in range(100):
+            if api.stats()['running'] == 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual((api.stats()['queued'], api.stats()['running']), (0, 0))
+    
+    def test_requeued_job_runs_again_when_due(self):
+        """A job raising RequeueJob frees its worker and runs again with new arguments after its delay."""
+        queue = main.SharedJobQueue(self.node_a, workers=1, max_queued=2)
+        ran = []
+        finished = threading.Event()
+        
+        def fake_job(name, run=0):
+            ran.append((name, run))
+            if name == 'waiting' and run == 0:
+                raise main.RequeueJob(0.3, (name, 1))
+            if len(ran) == 3:
+                finished.set()
+        
+        with patch.dict(main.JOB_FUNCTIONS, {'fake_job': fake_job}):
+            queue.submit('job-waiting', fake_job, 'waiting')
+            queue.submit('job-next', fake_job, 'next')
+            queue.start()
+            self.assertTrue(finished.wait(5))
+        
+        self.assertEqual(ran, [('waiting', 0), ('next', 0), ('waiting', 1)])
+    
+    def test_jobs_of_a_dead_worker_are_taken_back(self):
+        """A job whose worker stopped renewing its lease is queued again, and fails when that happens twice."""
+        dead = main.SharedJobQueue(self.node_a, workers=1, max_queued=2)
+        survivor = main.SharedJobQueue(self.node_b, workers=1, max_queued=2)
+        url = 'https://soundcloud.com/a/orphan'
+        main.claim_inflight('soundcloud:orphan', 'dl-orphan')
+        
+        with patch.dict(main.CONFIG, {'JOB_LEASE': 0.1}):
+            dead.submit('dl-orphan', main.run_single_download, url, 'dl-orphan', 'soundcloud:orphan')
+            main.download_progress['dl-orphan'] = {'status': 'downloading', 'percentage': 40}
+            # Claimed by a worker that is killed before it finishes or renews the lease
+            self.assertEqual(dead._claim()[0], 'dl-orphan')
+            self.assertIsNone(survivor._claim())
+            self.assertEqual(main.claim_inflight('soundcloud:orphan', 'dl-again'), 'dl-orphan')
+            
+            time.sleep(0.15)
+            self.assertEqual(survivor._claim()[:2], ('dl-orphan', main.run_single_download))
+            self.assertEqual(survivor.stats()['running'], 1)
+            
+            # The second worker dies as well
+            time.sleep(0.15)
+            self.assertIsNone(dead._claim())
+        
+        self.assertEqual(survivor.stats()['running'], 0)
+        self.assertEqual(main.download_progress['dl-orphan']['status'], 'error')
+        self.assertIsNone(main.claim_inflight('soundcloud:orphan', 'dl-again'))
+        main.release_inflight('soundcloud:orphan', 'dl-again')
+    
+    def test_heartbeat_keeps_running_jobs(self):
+        """A job running longer than JOB_LEASE keeps its lease and is not taken back."""
+        worker = main.SharedJobQueue(self.node_a, workers=1, max_queued=2)
+        other = main.SharedJobQueue(self.node_b, workers=1, max_queued=2)
+        release = threading.Event()
+        ran = []
+        
+        def fake_job(name):
+            ran.append(name)
+            release.wait(5)
+        
+        with patch.dict(main.JOB_FUNCTIONS, {'fake_job': fake_job}), patch.dict(main.CONFIG, {'JOB_LEASE': 0.15}):
+            worker.submit('job-long', fake_job, 'long')
+            worker.start()
+            for _ in range(100):
+                if ran:
+                    break
+                time.sleep(0.01)
+            time.sleep(0.4)
+            self.assertIsNone(other._claim())
+            release.set()
+        
+        self.assertEqual(ran, ['long'])
+    
+    def test_playlist_files_from_records(self):
+        """Nodes that did not run a playlist stream its files from the track records."""
+        download_dir = make_temp_dir(self)
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(download_dir, f'{i}.mp3'))
+            with open(paths[-1], 'wb') as f:
+                f.write(b'audio')
+        main.playlist_progress['stored-pl'] = {'status': 'downloading', 'total_tracks': 3}
+        main.download_progress['stored-pl_track_0'] = {'status': 'completed', 'file_path': paths[0]}
+        main.download_progress['stored-pl_track_1'] = {'status': 'error'}
+        
+        files = iter(main.StoredPlaylistFiles('stored-pl'))
+        self.assertEqual(next(files), paths[0])
+        
+        def finish():
+            time.sleep(0.05)
+            main.download_progress['stored-pl_track_2'] = {'status': 'completed', 'file_path': paths[2]}
+            main.playlist_progress.update('stored-pl', {'status': 'completed'})
+        threading.Thread(target=finish).start()
+        
+        # None marks a wait that timed out before the next track resolved
+        self.assertEqual([path for path in files if path], [paths[2]])
+        self.assertEqual(main.StoredPlaylistFiles('stored-pl').ready(), [paths[0], paths[2]])
+    
+    def test_claims_of_finished_jobs_are_replaced(self):
+        """A claim left by a job that finished on another node does not block new jobs."""
+        main.download_progress['claim-old'] = {'status': 'completed'}
+        main.inflight_jobs['youtube:claimed'] = 'claim-old'
+        self.assertIsNone(main.claim_inflight('youtube:claimed', 'claim-new'))
+        self.assertEqual(main.inflight_jobs['youtube:claimed'], 'claim-new')
+        main.release_inflight('youtube:claimed', 'claim-new')
+
+class TestJobQueue(unittest.TestCase):
+    """Test admission control for download jobs."""
+    
+    def setUp(self):
+        self.app = app.test_client()
+        self.release = threading.Event()
+        self.queue = main.JobQueue(workers=1, max_queued=1)
+        self.queue_patch = patch('main.job_queue', self.queue)
+        self.queue_patch.start()
+    
+    def tearDown(self):
+        self.release.set()
+        self.queue_patch.stop()
+    
+    def test_queued_position_and_full_queue(self):
+        """Jobs beyond the workers report a position; beyond the queue they get 503."""
+        with patch('main.run_single_download', side_effect=lambda *args: self.release.wait()):
+            url = 'https://www.youtube.com/watch?v=queue{}'
+            self.app.post('/download', json={'url': url.format(1)})
+            # Wait for the worker to pick up the first job
+            for _ in range(100):
+                if self.queue.active:
+                    break
+                time.sleep(0.01)
+            
+            second = self.app.post('/download', json={'url': url.format(2)}).get_json()
+            progress = self.app.get(f"/progress/{second['download_id']}").get_json()
+            self.assertEqual(progress['status'], 'queued')
+            self.assertEqual(progress['queue_position'], 1)
+            
+            response = self.app.post('/download', json={'url': url.format(3)})
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('Retry-After', response.headers)
+
+    def test_duplicate_urls_join_running_job(self):
+        """Concurrent requests for the same media share one job."""
+        with patch('main.run_single_download', side_effect=lambda *args: self.release.wait()):
+            first = self.app.post('/download', json={
+                'url': 'https://www.youtube.com/watch?v=coalesce123'}).get_json()
+            second = self.app.post('/download', json={
+                'url': 'https://youtu.be/coalesce123'}).get_json()
+        
+        self.assertFalse(first['coalesced'])
+        self.assertTrue(second['coalesced'])
+        self.assertEqual(first['download_id'], second['download_id'])
+        self.assertEqual(self.queue.stats()['queued'] + self.queue.stats()['active'], 1)
+    
+    def test_track_waiting_to_retry_frees_its_worker(self):
+        """A single download waiting for a retry is queued again, so the worker runs other jobs meanwhile."""
+        fetched = []
+        done = threading.Event()
+        
+        def fake_fetch(job):
+            fetched.append(job.download_id)
+            if fetched == ['dl-flaky']:
+                raise Exception('HTTP Error 503')
+        
+        def fake_finish(job):
+            if job.download_id == 'dl-flaky':
+                done.set()
+            return f'/{job.download_id}.mp3'
+        
+        # The waiting job keeps its queue slot
+        self.queue.max_queued = 2
+        with patch('main.fetch_track', side_effect=fake_fetch), patch('main.finish_track', side_effect=fake_finish), \
+                patch('main.retry_backoff', return_value=0.3), patch.dict(main.circuit_breakers, clear=True):
+            self.queue.submit('dl-flaky', main.run_single_download, 'https://soundcloud.com/a/flaky', 'dl-flaky')
+            for _ in range(100):
+                if main.download_progress.get('dl-flaky', {}).get('message', '').startswith('Retrying'):
+                    break
+                time.sleep(0.01)
+            self.queue.submit('dl-other', main.run_single_download, 'https://soundcloud.com/a/other', 'dl-other')
+            self.assertTrue(done.wait(5))
+        
+        self.assertEqual(fetched, ['dl-flaky', 'dl-other', 'dl-flaky'])
+    
+    def test_full_platform_does_not_hold_job_workers(self):
+        """Single downloads of a platform at its limit stay queued while jobs for other platforms run."""
+        queue = main.JobQueue(workers=2, max_queued=5, ready=main.job_can_start)
+        stage = main.PlatformStage('download', 4, lambda job: main.detect_platform(job.url))
+        fetched = []
+        other_done = threading.Event()
+        
+        def fake_fetch(job):
+            fetched.append(job.download_id)
+            if 'soundcloud' in job.url:
+                self.release.wait(5)
+        
+        def fake_finish(job):
+            if job.download_id == 'dl-bandcamp':
+                other_done.set()
+            return f'/{job.download_id}.mp3'
+        
+        with patch('main.fetch_track', side_effect=fake_fetch), patch('main.finish_track', side_effect=fake_finish), \
+                patch('main.download_stage', stage), patch.dict(main.PLATFORM_SUPPORT['soundcloud.com'], {'max_concurrent': 1}):
+            for download_id, url in (('dl-sc-1', 'https://soundcloud.com/a/one'), ('dl-sc-2', 'https://soundcloud.com/a/two'),
+                                     ('dl-bandcamp', 'https://bandcamp.com/track/three')):
+                queue.submit(download_id, main.run_single_download, url, download_id)
+            self.assertTrue(other_done.wait(5))
+            
+            self.assertEqual(fetched, ['dl-sc-1', 'dl-bandcamp'])
+            self.assertEqual(queue.position('dl-sc-2'), 1)
+            self.release.set()
+            for _ in range(300):
+                if len(fetched) == 3:
+                    break
+                time.sleep(0.01)
+        
+        self.assertEqual(fetched, ['dl-sc-1', 'dl-bandcamp', 'dl-sc-2'])
+    
+    def test_only_a_leading_www_is_ignored(self):
+        """www. is dropped from the start of the host, not from inside it."""
+        self.assertEqual(main.normalize_url('https://www.example.com/a/'), 'example.com/a')
+        self.assertEqual(main.normalize_url('https://mywww.example.com/a'), 'mywww.example.com/a')
+        self.assertNotEqual(main.normalize_url('https://mywww.example.com/a'),
+                            main.normalize_url('https://my.example.com/a'))
+
 class TestConfiguration(unittest.TestCase):
     """Test configuration settings."""
     
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""Download worker for multi-node deployments
+
+    STATE_DB=/shared/state.db python worker.py
+
+Claims jobs that API nodes (ROLE=api) queued in the shared STATE_DB and runs
+them, writing progress back to it and results to the shared DOWNLOAD_DIR.
+Throughput scales with the number of workers; each runs MAX_ACTIVE_JOBS jobs.
+"""
+import os
+import sys
+import threading
+
+os.environ.setdefault('ROLE', 'worker')
+
+import main
+from main import CONFIG, logger
+
+def run():
+    if not main.state_db:
+        sys.exit("worker.py needs STATE_DB pointing at the database the API nodes use")
+    
+    logger.info(f"Download worker {main.NODE_ID}: {CONFIG['MAX_ACTIVE_JOBS']} jobs, download dir {CONFIG['DOWNLOAD_DIR']}")
+    main.start_services()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        logger.info("Worker stopped")
+
+if __name__ == '__main__':
+    run()